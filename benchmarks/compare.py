@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Compare two benchmark result files of run.py
+
+    python3 compare.py baseline.json candidate.json
+
+Prints the change of throughput and latency per scenario, slower is positive for
+times and negative for throughput. Exits with 1 if a scenario of the candidate had
+errors or regressed by more than --threshold percent.
+"""
+import argparse
+import json
+import sys
+
+# Metric, path into a scenario result, True if higher is better
+METRICS = [
+    ('ops/s', ('ops_per_second',), True),
+    ('p50', ('latency', 'p50'), False),
+    ('p99', ('latency', 'p99'), False),
+    ('seconds', ('seconds',), False),
+]
+
+
+def lookup(result, path):
+    for key in path:
+        if not isinstance(result, dict) or key not in result:
+            return None
+        result = result[key]
+    return result
+
+
+def change(before, after):
+    if before in (None, 0) or after is None:
+        return None
+    return (after - before) / before * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two GitCubby benchmark results")
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10, help="Percent a metric may regress")
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+        help="Timings closer than this are equal, keeps millisecond noise from failing the comparison")
+    args = parser.parse_args()
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    if baseline.get('config') != candidate.get('config'):
+        print("Warning: the runs used different configurations, see the config of both files")
+
+    failed = False
+    print(f"{'scenario':<20} {'metric':<8} {'baseline':>10} {'candidate':>10} {'change':>8}")
+    for scenario, result in candidate['scenarios'].items():
+        if result.get('errors'):
+            print(f"{scenario:<20} {result['errors']} errors: {result.get('first_error', '')}")
+            failed = True
+            continue
+        before_result = baseline['scenarios'].get(scenario)
+        if before_result is None:
+            continue
+        # Transport scenarios are judged by throughput and latency, the others by their duration
+        metrics = [metric for metric in METRICS if metric[0] != 'seconds' or 'latency' not in result]
+        for name, path, higher_is_better in metrics:
+            before, after = lookup(before_result, path), lookup(result, path)
+            percent = change(before, after)
+            if percent is None:
+                continue
+            regressed = -percent if higher_is_better else percent
+            significant = higher_is_better or abs(after - before) >= args.min_seconds
+            marker = ' !' if regressed > args.threshold and significant else ''
+            failed = failed or bool(marker)
+            print(f"{scenario:<20} {name:<8} {before:>10} {after:>10} {percent:>+7.1f}%{marker}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
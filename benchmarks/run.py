@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Load and throughput benchmarks of GitCubby
+
+Builds synthetic repositories under temporary repository roots, drives concurrent
+HTTP and SSH clones, fetches and pushes against locally started servers and times
+backup, verify and restore against a file:// target. Results are written as JSON,
+compare two runs with compare.py.
+
+Run it in a throwaway container of the image, it imports the GPG key, writes the
+configuration and starts servers like the container init does:
+
+    docker run --rm -v "$PWD/benchmarks:/srv/benchmarks" --entrypoint python3 gitcubby \\
+        /srv/benchmarks/run.py --output /srv/benchmarks/results.json
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+from synthetic import build_repository, extend_repository, mark_base, repository_refs
+from transport import Servers, TransportOperation
+
+RESULTS_VERSION = 1
+TRANSPORT_SCENARIOS = [f"{transport}-{operation}" for transport in ('http', 'ssh')
+                       for operation in ('clone', 'fetch', 'push')]
+BACKUP_SCENARIOS = ['backup-full', 'backup-unchanged', 'backup-incremental', 'verify', 'restore']
+SCENARIOS = TRANSPORT_SCENARIOS + BACKUP_SCENARIOS
+BENCH_PASSPHRASE = 'bench'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="GitCubby load and throughput benchmarks")
+    parser.add_argument('--src', default='/usr/local/bin', help="Directory holding utility, shell_utility and the bin scripts")
+    parser.add_argument('--workdir', help="Directory for repositories and backups, a temporary one by default")
+    parser.add_argument('--repos', type=int, default=4, help="Number of repositories, split between private and public")
+    parser.add_argument('--commits', type=int, default=200, help="Commits per repository")
+    parser.add_argument('--files', type=int, default=5, help="Files changed per commit")
+    parser.add_argument('--file-size', type=int, default=4096, help="Size of a file in bytes")
+    parser.add_argument('--fetch-depth', type=int, default=20, help="Commits a fetch client is behind")
+    parser.add_argument('--push-size', type=int, default=65536, help="Bytes added by a push")
+    parser.add_argument('--concurrency', type=int, default=4, help="Concurrent clients of a transport scenario")
+    parser.add_argument('--iterations', type=int, default=5, help="Operations per client")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"Comma separated, of {', '.join(SCENARIOS)}")
+    parser.add_argument('--output', help="Write the results to a JSON file instead of stdout")
+    parser.add_argument('--no-lighttpd', action='store_true', help="Send HTTP straight to the smart-HTTP service")
+    parser.add_argument('--no-sshd', action='store_true', help="Run the login shell locally instead of through sshd")
+    parser.add_argument('--force', action='store_true', help="Run even though this looks like a live instance")
+    args = parser.parse_args()
+    args.scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def generate_key(workdir):
+    """
+    Returns:
+        str: Base64 encoded armored secret key, protected with BENCH_PASSPHRASE
+    """
+    home = Path(workdir) / 'gnupg'
+    home.mkdir(mode=0o700)
+    gpg = ['gpg', '--homedir', str(home), '--batch', '--pinentry-mode', 'loopback', '--passphrase', BENCH_PASSPHRASE]
+    subprocess.run(gpg + ['--quick-gen-key', 'GitCubby Benchmark <bench@localhost>', 'default', 'default', 'never'],
+        check=True, capture_output=True)
+    key = subprocess.run(gpg + ['--armor', '--export-secret-keys'], check=True, capture_output=True).stdout
+    return base64.b64encode(key).decode()
+
+
+def looks_live():
+    """
+    Returns:
+        list: Reasons to believe the benchmark would run over the data of a live instance
+    """
+    reasons = []
+    for root in ('/private', '/public'):
+        if Path(root).is_dir() and any(Path(root).iterdir()):
+            reasons.append(f"{root} holds repositories")
+    if Path('/etc/gitcubby').is_dir() and any(Path('/etc/gitcubby').iterdir()):
+        reasons.append("/etc/gitcubby holds state")
+    return reasons
+
+
+def configure_environment(args, workdir):
+    """Point the configuration at the benchmark workdir before utility is imported"""
+    roots = {'private': workdir / 'private', 'public': workdir / 'public'}
+    for root in roots.values():
+        root.mkdir()
+    os.environ.update(
+        # Like the container init, the environment is the whole configuration
+        GITCUBBY_CONFIG_SOURCE='environment',
+        PRIVATE_REPO_ROOT=str(roots['private']),
+        PUBLIC_REPO_ROOT=str(roots['public']),
+        BACKUP_TARGET=f"file://{workdir / 'backup'}",
+        # Backups are timed by the benchmark, not run on a schedule
+        BACKUP_SCHEDULER='false',
+    )
+    # The repositories belong to the git user and the clients run as root, git only
+    # takes safe.directory from the global or system configuration
+    git_config = workdir / 'gitconfig'
+    git_config.write_text("[safe]\n\tdirectory = *\n")
+    os.environ['GIT_CONFIG_GLOBAL'] = str(git_config)
+    if not os.environ.get('ENCRYPTION_KEY_MATERIAL'):
+        os.environ['ENCRYPTION_KEY_MATERIAL'] = generate_key(workdir)
+        os.environ['ENCRYPTION_PASSPHRASE'] = BENCH_PASSPHRASE
+    return roots
+
+
+def build_repositories(args, roots):
+    """
+    Returns:
+        list: (repo_type, path) of the synthetic repositories
+    """
+    from utility.gitcmd import chown_to_git_user
+    repositories = []
+    for index in range(args.repos):
+        repo_type = 'private' if index % 2 == 0 else 'public'
+        path = roots[repo_type] / f"bench{index}.git"
+        build_repository(path, args.commits, args.files, args.file_size, seed=index)
+        mark_base(path, args.fetch_depth)
+        repositories.append((repo_type, path))
+    for root in roots.values():
+        chown_to_git_user(str(root))
+    return repositories
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies, errors, took):
+    result = {
+        'count': len(latencies),
+        'errors': len(errors),
+        'seconds': round(took, 3),
+        'ops_per_second': round(len(latencies) / took, 3) if took else None,
+    }
+    if latencies:
+        result['latency'] = {
+            'mean': round(sum(latencies) / len(latencies), 4),
+            'p50': round(percentile(latencies, 0.5), 4),
+            'p90': round(percentile(latencies, 0.9), 4),
+            'p99': round(percentile(latencies, 0.99), 4),
+            'max': round(max(latencies), 4),
+        }
+    if errors:
+        result['first_error'] = errors[0]
+    return result
+
+
+def run_transport_scenario(scenario, args, servers, repositories, workdir):
+    """Run concurrency clients doing iterations operations each, spread over the repositories"""
+    transport, operation = scenario.split('-')
+    scenario_dir = workdir / 'clients' / scenario
+    scenario_dir.mkdir(parents=True)
+    operations = []
+    for index in range(args.concurrency * args.iterations):
+        repo_type, path = repositories[index % len(repositories)]
+        operations.append(TransportOperation(servers, operation, transport, repo_type, path, scenario_dir,
+            push_size=args.push_size))
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for error in pool.map(lambda item: prepare(*item), enumerate(operations)):
+            if error:
+                errors.append(error)
+    if errors:
+        return summarize([], errors, 0)
+
+    def timed(operation):
+        start = time.perf_counter()
+        try:
+            operation.run()
+        except RuntimeError as e:
+            return None, str(e)
+        finally:
+            took = time.perf_counter() - start
+            operation.cleanup()
+        return took, None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(timed, operations))
+    took = time.perf_counter() - start
+    shutil.rmtree(scenario_dir, ignore_errors=True)
+    return summarize([latency for latency, _ in results if latency is not None],
+                     [error for _, error in results if error], took)
+
+
+def prepare(iteration, operation):
+    try:
+        operation.prepare(iteration)
+    except RuntimeError as e:
+        return str(e)
+    return None
+
+
+def directory_size(path):
+    return sum(entry.stat().st_size for entry in Path(path).rglob('*') if entry.is_file())
+
+
+def timed_call(function):
+    start = time.perf_counter()
+    try:
+        outcome = function()
+        error = None
+    except Exception as e:
+        outcome, error = None, str(e)
+    result = {'seconds': round(time.perf_counter() - start, 3)}
+    if outcome is False or error:
+        result['errors'] = 1
+        result['first_error'] = error or "Returned False, see the log"
+    return result
+
+
+def wait_for_progressive_restore(timeout):
+    from shell_utility.restore_status import read_restore_status
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = read_restore_status()
+        if not status or status['state'] != 'running':
+            return
+        time.sleep(0.2)
+    raise RuntimeError(f"Progressive restore still running after {timeout}s")
+
+
+def run_backup_scenarios(args, roots, repositories, workdir):
+    from utility import BACKUP_PATHS, CREDENTIALS_DB, GCBackup, GCGpg
+    from utility.gitcmd import chown_to_git_user
+    backup = GCBackup(GCGpg(), configure=False)
+    target = workdir / 'backup'
+    results = {}
+
+    def run(scenario, function):
+        if scenario in args.scenarios:
+            results[scenario] = dict(timed_call(function), target_bytes=directory_size(target))
+
+    run('backup-full', lambda: backup.perform_backup(force=True))
+    run('backup-unchanged', backup.perform_backup)
+    if 'backup-incremental' in args.scenarios:
+        # A tenth of the history is new, as after a busy day of pushes
+        for index, (_, path) in enumerate(repositories):
+            extend_repository(path, max(args.commits // 10, 1), args.files, args.file_size, seed=1000 + index)
+        for root in roots.values():
+            chown_to_git_user(str(root))
+    run('backup-incremental', backup.perform_backup)
+    run('verify', backup.verify_backup)
+
+    if 'restore' in args.scenarios:
+        expected = {path: repository_refs(path) for _, path in repositories}
+        # Restore only runs into empty data paths
+        Path(CREDENTIALS_DB).unlink(missing_ok=True)
+        for root in roots.values():
+            root.rename(root.with_name(f"{root.name}.orig"))
+            root.mkdir()
+        occupied = [path for path in BACKUP_PATHS if not backup.is_path_empty(path)]
+        if occupied:
+            results['restore'] = {'errors': 1, 'first_error': f"Restore needs empty {', '.join(occupied)}"}
+            return results
+
+        def restore():
+            if backup.restore_from_backup() is False:
+                return False
+            if backup.uses_progressive_restore():
+                wait_for_progressive_restore(3600)
+        result = timed_call(restore)
+        mismatched = [str(path) for path, refs in expected.items()
+                      if not path.exists() or repository_refs(path) != refs]
+        result['repositories'] = len(expected)
+        if mismatched and 'errors' not in result:
+            result['errors'] = 1
+            result['first_error'] = f"Restored refs differ for {', '.join(mismatched)}"
+        results['restore'] = result
+    return results
+
+
+def main():
+    args = parse_args()
+    reasons = looks_live()
+    if reasons and not args.force:
+        sys.exit(f"Refusing to run on what looks like a live instance ({'; '.join(reasons)}), "
+                 "use a throwaway container or --force")
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix='gitcubby-bench-'))
+    workdir.mkdir(parents=True, exist_ok=True)
+    # The git user of the servers has to reach the repository roots
+    workdir.chmod(0o755)
+    roots = configure_environment(args, workdir)
+    sys.path.insert(0, args.src)
+
+    started = datetime.now(timezone.utc).isoformat()
+    build_start = time.perf_counter()
+    repositories = build_repositories(args, roots)
+    results = {
+        'version': RESULTS_VERSION,
+        'started': started,
+        'host': {'hostname': platform.node(), 'cpus': os.cpu_count(), 'platform': platform.platform()},
+        'git': subprocess.run(['git', '--version'], capture_output=True, text=True).stdout.strip(),
+        'config': {
+            key: getattr(args, key) for key in
+            ('repos', 'commits', 'files', 'file_size', 'fetch_depth', 'push_size', 'concurrency', 'iterations')
+        },
+        'build_seconds': round(time.perf_counter() - build_start, 3),
+        'repository_bytes': sum(directory_size(path) for _, path in repositories),
+        'scenarios': {},
+    }
+
+    transport_scenarios = [scenario for scenario in args.scenarios if scenario in TRANSPORT_SCENARIOS]
+    if transport_scenarios:
+        servers = Servers(workdir, args.src)
+        try:
+            servers.start(use_lighttpd=not args.no_lighttpd, use_sshd=not args.no_sshd)
+            results['servers'] = {'http': servers.http_via, 'ssh': servers.ssh_via}
+            for scenario in transport_scenarios:
+                print(f"Running {scenario}", file=sys.stderr)
+                results['scenarios'][scenario] = run_transport_scenario(scenario, args, servers, repositories, workdir)
+        finally:
+            servers.stop()
+
+    if any(scenario in BACKUP_SCENARIOS for scenario in args.scenarios):
+        print("Running backup scenarios", file=sys.stderr)
+        results['scenarios'].update(run_backup_scenarios(args, roots, repositories, workdir))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n')
+    else:
+        print(output)
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if any(result.get('errors') for result in results['scenarios'].values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+import random
+import subprocess
+import time
+from pathlib import Path
+
+# Branch at main~FETCH_DEPTH, fetch clients start from it
+BASE_BRANCH = 'bench-base'
+
+
+def build_repository(path, commits, files_per_commit, file_size, seed=0):
+    """
+    Create a bare repository with a linear synthetic history
+
+    The history is written with git fast-import, a few hundred commits take well
+    under a second. Files are hex text of random bytes so they compress about as
+    well as source code, and every commit rewrites files_per_commit of them.
+
+    Args:
+        path: Repository directory, must not exist
+        commits: Number of commits on main
+        files_per_commit: Files changed by every commit
+        file_size: Size of a file in bytes
+        seed: Seed of the content, equal seeds build equal repositories
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    subprocess.run(['git', 'init', '--bare', '--quiet', str(path)], check=True)
+    subprocess.run(['git', '-C', str(path), 'symbolic-ref', 'HEAD', 'refs/heads/main'], check=True)
+    import_commits(path, commits, files_per_commit, file_size, random.Random(seed))
+
+
+def extend_repository(path, commits, files_per_commit, file_size, seed=0):
+    """Add synthetic commits on top of main, see build_repository"""
+    import_commits(path, commits, files_per_commit, file_size, random.Random(seed), parent='refs/heads/main^0')
+
+
+def import_commits(path, commits, files_per_commit, file_size, rng, parent=None):
+    file_names = [f"src/module{index % 16}/file{index}.txt" for index in range(max(files_per_commit * 8, 1))]
+    timestamp = int(time.time()) - commits * 60
+    process = subprocess.Popen(['git', '-C', str(path), 'fast-import', '--quiet'], stdin=subprocess.PIPE)
+    for number in range(1, commits + 1):
+        message = f"Synthetic commit {number}\n".encode()
+        stream = [
+            b"commit refs/heads/main\n",
+            f"mark :{number}\n".encode(),
+            f"committer Benchmark <bench@localhost> {timestamp + number * 60} +0000\n".encode(),
+            f"data {len(message)}\n".encode(), message,
+        ]
+        if number > 1:
+            stream.append(f"from :{number - 1}\n".encode())
+        elif parent:
+            stream.append(f"from {parent}\n".encode())
+        for name in rng.sample(file_names, min(files_per_commit, len(file_names))):
+            content = rng.randbytes(file_size // 2).hex().encode()
+            stream.append(f"M 644 inline {name}\ndata {len(content)}\n".encode())
+            stream.append(content + b"\n")
+        process.stdin.write(b''.join(stream))
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError(f"git fast-import failed for {path}")
+
+
+def mark_base(path, depth):
+    """Point BASE_BRANCH depth commits behind main, or at the root commit of a shorter history"""
+    commits = int(subprocess.run(['git', '-C', str(path), 'rev-list', '--count', 'main'],
+        capture_output=True, text=True, check=True).stdout)
+    revision = f"main~{min(depth, commits - 1)}"
+    subprocess.run(['git', '-C', str(path), 'branch', '--force', BASE_BRANCH, revision], check=True)
+
+
+def repository_refs(path):
+    """
+    Returns:
+        dict: Ref name to object id, used to compare a restored repository with its original
+    """
+    result = subprocess.run(['git', '-C', str(path), 'for-each-ref',
+        '--format=%(refname) %(objectname)'], capture_output=True, text=True, check=True)
+    return dict(line.split(' ', 1) for line in result.stdout.splitlines())
@@ -0,0 +1,186 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from synthetic import BASE_BRANCH
+
+BENCH_USER = 'bench'
+BENCH_PASSWORD = 'bench'
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Nothing listens on port {port} after {timeout}s")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Servers():
+    """Starts the git servers of the image against the benchmark repository roots
+
+    HTTP goes through lighttpd and the smart-HTTP service as in production, or to
+    the service alone when lighttpd is not installed. SSH goes through a second sshd
+    on a free port with the production sshd_config, the login shell and the key
+    lookup, or runs the login shell locally when sshd is not available.
+    """
+
+    def __init__(self, workdir, bin_dir):
+        self.workdir = Path(workdir)
+        self.bin_dir = Path(bin_dir)
+        self.processes = []
+        self.http_via = None
+        self.ssh_via = None
+        self.env = dict(os.environ)
+
+    def start(self, use_lighttpd=True, use_sshd=True):
+        from shell_utility import GIT_HTTP_SERVICE_PORT, USER
+        # The service runs as the git user that owns the repositories, as in the container
+        self.spawn([str(self.bin_dir / 'git-http-service')], user=USER if os.geteuid() == 0 else None)
+        wait_for_port(GIT_HTTP_SERVICE_PORT)
+        self.service_port = GIT_HTTP_SERVICE_PORT
+
+        if use_lighttpd and shutil.which('lighttpd') and Path('/etc/lighttpd/lighttpd.conf').exists():
+            from shell_utility import CredentialStore
+            credentials = CredentialStore()
+            credentials.set_password(BENCH_USER, BENCH_PASSWORD)
+            credentials.close()
+            self.spawn(['lighttpd', '-D', '-f', '/etc/lighttpd/lighttpd.conf'])
+            self.http_port = 9980
+            wait_for_port(self.http_port)
+            self.http_via = 'lighttpd'
+        else:
+            self.http_port = self.service_port
+            self.http_via = 'service'
+
+        if use_sshd and shutil.which('sshd') and os.geteuid() == 0:
+            self.start_sshd()
+            self.ssh_via = 'sshd'
+        else:
+            self.ssh_via = 'local'
+        self.write_ssh_command()
+
+    def spawn(self, cmd, user=None):
+        log = open(self.workdir / f"{Path(cmd[0]).name}.log", 'a')
+        self.processes.append(subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=self.env,
+            user=user, group=user))
+
+    def start_sshd(self):
+        from shell_utility import SSHKeyIndex
+        host_key = self.workdir / 'ssh_host_ed25519_key'
+        self.client_key = self.workdir / 'client_key'
+        for key in (host_key, self.client_key):
+            subprocess.run(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '', '-f', str(key)], check=True)
+        key_file = self.workdir / f"{BENCH_USER}.pub"
+        shutil.copy(f"{self.client_key}.pub", key_file)
+        index = SSHKeyIndex()
+        index.apply_changes([key_file], [])
+        index.close()
+
+        self.ssh_port = free_port()
+        self.spawn([shutil.which('sshd'), '-D', '-p', str(self.ssh_port), '-h', str(host_key),
+            '-o', f"PidFile={self.workdir / 'sshd.pid'}", '-E', str(self.workdir / 'sshd.log')])
+        wait_for_port(self.ssh_port)
+
+    def write_ssh_command(self):
+        """GIT_SSH wrapper used by the SSH scenarios"""
+        self.ssh_command = self.workdir / 'git-ssh'
+        if self.ssh_via == 'sshd':
+            script = (f'#!/bin/sh\nexec ssh -i {self.client_key} -o StrictHostKeyChecking=no '
+                      f'-o UserKnownHostsFile=/dev/null -o LogLevel=ERROR -p {self.ssh_port} "$@"\n')
+        else:
+            # The host and any option are dropped, the command runs through the login shell
+            script = f'#!/bin/sh\nfor last; do :; done\nexec {self.bin_dir / "gitcubby-shell"} -c "$last"\n'
+        self.ssh_command.write_text(script)
+        self.ssh_command.chmod(0o755)
+
+    def url(self, transport, repo_type, repo_path):
+        if transport == 'http':
+            credentials = f"{BENCH_USER}:{BENCH_PASSWORD}@" if self.http_via == 'lighttpd' else ''
+            return f"http://{credentials}127.0.0.1:{self.http_port}/{repo_type}/{repo_path.name}"
+        return f"ssh://git@127.0.0.1{repo_path}"
+
+    def git_env(self):
+        env = dict(self.env, GIT_SSH=str(self.ssh_command), GIT_SSH_VARIANT='ssh', GIT_TERMINAL_PROMPT='0')
+        if self.http_via == 'service':
+            # Stands in for the user lighttpd would authenticate
+            env.update(GIT_CONFIG_COUNT='1', GIT_CONFIG_KEY_0='http.extraHeader',
+                GIT_CONFIG_VALUE_0=f'Forwarded: for=127.0.0.1;remote_user={BENCH_USER}')
+        return env
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+class TransportOperation():
+    """One clone, fetch or push against the servers, prepare is not timed"""
+
+    def __init__(self, servers, operation, transport, repo_type, repo_path, workdir, push_size=65536):
+        self.servers = servers
+        self.operation = operation
+        self.push_size = push_size
+        self.url = servers.url(transport, repo_type, repo_path)
+        self.repo_path = repo_path
+        self.workdir = Path(tempfile.mkdtemp(dir=workdir))
+        self.env = servers.git_env()
+
+    def git(self, *args, cwd=None, input=None, env=None):
+        return subprocess.run(['git', *args], cwd=cwd, env=env or self.env, input=input, capture_output=True, text=True)
+
+    def commit_new_file(self, iteration):
+        """Commit a file of push_size random bytes on top of main, returns the commit id"""
+        repo = ['-C', str(self.target)]
+        env = dict(self.env, GIT_INDEX_FILE=str(self.workdir / f"{iteration}.index"))
+        content = os.urandom(self.push_size // 2).hex()
+        blob = self.git(*repo, 'hash-object', '-w', '--stdin', input=content).stdout.strip()
+        self.git(*repo, 'read-tree', 'main', env=env)
+        self.git(*repo, 'update-index', '--add', '--cacheinfo', f"100644,{blob},bench/{self.workdir.name}-{iteration}.txt", env=env)
+        tree = self.git(*repo, 'write-tree', env=env).stdout.strip()
+        return self.git(*repo, '-c', 'user.name=Benchmark', '-c', 'user.email=bench@localhost',
+            'commit-tree', tree, '-p', 'main', '-m', f"Benchmark push {iteration}").stdout.strip()
+
+    def prepare(self, iteration):
+        self.target = self.workdir / f"{iteration}.git"
+        if self.operation == 'clone':
+            return
+        # Local clones hardlink the objects and cost next to nothing
+        branch = BASE_BRANCH if self.operation == 'fetch' else 'main'
+        result = self.git('clone', '--quiet', '--bare', '--single-branch', '--branch', branch,
+            str(self.repo_path), str(self.target))
+        if result.returncode != 0:
+            raise RuntimeError(f"Preparing {self.operation} failed: {result.stderr.strip()}")
+        self.git('-C', str(self.target), 'remote', 'set-url', 'origin', self.url)
+        if self.operation == 'push':
+            self.push_ref = f"{self.commit_new_file(iteration)}:refs/heads/bench/{self.workdir.name}-{iteration}"
+
+    def run(self):
+        if self.operation == 'clone':
+            result = self.git('clone', '--quiet', '--bare', self.url, str(self.target))
+        elif self.operation == 'fetch':
+            result = self.git('-C', str(self.target), 'fetch', '--quiet', 'origin', 'main')
+        else:
+            result = self.git('-C', str(self.target), 'push', '--quiet', 'origin', self.push_ref)
+        if result.returncode != 0:
+            raise RuntimeError(f"{self.operation} of {self.url} failed: {result.stderr.strip()}")
+
+    def cleanup(self):
+        shutil.rmtree(self.target, ignore_errors=True)
@@ -2,28 +2,141 @@
 
 import os
 import subprocess
+import sys
 
-from utility import GCLogger, GCGpg, GCSsh, GCBackup
+# The container environment is authoritative, the constants record it in the configuration snapshot
+os.environ['GITCUBBY_CONFIG_SOURCE'] = 'environment'
+
+from utility import (GCLogger, GCGpg, GCSsh, GCBackup, GCMaintenance, GCProvisioning, GCStartup, HTDIGEST_FILE,
+    USER, GIT_HTTP_SERVICE_LOG_PATH, SSH_KEYS_POLL_INTERVAL, BACKUP_SCHEDULER, METRICS_PORT, SSH_AUTH_LOG_PATH,
+    USAGE_INGEST_INTERVAL, GITCUBBY_MODE, REPLICA_LOG_PATH, PROVISIONING_POLL_INTERVAL)
+from shell_utility import CredentialStore, RepoCatalog, create_lock_dir
 
 
 logger = GCLogger(__name__).get_logger()
 logger.info("Starting GitCubby")
 
-logger.info("Initializing SSH Server and keys")
-ssh = GCSsh()
-ssh.install_ssh_keys()
+# A replica fetches its repositories from the primary, which restores and backs them up
+replica = GITCUBBY_MODE == 'replica'
+
+
+def install_ssh_keys():
+    startup.results['ssh'].install_ssh_keys()
+    if SSH_KEYS_POLL_INTERVAL > 0:
+        subprocess.Popen(['/usr/local/bin/ssh-key-watcher'])
+
+
+def migrate_web_users():
+    # Users left in the htdigest file, by older images or a restored backup, move into the store
+    credentials = CredentialStore()
+    migrated = credentials.import_htdigest(HTDIGEST_FILE)
+    if migrated:
+        logger.info(f"Migrated {migrated} web user(s) from {HTDIGEST_FILE} into the credential store")
+    credentials.close()
+
+
+def configure_maintenance():
+    maintenance = GCMaintenance()
+    maintenance.configure_maintenance_schedule()
+    return maintenance
+
+
+def start_backup_scheduler():
+    if BACKUP_SCHEDULER and startup.results['backup'].backup_enabled and not replica:
+        subprocess.Popen(['/usr/local/bin/backup-scheduler'])
+
+
+def start_crond():
+    backup = startup.results['backup']
+    if (backup.backup_enabled and not replica and backup.uses_cron() and backup.is_configured()) \
+            or startup.results['maintenance'].is_configured():
+        subprocess.Popen(['crond'])
+
+
+def reconcile_catalog():
+    catalog = RepoCatalog()
+    with catalog.update():
+        added, removed = catalog.reconcile()
+    logger.info(f"Repository catalog holds {len(catalog.repos)} repositories ({len(added)} added, {len(removed)} removed)")
+
+
+def provision():
+    gcp = GCProvisioning()
+    gcp.run()
+    # Also picks up a manifest mounted after startup
+    if PROVISIONING_POLL_INTERVAL > 0:
+        subprocess.Popen(['/usr/local/bin/provision', '--watch'])
+    elif gcp.is_deferred():
+        subprocess.Popen(['/usr/local/bin/provision', '--after-restore'])
+
+
+def start_git_http_service():
+    subprocess.Popen(
+        ['/usr/local/bin/git-http-service'],
+        user=USER, group=USER,
+        stdout=open(GIT_HTTP_SERVICE_LOG_PATH, 'a'), stderr=subprocess.STDOUT
+    )
+
+
+def start_replica_sync():
+    if replica:
+        subprocess.Popen(
+            ['/usr/local/bin/replica-sync'],
+            user=USER, group=USER,
+            stdout=open(REPLICA_LOG_PATH, 'a'), stderr=subprocess.STDOUT
+        )
+
+
+def start_metrics_exporter():
+    if METRICS_PORT > 0:
+        subprocess.Popen(['/usr/local/bin/metrics-exporter'], user=USER, group=USER)
+
+
+def start_usage_ingester():
+    if USAGE_INGEST_INTERVAL > 0:
+        subprocess.Popen(['/usr/local/bin/usage-ingester'], user=USER, group=USER)
+
+
+def start_lighttpd():
+    subprocess.Popen([
+        '/usr/sbin/lighttpd', '-D', '-f', '/etc/lighttpd/lighttpd.conf'
+    ])
+
+
+def start_sshd():
+    if not startup.results['ssh'].is_configured():
+        return None
+    # Logs go to a file, read by the metrics exporter, as there is no syslog daemon
+    return subprocess.Popen(["/usr/sbin/sshd", "-D", "-E", SSH_AUTH_LOG_PATH])
 
-logger.info("Initializing GPG Backup Keys")
-gpg = GCGpg()
 
-logger.info("Initializing Duplicity Backup")
-backup = GCBackup()
-if backup.is_configured():
-    subprocess.Popen(['crond'])
+# Nothing is served before the lock directory shared by the hooks and root jobs and the web
+# users are in place. The backup stage returns once the system shard holding the web users is
+# restored, a progressive restore brings the repositories online in the background while a
+# restore in place returns when they are all back.
+serving_requires = ['locks', 'web_users']
 
-subprocess.Popen([
-    '/usr/sbin/lighttpd', '-D', '-f', '/etc/lighttpd/lighttpd.conf'
-])
+startup = GCStartup()
+startup.add('locks', create_lock_dir)
+startup.add('ssh', GCSsh)
+startup.add('ssh_keys', install_ssh_keys, requires=['ssh'])
+startup.add('gpg', GCGpg)
+startup.add('backup', lambda: GCBackup(startup.results['gpg'], configure=not replica), requires=['gpg'])
+startup.add('web_users', migrate_web_users, requires=['backup'])
+startup.add('maintenance', configure_maintenance)
+startup.add('backup_scheduler', start_backup_scheduler, requires=['backup'])
+startup.add('crond', start_crond, requires=['backup', 'maintenance'])
+startup.add('catalog', reconcile_catalog, requires=['backup'])
+startup.add('provisioning', provision, requires=['catalog', 'web_users'])
+startup.add('git_http_service', start_git_http_service, requires=serving_requires)
+startup.add('replica_sync', start_replica_sync, requires=['catalog'])
+startup.add('metrics_exporter', start_metrics_exporter)
+startup.add('usage_ingester', start_usage_ingester, requires=['backup'])
+startup.add('lighttpd', start_lighttpd, requires=serving_requires)
+startup.add('sshd', start_sshd, requires=['ssh_keys'] + serving_requires)
+startup.run()
 
-if ssh.is_configured():
-    os.execv("/usr/sbin/sshd", ["/usr/sbin/sshd", "-D"])
+# The container lives as long as sshd does
+sshd = startup.results.get('sshd')
+if sshd:
+    sys.exit(sshd.wait())
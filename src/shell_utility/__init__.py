@@ -1,3 +1,35 @@
-from .constants import *
-from .user_interface import *
-from .util import *
\ No newline at end of file
+import importlib
+
+# Modules whose public names the package exports, imported on first use so a command that
+# runs per connection, such as the sshd AuthorizedKeysCommand, only loads what it needs
+SUBMODULES = (
+    'constants',
+    'user_interface',
+    'util',
+    'repository',
+    'catalog',
+    'locks',
+    'credentials',
+    'keys',
+    'restore_status',
+    'push_events',
+    'hooks',
+    'backup_stats',
+    'logtail',
+    'usage',
+    'forks',
+    'stats',
+    'snapshot',
+    'replication',
+)
+
+
+def __getattr__(name):
+    if not name.startswith('_'):
+        for module_name in SUBMODULES:
+            module = importlib.import_module(f"{__name__}.{module_name}")
+            if hasattr(module, name):
+                value = getattr(module, name)
+                globals()[name] = value
+                return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
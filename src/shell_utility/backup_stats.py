@@ -0,0 +1,79 @@
+import functools
+import json
+import threading
+import time
+from pathlib import Path
+
+from .constants import BACKUP_STATS_FILE
+from .locks import RepoLock
+from .util import atomic_write_text
+
+BACKUP_STATS_LOCK_NAME = 'stats'
+BACKUP_OPERATIONS = ('backup', 'verify', 'cleanup')
+
+_current_run = None
+_current_run_lock = threading.Lock()
+
+
+def read_backup_stats(stats_file=BACKUP_STATS_FILE):
+    """
+    Returns:
+        dict: Operation name to the stats of its last run, empty if nothing ran yet
+    """
+    try:
+        return json.loads(Path(stats_file).read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def add_backup_bytes(count):
+    """Add bytes written to the backup target to the run in progress, called from worker threads"""
+    with _current_run_lock:
+        if _current_run is not None:
+            _current_run['bytes'] += count
+
+
+def save_backup_run(operation, run, stats_file=BACKUP_STATS_FILE):
+    with RepoLock(stats_file, BACKUP_STATS_LOCK_NAME):
+        stats = read_backup_stats(stats_file)
+        previous = stats.get(operation, {})
+        if run['exit_status'] == 0:
+            run['last_success'] = run['finished']
+        else:
+            run['last_success'] = previous.get('last_success')
+        run['runs'] = previous.get('runs', 0) + 1
+        run['failures'] = previous.get('failures', 0) + (run['exit_status'] != 0)
+        stats[operation] = run
+        atomic_write_text(stats_file, json.dumps(stats, indent=2), mode=0o644)
+
+
+def record_backup_run(operation):
+    """
+    Decorator recording duration, bytes and exit status of a backup operation in BACKUP_STATS_FILE
+
+    The decorated function returns True on success. Bytes are reported by the engines
+    through add_backup_bytes while the run is in progress.
+
+    Args:
+        operation: One of BACKUP_OPERATIONS
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            global _current_run
+            run = {'started': time.time(), 'bytes': 0}
+            with _current_run_lock:
+                _current_run = run
+            success = False
+            try:
+                success = function(*args, **kwargs)
+                return success
+            finally:
+                with _current_run_lock:
+                    _current_run = None
+                run['finished'] = time.time()
+                run['duration'] = round(run['finished'] - run['started'], 3)
+                run['exit_status'] = 0 if success else 1
+                save_backup_run(operation, run)
+        return wrapper
+    return decorator
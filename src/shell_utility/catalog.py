@@ -0,0 +1,230 @@
+import fcntl
+import fnmatch
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from .constants import CATALOG_FILE, PRIVATE_REPO_ROOT, PUBLIC_REPO_ROOT
+from .forks import fork_parent
+from .repository import is_repository, iter_repositories, repo_updated_time
+from .util import atomic_write_text, clean_repo_name
+
+CATALOG_VERSION = 1
+
+REPO_TYPES = ('private', 'public')
+
+
+def repo_root_for(repo_type):
+    """Get the repository root directory for a repository type"""
+    return PUBLIC_REPO_ROOT if repo_type == "public" else PRIVATE_REPO_ROOT
+
+
+def repo_key(repo_type, repo_name):
+    """Get the catalog key of a repository, e.g. private/project.git"""
+    return f"{repo_type}/{repo_name}"
+
+
+def repo_key_for_path(path):
+    """Get the catalog key of a repository directory, None if it is outside the repository roots"""
+    for repo_type in REPO_TYPES:
+        try:
+            return repo_key(repo_type, str(Path(path).relative_to(repo_root_for(repo_type))))
+        except ValueError:
+            continue
+    return None
+
+
+class RepoCatalog():
+    """Persistent catalog of the repositories served by GitCubby
+
+    The catalog is a JSON file keyed by "<type>/<name>.git" holding the name, type,
+    path, created time, last update time and, for forks, the parent of each
+    repository. The repo commands update it as they change repositories and
+    reconcile() picks up repositories added or removed outside of them.
+    """
+
+    def __init__(self, catalog_file=CATALOG_FILE):
+        self.catalog_file = Path(catalog_file)
+        self.lock_file = self.catalog_file.with_name(self.catalog_file.name + '.lock')
+        self.data = self.load()
+
+    def load(self):
+        try:
+            data = json.loads(self.catalog_file.read_text())
+            if data.get('version') == CATALOG_VERSION:
+                return data
+        except (OSError, ValueError):
+            pass
+        return {'version': CATALOG_VERSION, 'reconciled_at': None, 'roots': {}, 'repos': {}}
+
+    def save(self):
+        atomic_write_text(self.catalog_file, json.dumps(self.data, indent=2, sort_keys=True))
+
+    @contextmanager
+    def update(self):
+        """Lock the catalog, reload it and save it when the block completes
+
+        Yields:
+            RepoCatalog: This catalog, holding the latest data
+        """
+        self.lock_file.parent.mkdir(parents=True, exist_ok=True)
+        # Opened read-only like RepoLock, the git user can lock a file root created
+        created = not self.lock_file.exists()
+        fd = os.open(self.lock_file, os.O_RDONLY | os.O_CREAT, 0o666)
+        if created:
+            try:
+                os.chmod(self.lock_file, 0o666)
+            except OSError:
+                pass
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self.data = self.load()
+            yield self
+            self.save()
+        finally:
+            os.close(fd)
+
+    @property
+    def repos(self):
+        return self.data['repos']
+
+    def get(self, repo_type, repo_name):
+        return self.repos.get(repo_key(repo_type, repo_name))
+
+    def add(self, repo_type, repo_name, created=None):
+        """Add or refresh a repository entry
+
+        Args:
+            repo_type: Repository type ('private' or 'public')
+            repo_name: Repository name including the .git suffix
+            created: Optional creation time, defaults to now for new entries
+
+        Returns:
+            dict: The catalog entry
+        """
+        path = Path(repo_root_for(repo_type)) / repo_name
+        now = time.time()
+        parent = fork_parent(path)
+        entry = self.repos.get(repo_key(repo_type, repo_name), {})
+        entry.update({
+            'name': clean_repo_name(repo_name),
+            'type': repo_type,
+            'path': str(path),
+            'created': entry.get('created') or created or now,
+            'updated': repo_updated_time(path) or now,
+            'parent': repo_key_for_path(parent) if parent else None,
+        })
+        self.repos[repo_key(repo_type, repo_name)] = entry
+        return entry
+
+    def remove(self, repo_type, repo_name):
+        return self.repos.pop(repo_key(repo_type, repo_name), None)
+
+    def rename(self, repo_type, old_name, new_name):
+        entry = self.remove(repo_type, old_name) or {}
+        self.repos[repo_key(repo_type, new_name)] = entry
+        return self.add(repo_type, new_name, created=entry.get('created'))
+
+    def root_mtimes(self):
+        mtimes = {}
+        for repo_type in REPO_TYPES:
+            try:
+                mtimes[repo_type] = Path(repo_root_for(repo_type)).stat().st_mtime
+            except OSError:
+                mtimes[repo_type] = None
+        return mtimes
+
+    def is_stale(self):
+        """Check if repositories may have been added or removed outside the repo commands
+
+        Returns:
+            bool: True if the catalog was never reconciled or a repository root changed since
+        """
+        return self.data.get('reconciled_at') is None or self.data.get('roots') != self.root_mtimes()
+
+    def reconcile(self):
+        """Bring the catalog in line with the repositories on disk
+
+        Returns:
+            tuple: Lists of added and removed catalog keys
+        """
+        found = set()
+        added = []
+        for repo_type in REPO_TYPES:
+            for repo_name in iter_repositories(repo_root_for(repo_type)):
+                key = repo_key(repo_type, repo_name)
+                found.add(key)
+                if key not in self.repos:
+                    added.append(key)
+                    created = (Path(repo_root_for(repo_type)) / repo_name).stat().st_ctime
+                    self.add(repo_type, repo_name, created=created)
+                else:
+                    self.add(repo_type, repo_name)
+
+        removed = [key for key in self.repos if key not in found]
+        for key in removed:
+            del self.repos[key]
+
+        self.data['roots'] = self.root_mtimes()
+        self.data['reconciled_at'] = time.time()
+        return added, removed
+
+    def find(self, repo_type=None, pattern=None):
+        """List catalog entries, optionally filtered
+
+        Args:
+            repo_type: Only include repositories of this type
+            pattern: Only include repositories whose name matches this glob pattern
+
+        Returns:
+            list: Catalog entries sorted by type and name
+        """
+        entries = []
+        for entry in self.repos.values():
+            if repo_type and entry['type'] != repo_type:
+                continue
+            if pattern and not fnmatch.fnmatch(entry['name'], pattern):
+                continue
+            entries.append(entry)
+        return sorted(entries, key=lambda entry: (entry['type'], entry['name']))
+
+
+def load_catalog(reconcile=False):
+    """Load the repository catalog, reconciling it when it is stale
+
+    Args:
+        reconcile: Force a reconcile pass even if the catalog looks current
+
+    Returns:
+        RepoCatalog: The loaded catalog
+    """
+    catalog = RepoCatalog()
+    if reconcile or catalog.is_stale():
+        with catalog.update():
+            catalog.reconcile()
+    return catalog
+
+
+def catalog_entry(repo_type, repo_name):
+    """Look up a single repository, adding it to the catalog if it exists on disk
+
+    Args:
+        repo_type: Repository type ('private' or 'public')
+        repo_name: Repository name including the .git suffix
+
+    Returns:
+        dict: The catalog entry, or None if the repository does not exist
+    """
+    catalog = RepoCatalog()
+    entry = catalog.get(repo_type, repo_name)
+    path = Path(repo_root_for(repo_type)) / repo_name
+    if entry and Path(entry['path']).exists():
+        return entry
+
+    with catalog.update():
+        if is_repository(path):
+            return catalog.add(repo_type, repo_name, created=path.stat().st_ctime)
+        catalog.remove(repo_type, repo_name)
+    return None
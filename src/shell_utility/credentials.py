@@ -0,0 +1,96 @@
+import hashlib
+import os
+import sqlite3
+from pathlib import Path
+
+from .constants import CREDENTIALS_DB, REALM
+
+
+def digest_hash(username, password, realm=REALM):
+    """Compute the htdigest HA1 hash, md5 of username:realm:password"""
+    return hashlib.md5(f"{username}:{realm}:{password}".encode()).hexdigest()
+
+
+class CredentialStore():
+    """Keyed store of the HTTP users, queried by lighttpd's mod_authn_dbi
+
+    Users live in an SQLite table keyed by (user, realm) so lighttpd does an indexed
+    lookup per request instead of scanning the htdigest file. Each change is a single
+    transaction.
+    """
+
+    def __init__(self, db_path=CREDENTIALS_DB, realm=REALM):
+        self.db_path = Path(db_path)
+        self.realm = realm
+        created = not self.db_path.exists()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.db_path), timeout=10)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "user TEXT NOT NULL, realm TEXT NOT NULL, passwd TEXT NOT NULL, "
+                "PRIMARY KEY (user, realm)) WITHOUT ROWID")
+        if created:
+            os.chmod(self.db_path, 0o640)
+            if os.geteuid() == 0:
+                parent_stat = self.db_path.parent.stat()
+                os.chown(self.db_path, parent_stat.st_uid, parent_stat.st_gid)
+
+    def close(self):
+        self.connection.close()
+
+    def set_password(self, username, password):
+        self.set_password_hash(username, digest_hash(username, password, self.realm))
+
+    def set_password_hash(self, username, password_hash):
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO users (user, realm, passwd) VALUES (?, ?, ?) "
+                "ON CONFLICT (user, realm) DO UPDATE SET passwd = excluded.passwd",
+                (username, self.realm, password_hash))
+
+    def get_password_hash(self, username):
+        row = self.connection.execute(
+            "SELECT passwd FROM users WHERE user = ? AND realm = ?", (username, self.realm)).fetchone()
+        return row[0] if row else None
+
+    def remove(self, username):
+        """
+        Remove a user
+
+        Returns:
+            bool: True if the user existed
+        """
+        with self.connection:
+            cursor = self.connection.execute("DELETE FROM users WHERE user = ? AND realm = ?", (username, self.realm))
+        return cursor.rowcount > 0
+
+    def list_users(self):
+        rows = self.connection.execute("SELECT user FROM users WHERE realm = ? ORDER BY user", (self.realm,))
+        return [row[0] for row in rows]
+
+    def import_htdigest(self, htdigest_file):
+        """
+        Import the users of an htdigest file and empty it, existing users are updated
+
+        The file is emptied rather than removed so it stays in place for BACKUP_PATHS,
+        users deleted later are not brought back by the next import.
+
+        Returns:
+            int: Number of users imported
+        """
+        htdigest_file = Path(htdigest_file)
+        if not htdigest_file.exists():
+            return 0
+        entries = []
+        for line in htdigest_file.read_text().splitlines():
+            parts = line.strip().split(':')
+            if len(parts) == 3 and parts[1] == self.realm:
+                entries.append((parts[0], self.realm, parts[2]))
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO users (user, realm, passwd) VALUES (?, ?, ?) "
+                "ON CONFLICT (user, realm) DO UPDATE SET passwd = excluded.passwd", entries)
+        with open(htdigest_file, 'r+') as f:
+            f.truncate(0)
+        return len(entries)
@@ -0,0 +1,167 @@
+import os
+import subprocess
+from pathlib import Path
+
+from .constants import PRIVATE_REPO_ROOT, PUBLIC_REPO_ROOT
+from .locks import RepoLock
+from .repository import iter_repositories
+from .util import atomic_write_text
+
+ALTERNATES_FILE = Path('objects') / 'info' / 'alternates'
+
+# Taken by GCMaintenance as well, a fork is never repacked twice at once
+FORK_LOCK_NAME = 'maintenance'
+
+# Set on parents while they have forks, a fork may still need an object its parent no longer references
+PARENT_CONFIG = {'gc.pruneExpire': 'never'}
+
+
+def _git(repo_path, *args, **kwargs):
+    return subprocess.run(['git', '-c', 'safe.directory=*', '-C', str(repo_path), *args],
+        capture_output=True, text=True, **kwargs)
+
+
+def read_alternates(repo_path):
+    """Read the object directories a repository borrows objects from
+
+    Args:
+        repo_path: Repository directory
+
+    Returns:
+        list: Absolute object directory paths, empty if the repository has no alternates
+    """
+    objects_dir = Path(repo_path) / 'objects'
+    try:
+        lines = (Path(repo_path) / ALTERNATES_FILE).read_text().splitlines()
+    except OSError:
+        return []
+    alternates = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            # Relative entries are relative to the objects directory
+            alternates.append(Path(os.path.normpath(objects_dir / line)))
+    return alternates
+
+
+def write_alternates(repo_path, object_dirs):
+    """Replace the alternates of a repository, an empty list removes the file"""
+    path = Path(repo_path) / ALTERNATES_FILE
+    if object_dirs:
+        atomic_write_text(path, ''.join(f"{object_dir}\n" for object_dir in object_dirs))
+    else:
+        path.unlink(missing_ok=True)
+
+
+def fork_parent(repo_path):
+    """Get the repository a fork borrows its objects from
+
+    Args:
+        repo_path: Repository directory
+
+    Returns:
+        Path: Parent repository directory, or None if the repository is not a fork
+    """
+    for object_dir in read_alternates(repo_path):
+        if object_dir.name == 'objects':
+            return object_dir.parent
+    return None
+
+
+def find_forks(repo_roots=(PRIVATE_REPO_ROOT, PUBLIC_REPO_ROOT)):
+    """Map every parent repository to its forks
+
+    Reads one alternates file per repository, no object is touched.
+
+    Args:
+        repo_roots: Repository roots to scan
+
+    Returns:
+        dict: Parent directory as a string to a list of fork directories
+    """
+    forks = {}
+    for repo_root in repo_roots:
+        for repo_name in iter_repositories(repo_root):
+            repo_path = Path(repo_root) / repo_name
+            parent = fork_parent(repo_path)
+            if parent is not None:
+                forks.setdefault(str(parent), []).append(repo_path)
+    return forks
+
+
+def repo_forks(repo_path):
+    """List the forks borrowing objects from a repository
+
+    Returns:
+        list: Fork directories, forks of forks are not included
+    """
+    return find_forks().get(str(Path(repo_path)), [])
+
+
+def update_parent_config(repo_path):
+    """Set PARENT_CONFIG on a repository with forks and unset it once the last fork is gone"""
+    has_forks = bool(repo_forks(repo_path))
+    for key, value in PARENT_CONFIG.items():
+        if has_forks:
+            _git(repo_path, 'config', key, value, check=True)
+        else:
+            _git(repo_path, 'config', '--unset', key)
+
+
+def create_fork(source, destination):
+    """Create a bare repository sharing the object store of source through git alternates
+
+    The fork gets the branches, tags and HEAD of its parent but no objects, pushes to
+    it only store the objects its parent does not have.
+
+    Args:
+        source: Parent repository directory
+        destination: Directory of the new repository
+
+    Raises:
+        subprocess.CalledProcessError: If git fails
+    """
+    source = Path(source)
+    destination = Path(destination)
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    _git(destination.parent, 'clone', '--quiet', '--bare', '--shared', str(source), destination.name, check=True)
+    # The alternates entry is absolute so renaming the fork keeps it working
+    write_alternates(destination, [source / 'objects'])
+    _git(destination, 'remote', 'remove', 'origin', check=True)
+    update_parent_config(source)
+
+
+def dissociate_fork(repo_path):
+    """Copy the borrowed objects into a fork and drop its alternates
+
+    Needed before the parent is removed, afterwards the fork is a standalone repository.
+
+    Args:
+        repo_path: Fork directory
+
+    Raises:
+        subprocess.CalledProcessError: If the repack fails, the fork is left unchanged
+    """
+    with RepoLock(repo_path, FORK_LOCK_NAME):
+        # Without -l the repack includes every reachable object of the alternates
+        _git(repo_path, 'repack', '-a', '-d', '-q', check=True)
+        write_alternates(repo_path, [])
+
+
+def relink_forks(old_path, new_path):
+    """Point the forks of a renamed or moved repository at its new location
+
+    Args:
+        old_path: Previous repository directory
+        new_path: Current repository directory
+
+    Returns:
+        list: The relinked fork directories
+    """
+    old_objects = Path(old_path) / 'objects'
+    forks = repo_forks(old_path)
+    for fork in forks:
+        write_alternates(fork, [Path(new_path) / 'objects' if object_dir == old_objects else object_dir
+            for object_dir in read_alternates(fork)])
+    return forks
+
@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+
+def run_repository_hook(name, args=(), stdin=None):
+    """Run the repository's own hook of the same name
+
+    core.hooksPath points every repository at the shared hooks, which replaces the
+    hooks/ directory of each repository. The shared hooks call this so hooks placed
+    in a repository keep running after the shared ones did their part.
+
+    Args:
+        name: Hook name, e.g. post-receive
+        args: Arguments git passed to the shared hook
+        stdin: Bytes git wrote to the shared hook's standard input
+
+    Returns:
+        int: Exit status of the repository hook, 0 if the repository has none
+    """
+    hook = Path(os.environ.get('GIT_DIR', '.')) / 'hooks' / name
+    if not os.access(hook, os.X_OK) or hook.is_dir():
+        return 0
+    # A hooks/ directory linked to the shared hooks would call itself
+    if hook.resolve() == Path(sys.argv[0]).resolve():
+        return 0
+    return subprocess.run([str(hook), *args], input=stdin).returncode
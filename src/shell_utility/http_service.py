@@ -0,0 +1,437 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from .constants import PRIVATE_REPO_ROOT, PUBLIC_REPO_ROOT, REPLICA_PRIMARY_URL
+from .pack_cache import MAX_CACHEABLE_REQUEST_SIZE, PackCache
+from .replication import (REPLICA_NOTIFY_PATH, REPLICA_STATUS_PATH, REPLICATION_PATH, forward_notification,
+    is_replica, redact_url, replica_status, replication_state)
+from .repository import is_repository, repo_fingerprint
+from .usage import OPERATION_HEADER, UploadPackScanner
+
+logger = logging.getLogger(__name__)
+
+SERVICES = ('git-upload-pack', 'git-receive-pack')
+READ_CHUNK_SIZE = 64 * 1024
+ADVERTISEMENT_CACHE_SIZE = 512
+
+STATUS_TEXT = {
+    200: 'OK', 202: 'Accepted', 400: 'Bad Request', 401: 'Unauthorized', 403: 'Forbidden', 404: 'Not Found',
+    405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable',
+}
+
+SMART_PATH = re.compile(r'^/(?P<type>private|public)/(?P<repo>.+?)/(?P<action>info/refs|git-upload-pack|git-receive-pack)$')
+
+
+def pkt_line(data):
+    """Encode data as a git pkt-line"""
+    if isinstance(data, str):
+        data = data.encode()
+    return f"{len(data) + 4:04x}".encode() + data
+
+
+class HttpRequest():
+    def __init__(self, method, target, version, headers, reader):
+        self.method = method
+        self.version = version
+        self.headers = headers
+        self.reader = reader
+        self.body_consumed = False
+        split = urlsplit(target)
+        self.path = unquote(split.path)
+        self.query = parse_qs(split.query)
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+    @property
+    def has_body(self):
+        return self.headers.get('transfer-encoding', '').lower() == 'chunked' or int(self.headers.get('content-length', '0') or 0) > 0
+
+    @property
+    def remote_user(self):
+        """User authenticated by lighttpd, passed in the Forwarded header"""
+        forwarded = self.headers.get('forwarded', '')
+        match = re.search(r'remote_user="?([^";,]+)"?', forwarded)
+        return unquote(match.group(1)) if match else None
+
+    async def iter_body(self):
+        """Yield the request body, de-chunked and gunzipped as needed"""
+        decompressor = None
+        if self.headers.get('content-encoding', '').lower() in ('gzip', 'x-gzip'):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        async for chunk in self._iter_raw_body():
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            if chunk:
+                yield chunk
+        if decompressor:
+            tail = decompressor.flush()
+            if tail:
+                yield tail
+
+    async def _iter_raw_body(self):
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size_line = await self.reader.readline()
+                size = int(size_line.split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    # Skip trailers up to the terminating empty line
+                    while (await self.reader.readline()).strip():
+                        pass
+                    self.body_consumed = True
+                    return
+                remaining = size
+                while remaining:
+                    chunk = await self.reader.read(min(remaining, READ_CHUNK_SIZE))
+                    if not chunk:
+                        raise ConnectionError("Connection closed inside a chunk")
+                    remaining -= len(chunk)
+                    yield chunk
+                await self.reader.readline()
+        else:
+            remaining = int(self.headers.get('content-length', '0') or 0)
+            while remaining:
+                chunk = await self.reader.read(min(remaining, READ_CHUNK_SIZE))
+                if not chunk:
+                    raise ConnectionError("Connection closed inside the request body")
+                remaining -= len(chunk)
+                yield chunk
+            self.body_consumed = True
+
+
+class HttpResponse():
+    """Streams a response, chunked for HTTP/1.1 clients and close-delimited otherwise
+
+    A response to a HEAD request only sends the headers, the body is dropped.
+    """
+
+    def __init__(self, request, writer):
+        self.request = request
+        self.writer = writer
+        self.chunked = request.version == 'HTTP/1.1'
+        self.headers_only = request.method == 'HEAD'
+        self.keep_alive = request.keep_alive and self.chunked
+
+    async def start(self, status, headers=None):
+        lines = [f"{self.request.version if self.chunked else 'HTTP/1.0'} {status} {STATUS_TEXT.get(status, '')}"]
+        headers = dict(headers or {})
+        headers.setdefault('Cache-Control', 'no-cache, max-age=0, must-revalidate')
+        if self.chunked:
+            headers['Transfer-Encoding'] = 'chunked'
+        headers['Connection'] = 'keep-alive' if self.keep_alive else 'close'
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+
+    async def write(self, data):
+        if not data or self.headers_only:
+            return
+        if self.chunked:
+            self.writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        else:
+            self.writer.write(data)
+        await self.writer.drain()
+
+    async def end(self):
+        if self.chunked and not self.headers_only:
+            self.writer.write(b"0\r\n\r\n")
+        await self.writer.drain()
+
+    async def send(self, status, body=b'', content_type='text/plain', headers=None):
+        headers = dict(headers or {})
+        headers['Content-Type'] = content_type
+        await self.start(status, headers)
+        await self.write(body.encode() if isinstance(body, str) else body)
+        await self.end()
+
+
+class GitHttpService():
+    """Long-lived git smart-HTTP service
+
+    lighttpd keeps authentication and proxies /public and /private to this service,
+    which replaces a git-http-backend CGI fork per request. Ref advertisements are
+    answered from an in-process cache keyed by the repository fingerprint, so polling
+    clients only start a git process when refs actually changed. upload-pack and
+    receive-pack responses are streamed without buffering the pack. upload-pack
+    responses of public repositories are also written to the pack cache, repeated
+    clones of the same tip are served from disk without running pack-objects.
+    """
+
+    def __init__(self, host, port, max_processes=64, pack_cache_dir=None, pack_cache_bytes=0):
+        self.host = host
+        self.port = port
+        self.roots = {'private': Path(PRIVATE_REPO_ROOT), 'public': Path(PUBLIC_REPO_ROOT)}
+        self.process_slots = asyncio.Semaphore(max_processes)
+        self.advertisements = OrderedDict()
+        self.pack_cache = PackCache(pack_cache_dir, pack_cache_bytes) if pack_cache_dir else None
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        logger.info(f"Git smart-HTTP service listening on {self.host}:{self.port}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                response = HttpResponse(request, writer)
+                await self.dispatch(request, response)
+                # An unread request body would be parsed as the next request
+                if not response.keep_alive or (request.has_body and not request.body_consumed):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.exception(f"Request handling failed: {e}")
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        method, target, version = request_line.decode('latin-1').split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1')
+            if line in ('\r\n', '\n', ''):
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return HttpRequest(method, target, version, headers, reader)
+
+    def resolve_repository(self, repo_type, repo_name):
+        """Map a URL path onto a repository, rejecting anything outside the roots"""
+        root = self.roots[repo_type]
+        # Hidden directories hold restores and other work in progress
+        if any(part.startswith('.') for part in Path(repo_name).parts):
+            return None
+        for candidate in (repo_name, f"{repo_name}.git"):
+            path = (root / candidate).resolve()
+            if root.resolve() in path.parents and is_repository(path):
+                return path
+        return None
+
+    async def dispatch(self, request, response):
+        if request.path == '/_gitcubby/health':
+            return await response.send(200, 'ok\n')
+        if request.path == '/_gitcubby/pack-cache':
+            report = self.pack_cache.report() if self.pack_cache else {'enabled': False}
+            return await response.send(200, json.dumps(report) + '\n', content_type='application/json')
+        if request.path.startswith('/_gitcubby/replica'):
+            return await self.dispatch_replication(request, response)
+
+        match = SMART_PATH.match(request.path)
+        if not match:
+            return await response.send(404, 'Not Found\n')
+
+        repo_type, action = match.group('type'), match.group('action')
+        service = request.query.get('service', [None])[0] if action == 'info/refs' else action
+        if service not in SERVICES:
+            # Only the smart protocol is served
+            return await response.send(403, 'Dumb HTTP protocol is not supported\n')
+
+        # lighttpd enforces these rules already, refuse anything that bypassed it
+        if (repo_type == 'private' or service == 'git-receive-pack') and not request.remote_user:
+            return await response.send(401, 'Authentication required\n', headers={'WWW-Authenticate': 'Basic realm="git"'})
+
+        repo_path = self.resolve_repository(repo_type, match.group('repo'))
+        if repo_path is None:
+            return await response.send(404, 'Repository not found\n')
+        if service == 'git-receive-pack' and is_replica():
+            return await response.send(403, f"This is a read-only replica, push to {redact_url(REPLICA_PRIMARY_URL)}\n")
+
+        if action == 'info/refs':
+            if request.method not in ('GET', 'HEAD'):
+                return await response.send(405, 'Method Not Allowed\n')
+            return await self.advertise_refs(request, response, repo_path, service)
+        if request.method != 'POST':
+            return await response.send(405, 'Method Not Allowed\n')
+        if repo_type == 'public' and service == 'git-upload-pack' and self.pack_cache and self.pack_cache.enabled:
+            return await self.run_cached_upload_pack(request, response, repo_path)
+        return await self.run_service(request, response, repo_path, service)
+
+    async def dispatch_replication(self, request, response):
+        if request.path == REPLICATION_PATH and not is_replica():
+            # Lists every repository, lighttpd only lets web users through
+            if not request.remote_user:
+                return await response.send(401, 'Authentication required\n', headers={'WWW-Authenticate': 'Basic realm="git"'})
+            state = await asyncio.to_thread(replication_state)
+            return await response.send(200, json.dumps(state) + '\n', content_type='application/json')
+        if request.path == REPLICA_STATUS_PATH and is_replica():
+            status = replica_status()
+            # Open to anyone, so without repository names
+            status['failing'] = len(status['failing'])
+            return await response.send(200, json.dumps(status) + '\n', content_type='application/json')
+        if request.path == REPLICA_NOTIFY_PATH and is_replica():
+            if request.method != 'POST':
+                return await response.send(405, 'Method Not Allowed\n')
+            body = b''
+            async for chunk in request.iter_body():
+                body += chunk
+                if len(body) > 4096:
+                    return await response.send(413, 'Payload Too Large\n')
+            try:
+                key = json.loads(body)['repo']
+            except (ValueError, KeyError, TypeError):
+                return await response.send(400, 'Bad Request\n')
+            # Only a hint, the replica fetches from its configured primary whoever sent it
+            if not isinstance(key, str) or not forward_notification(key):
+                return await response.send(503, 'Replica sync is not running\n')
+            return await response.send(202, 'queued\n')
+        return await response.send(404, 'Not Found\n')
+
+    def service_env(self, request):
+        env = dict(os.environ)
+        protocol = request.headers.get('git-protocol')
+        if protocol:
+            env['GIT_PROTOCOL'] = protocol
+        if request.remote_user:
+            env['REMOTE_USER'] = request.remote_user
+            env['GIT_USER'] = request.remote_user
+        return env
+
+    async def advertise_refs(self, request, response, repo_path, service):
+        protocol = request.headers.get('git-protocol', '')
+        key = (str(repo_path), service, protocol, repo_fingerprint(repo_path))
+        body = self.advertisements.get(key)
+        if body is None:
+            async with self.process_slots:
+                process = await asyncio.create_subprocess_exec(
+                    'git', service[len('git-'):], '--stateless-rpc', '--advertise-refs', str(repo_path),
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=self.service_env(request))
+                stdout, stderr = await process.communicate()
+            if process.returncode != 0:
+                logger.error(f"Ref advertisement for {repo_path} failed: {stderr.decode(errors='replace').strip()}")
+                return await response.send(500, 'Ref advertisement failed\n')
+            body = stdout
+            if 'version=2' not in protocol:
+                body = pkt_line(f"# service={service}\n") + b"0000" + body
+            self.advertisements[key] = body
+            while len(self.advertisements) > ADVERTISEMENT_CACHE_SIZE:
+                self.advertisements.popitem(last=False)
+        else:
+            self.advertisements.move_to_end(key)
+        await response.send(200, body, content_type=f"application/x-{service}-advertisement")
+
+    async def run_cached_upload_pack(self, request, response, repo_path):
+        """Answer a public upload-pack request from the pack cache, or run it and cache the response"""
+        body = bytearray()
+        body_iterator = request.iter_body()
+        async for chunk in body_iterator:
+            body.extend(chunk)
+            if len(body) > MAX_CACHEABLE_REQUEST_SIZE:
+                break
+        if len(body) > MAX_CACHEABLE_REQUEST_SIZE:
+            # Too large to key on, hand the buffered part and the rest of the body to git
+            self.pack_cache.stats['bypassed'] += 1
+
+            async def remaining_body():
+                yield bytes(body)
+                async for chunk in body_iterator:
+                    yield chunk
+            return await self.run_service(request, response, repo_path, 'git-upload-pack', body=remaining_body())
+
+        body = bytes(body)
+        name = self.pack_cache.key(repo_path, repo_fingerprint(repo_path), request.headers.get('git-protocol', ''), body)
+        if name is None:
+            self.pack_cache.stats['bypassed'] += 1
+            return await self.run_service(request, response, repo_path, 'git-upload-pack', body=self.iter_bytes(body))
+
+        cached = self.pack_cache.open(name)
+        if cached is None:
+            return await self.run_service(request, response, repo_path, 'git-upload-pack', body=self.iter_bytes(body),
+                cache_name=name)
+        scanner = UploadPackScanner()
+        scanner.feed(body)
+        with cached:
+            await response.start(200, {'Content-Type': 'application/x-git-upload-pack-result',
+                OPERATION_HEADER: scanner.operation})
+            while True:
+                chunk = cached.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await response.write(chunk)
+            await response.end()
+
+    @staticmethod
+    async def iter_bytes(data):
+        yield data
+
+    async def run_service(self, request, response, repo_path, service, body=None, cache_name=None):
+        """
+        Run upload-pack or receive-pack and stream its response
+
+        Args:
+            body: Optional async iterator replacing the request body, when it was already read
+            cache_name: Pack cache entry the response is stored as when git succeeds
+        """
+        body = body if body is not None else request.iter_body()
+        cache_writer = self.pack_cache.writer() if cache_name else None
+        scanner = UploadPackScanner() if service == 'git-upload-pack' else None
+        async with self.process_slots:
+            process = await asyncio.create_subprocess_exec(
+                'git', service[len('git-'):], '--stateless-rpc', str(repo_path),
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                env=self.service_env(request))
+
+            async def feed_stdin():
+                try:
+                    async for chunk in body:
+                        if scanner:
+                            scanner.feed(chunk)
+                        process.stdin.write(chunk)
+                        await process.stdin.drain()
+                except ConnectionError:
+                    pass
+                finally:
+                    process.stdin.close()
+
+            feeder = asyncio.ensure_future(feed_stdin())
+            stderr_task = asyncio.ensure_future(process.stderr.read())
+            completed = False
+            try:
+                # git answers once it read the request, the headers wait for its first output so
+                # the operation logged by lighttpd is known
+                chunk = await process.stdout.read(READ_CHUNK_SIZE)
+                await response.start(200, {'Content-Type': f"application/x-{service}-result",
+                    OPERATION_HEADER: scanner.operation if scanner else 'push'})
+                while chunk:
+                    if cache_writer:
+                        cache_writer.write(chunk)
+                    await response.write(chunk)
+                    chunk = await process.stdout.read(READ_CHUNK_SIZE)
+                await response.end()
+                completed = True
+            finally:
+                if not completed and process.returncode is None:
+                    try:
+                        process.kill()
+                    except ProcessLookupError:
+                        pass
+                await asyncio.gather(feeder, return_exceptions=True)
+                stderr = await stderr_task
+                await process.wait()
+                if cache_writer:
+                    # Only complete responses of a successful run are cached, and only if no
+                    # push changed the repository meanwhile
+                    if completed and process.returncode == 0 and self.pack_cache.is_current(cache_name, repo_fingerprint(repo_path)):
+                        self.pack_cache.store(cache_name, cache_writer)
+                    else:
+                        self.pack_cache.discard(cache_writer)
+            if process.returncode != 0:
+                logger.warning(f"{service} for {repo_path} exited with {process.returncode}: {stderr.decode(errors='replace').strip()}")
@@ -0,0 +1,237 @@
+import base64
+import hashlib
+import os
+import sqlite3
+from pathlib import Path
+
+from .constants import SSH_KEY_INDEX
+
+KEY_OPTIONS = 'no-port-forwarding,no-X11-forwarding,no-agent-forwarding'
+
+
+def key_fingerprint(key_blob):
+    """
+    SHA256 fingerprint of a public key, formatted like ssh-keygen -lf
+
+    Args:
+        key_blob: Base64 encoded key as found in a .pub file
+
+    Returns:
+        str: Fingerprint, e.g. SHA256:nThbg6kXUpJWGl7E1IGOCspRomTxdCARLviKw6E5SY8
+    """
+    digest = hashlib.sha256(base64.b64decode(key_blob)).digest()
+    return 'SHA256:' + base64.b64encode(digest).decode().rstrip('=')
+
+
+def parse_public_keys(text):
+    """
+    Parse the keys of a .pub file
+
+    Returns:
+        list: (key_type, key_blob) for every key line, comments and options are dropped
+    """
+    keys = []
+    for line in text.splitlines():
+        fields = line.strip().split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        # The key type is followed by the key, anything before it are options
+        for position, field in enumerate(fields[:-1]):
+            if field.startswith(('ssh-', 'ecdsa-', 'sk-')):
+                keys.append((field, fields[position + 1]))
+                break
+    return keys
+
+
+def key_file_signature(key_file):
+    """Cheap change marker of a .pub file, compared instead of reading the file"""
+    stat = os.stat(key_file)
+    return f"{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def scan_key_files(keys_dir):
+    """
+    Returns:
+        dict: .pub file name to its stat signature
+    """
+    signatures = {}
+    try:
+        entries = list(os.scandir(keys_dir))
+    except FileNotFoundError:
+        return signatures
+    for entry in entries:
+        if entry.name.endswith('.pub') and entry.is_file():
+            try:
+                signatures[entry.name] = key_file_signature(entry.path)
+            except FileNotFoundError:
+                pass
+    return signatures
+
+
+class SSHKeyIndex():
+    """Fingerprint index of the keys in KEYS_DIR_PATH, queried by sshd's AuthorizedKeysCommand
+
+    Each connection attempt does a primary key lookup instead of sshd parsing an
+    authorized_keys file with every key. The index is world readable, it only
+    holds public keys, so the helper can run as an unprivileged user.
+    """
+
+    def __init__(self, db_path=SSH_KEY_INDEX, read_only=False):
+        self.db_path = Path(db_path)
+        if read_only:
+            self.connection = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=10)
+            return
+        created = not self.db_path.exists()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.db_path), timeout=10)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS keys ("
+                "fingerprint TEXT PRIMARY KEY, user TEXT NOT NULL, options TEXT NOT NULL, "
+                "key_type TEXT NOT NULL, key TEXT NOT NULL, source TEXT NOT NULL) WITHOUT ROWID")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS keys_source ON keys (source)")
+            # Stat signature of every applied .pub file, so a watcher only re-reads changed files
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS key_files (source TEXT PRIMARY KEY, signature TEXT NOT NULL) WITHOUT ROWID")
+        if created:
+            os.chmod(self.db_path, 0o644)
+
+    def close(self):
+        self.connection.close()
+
+    def _insert_key_file(self, key_file):
+        """Insert the keys of a .pub file, the file name without .pub is the user"""
+        key_file = Path(key_file)
+        username = key_file.stem
+        options = f'environment="GIT_USER={username}",{KEY_OPTIONS}'
+        inserted = 0
+        for key_type, key_blob in parse_public_keys(key_file.read_text()):
+            try:
+                fingerprint = key_fingerprint(key_blob)
+            except ValueError:
+                raise ValueError(f"Invalid public key in {key_file}")
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO keys (fingerprint, user, options, key_type, key, source) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (fingerprint, username, options, key_type, key_blob, key_file.name))
+            if cursor.rowcount == 0:
+                owner = self.lookup(fingerprint)[0]
+                raise ValueError(f"Key {fingerprint} in {key_file} is already installed for user {owner}")
+            inserted += 1
+        return inserted
+
+    def _apply_key_file(self, key_file, failed):
+        """Replace the keys of one .pub file inside the current transaction"""
+        key_file = Path(key_file)
+        self.connection.execute("DELETE FROM keys WHERE source = ?", (key_file.name,))
+        self.connection.execute("SAVEPOINT key_file")
+        installed = 0
+        signature = ''
+        try:
+            signature = key_file_signature(key_file)
+            installed = self._insert_key_file(key_file)
+            self.connection.execute("RELEASE key_file")
+        except (OSError, ValueError) as e:
+            self.connection.execute("ROLLBACK TO key_file")
+            self.connection.execute("RELEASE key_file")
+            failed.append((key_file, e))
+        # Failed files are recorded too so they are retried only once they change again
+        self.connection.execute(
+            "INSERT INTO key_files (source, signature) VALUES (?, ?) "
+            "ON CONFLICT (source) DO UPDATE SET signature = excluded.signature", (key_file.name, signature))
+        return installed
+
+    def rebuild(self, key_files):
+        """
+        Replace the whole index with the keys of the given .pub files in one transaction
+
+        Files that fail to parse are skipped and returned so the caller can report them.
+
+        Returns:
+            tuple: (number of keys installed, list of (key_file, error))
+        """
+        installed = 0
+        failed = []
+        with self.connection:
+            self.connection.execute("DELETE FROM keys")
+            self.connection.execute("DELETE FROM key_files")
+            for key_file in sorted(key_files):
+                installed += self._apply_key_file(key_file, failed)
+        return installed, failed
+
+    def applied_signatures(self):
+        """
+        Returns:
+            dict: .pub file name to the stat signature it had when it was applied
+        """
+        return dict(self.connection.execute("SELECT source, signature FROM key_files"))
+
+    def apply_changes(self, changed_files, removed_names):
+        """
+        Apply changed and removed .pub files in one transaction
+
+        Readers see either the previous or the new set of keys, never a partial update.
+
+        Args:
+            changed_files: Paths of added or modified .pub files
+            removed_names: File names of deleted .pub files
+
+        Returns:
+            tuple: (number of keys installed, list of (key_file, error))
+        """
+        installed = 0
+        failed = []
+        with self.connection:
+            for name in removed_names:
+                self.connection.execute("DELETE FROM keys WHERE source = ?", (name,))
+                self.connection.execute("DELETE FROM key_files WHERE source = ?", (name,))
+            for key_file in sorted(changed_files):
+                installed += self._apply_key_file(key_file, failed)
+        return installed, failed
+
+    def lookup(self, fingerprint):
+        """
+        Returns:
+            tuple: (user, options, key_type, key) or None if the key is unknown
+        """
+        return self.connection.execute(
+            "SELECT user, options, key_type, key FROM keys WHERE fingerprint = ?", (fingerprint,)).fetchone()
+
+    def authorized_keys_line(self, key_type, key_blob):
+        """
+        Build the authorized_keys line sshd expects from AuthorizedKeysCommand
+
+        Returns:
+            str: Line with the user's options, or None if the key is unknown
+        """
+        try:
+            entry = self.lookup(key_fingerprint(key_blob))
+        except ValueError:
+            return None
+        if entry is None or entry[2] != key_type or entry[3] != key_blob:
+            return None
+        return f"{entry[1]} {entry[2]} {entry[3]}"
+
+    def user_for_auth_info(self, auth_info_path):
+        """
+        Map the key of the current session to its user
+
+        Args:
+            auth_info_path: File named by SSH_USER_AUTH, written by sshd with ExposeAuthInfo
+
+        Returns:
+            str: User the key belongs to, or None
+        """
+        try:
+            lines = Path(auth_info_path).read_text().splitlines()
+        except OSError:
+            return None
+        for line in lines:
+            fields = line.split()
+            if len(fields) >= 3 and fields[0] == 'publickey':
+                try:
+                    entry = self.lookup(key_fingerprint(fields[2]))
+                except ValueError:
+                    continue
+                if entry:
+                    return entry[0]
+        return None
@@ -0,0 +1,81 @@
+import fcntl
+import hashlib
+import os
+from pathlib import Path
+
+from .constants import LOCK_PATH
+
+
+def create_lock_dir():
+    """Create the lock directory, sticky and world writable so the git user and root share it"""
+    lock_dir = Path(LOCK_PATH)
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    os.chmod(lock_dir, 0o1777)
+
+
+class RepoLock():
+    """Advisory per-repository lock shared by the git user and root jobs
+
+    Lock files live outside the repositories so they never end up in a backup.
+    Each lock has a name so independent concerns, e.g. maintenance and snapshots,
+    do not block each other.
+
+    Usage:
+        with RepoLock('/private/project.git', 'maintenance'):
+            ...
+    """
+
+    def __init__(self, repo_path, name, shared=False, blocking=True):
+        self.repo_path = str(Path(repo_path))
+        self.name = name
+        self.shared = shared
+        self.blocking = blocking
+        self.fd = None
+
+    @property
+    def path(self):
+        repo_hash = hashlib.sha1(self.repo_path.encode()).hexdigest()
+        return Path(LOCK_PATH) / f"{repo_hash}.{self.name}.lock"
+
+    def acquire(self):
+        """
+        Acquire the lock
+
+        Returns:
+            bool: True if acquired, False if non-blocking and already held
+        """
+        if not Path(LOCK_PATH).exists():
+            create_lock_dir()
+
+        created = not self.path.exists()
+        self.fd = os.open(self.path, os.O_RDONLY | os.O_CREAT, 0o666)
+        if created:
+            try:
+                os.chmod(self.path, 0o666)
+            except OSError:
+                pass
+
+        flags = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        if not self.blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.fd, flags)
+            return True
+        except BlockingIOError:
+            os.close(self.fd)
+            self.fd = None
+            return False
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        if not self.acquire():
+            raise BlockingIOError(f"Lock {self.name} of {self.repo_path} is held")
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,108 @@
+import os
+
+
+class LogTailer():
+    """Incremental reader of an append-only log file
+
+    Each call returns the complete lines appended since the previous call, a partial
+    last line is kept until its newline arrives. Rotation is detected by a changed
+    inode and truncation by the file shrinking below the read offset. After a
+    rotation the rest of the previous file is read from its rotated name first,
+    when it is still there, over as many calls as it takes, then the new file
+    from the start.
+
+    The position can be persisted and passed back in, so a restarted reader carries
+    on where the previous one stopped.
+
+    Usage:
+        tailer = LogTailer('/var/log/git/access.log')
+        for line in tailer.read_lines():
+            ...
+    """
+
+    # Bounds the work of a single call, the rest is read by the next one
+    MAX_READ_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, path, inode=None, offset=0):
+        """
+        Args:
+            path: Log file to read
+            inode: Inode of the file at a persisted position
+            offset: Byte offset of a persisted position
+        """
+        self.path = str(path)
+        self.inode = inode
+        self.offset = offset
+        self.partial = b''
+
+    @property
+    def position(self):
+        """
+        Returns:
+            tuple: (inode, offset) of the first byte not returned as a complete line
+        """
+        return self.inode, self.offset - len(self.partial)
+
+    def rotated_path(self):
+        return f"{self.path}.1"
+
+    def read_range(self, path, offset, size):
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                return f.read(size)
+        except OSError:
+            return b''
+
+    def split_lines(self, data):
+        if not data:
+            return []
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        return [line.decode('utf-8', errors='replace') for line in lines]
+
+    def read_lines(self):
+        """
+        Returns:
+            list: Lines appended since the last call, without line endings
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return []
+
+        data = b''
+        if stat.st_ino != self.inode:
+            drained = False
+            if self.inode is not None:
+                try:
+                    rotated = os.stat(self.rotated_path())
+                except OSError:
+                    rotated = None
+                if rotated is not None and rotated.st_ino == self.inode:
+                    if rotated.st_size > self.offset:
+                        # The position stays in the previous file until all of it is read
+                        chunk = self.read_range(self.rotated_path(), self.offset,
+                            min(rotated.st_size - self.offset, self.MAX_READ_BYTES))
+                        if chunk:
+                            self.offset += len(chunk)
+                            return self.split_lines(chunk)
+                    else:
+                        drained = True
+            if drained and self.partial:
+                # The previous file ended without a newline
+                data = b'\n'
+            else:
+                # The rest of a partial line of a file that is gone is unknown
+                self.partial = b''
+            self.inode = stat.st_ino
+            self.offset = 0
+        elif stat.st_size < self.offset:
+            self.offset = 0
+            self.partial = b''
+
+        if stat.st_size > self.offset:
+            chunk = self.read_range(self.path, self.offset, min(stat.st_size - self.offset, self.MAX_READ_BYTES))
+            self.offset += len(chunk)
+            data += chunk
+        return self.split_lines(data)
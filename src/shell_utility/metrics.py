@@ -0,0 +1,221 @@
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from .backup_stats import BACKUP_OPERATIONS, read_backup_stats
+from .constants import (ACCESS_LOG_PATH, BACKUP_STATS_FILE, PRIVATE_REPO_ROOT, PUBLIC_REPO_ROOT, REPO_STATS_FILE,
+    SSH_AUTH_LOG_PATH)
+from .logtail import LogTailer
+from .replication import is_replica, replica_status
+from .repository import iter_repositories
+from .stats import RepoStatsCache
+
+# Git transfers range from a ref advertisement to a clone of a large repository
+HTTP_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# lighttpd accesslog.format ending in the request time in microseconds (%D)
+ACCESS_LOG_PATTERN = re.compile(r'"(?P<method>[A-Z]+) (?P<target>\S+)[^"]*" (?P<status>\d{3}) (?P<bytes>\d+|-) .* (?P<usec>\d+)$')
+
+SSH_LOG_EVENTS = [
+    (re.compile(r'\bAccepted \S+ for '), 'accepted'),
+    (re.compile(r'\b(Failed \S+ for|Invalid user|Connection closed by authenticating user)\b'), 'failed'),
+    (re.compile(r'\bDisconnected from user '), 'closed'),
+]
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels) + '}'
+
+
+def git_service(target):
+    """Name the git endpoint of a request path, keeps the label set small"""
+    path = target.split('?', 1)[0]
+    for service in ('git-upload-pack', 'git-receive-pack'):
+        if path.endswith(f'/{service}'):
+            return service
+    if path.endswith('/info/refs'):
+        return 'info-refs'
+    return 'other'
+
+
+class Histogram():
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MetricsCollector():
+    """Collects the GitCubby metrics in the Prometheus text format
+
+    Every scrape only reads what changed since the previous one: the access and
+    auth logs are tailed from the last offset, the repository statistics come from
+    the RepoStatsCache shared with listrepos and the backup stats are a small JSON
+    file written by the backup runs.
+    """
+
+    def __init__(self, access_log=ACCESS_LOG_PATH, auth_log=SSH_AUTH_LOG_PATH, stats_file=BACKUP_STATS_FILE,
+                 repo_roots=None, repo_stats_file=REPO_STATS_FILE):
+        self.stats_file = stats_file
+        self.repo_stats = RepoStatsCache(repo_stats_file)
+        self.repo_roots = repo_roots or {'private': PRIVATE_REPO_ROOT, 'public': PUBLIC_REPO_ROOT}
+        self.access_log = LogTailer(access_log)
+        self.auth_log = LogTailer(auth_log)
+        self.lock = threading.Lock()
+        self.http_requests = {}
+        self.http_bytes = {}
+        self.http_latency = {}
+        self.ssh_events = {event: 0 for _, event in SSH_LOG_EVENTS}
+        self.repositories = {}
+        self.scrape_duration = 0.0
+
+    def collect_http(self):
+        for line in self.access_log.read_lines():
+            match = ACCESS_LOG_PATTERN.search(line)
+            if not match:
+                continue
+            target = match.group('target')
+            visibility = target.lstrip('/').split('/', 1)[0]
+            if visibility not in self.repo_roots:
+                continue
+            key = (visibility, git_service(target))
+            status_key = key + (match.group('status'),)
+            self.http_requests[status_key] = self.http_requests.get(status_key, 0) + 1
+            if match.group('bytes') != '-':
+                self.http_bytes[key] = self.http_bytes.get(key, 0) + int(match.group('bytes'))
+            if key not in self.http_latency:
+                self.http_latency[key] = Histogram(HTTP_LATENCY_BUCKETS)
+            self.http_latency[key].observe(int(match.group('usec')) / 1e6)
+
+    def collect_ssh(self):
+        for line in self.auth_log.read_lines():
+            for pattern, event in SSH_LOG_EVENTS:
+                if pattern.search(line):
+                    self.ssh_events[event] += 1
+                    break
+
+    def collect_repositories(self):
+        repositories = {}
+        for visibility, root in self.repo_roots.items():
+            for repo_name in iter_repositories(root):
+                repositories[f"{visibility}/{repo_name}"] = Path(root) / repo_name
+        stats = self.repo_stats.refresh(repositories, prune=True)
+        self.repositories = {tuple(key.split('/', 1)): repo for key, repo in stats.items()}
+
+    def collect(self):
+        """
+        Returns:
+            str: Metrics in the Prometheus text exposition format
+        """
+        with self.lock:
+            start = time.monotonic()
+            self.collect_http()
+            self.collect_ssh()
+            self.collect_repositories()
+            self.scrape_duration = time.monotonic() - start
+            return self.render()
+
+    def render(self):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+
+        stats = read_backup_stats(self.stats_file)
+        runs = [(operation, stats[operation]) for operation in BACKUP_OPERATIONS if operation in stats]
+        metric('gitcubby_backup_duration_seconds', 'gauge', 'Duration of the last backup operation',
+            [((('operation', op),), run['duration']) for op, run in runs])
+        metric('gitcubby_backup_bytes', 'gauge', 'Bytes written to the backup target by the last backup operation',
+            [((('operation', op),), run['bytes']) for op, run in runs])
+        metric('gitcubby_backup_exit_status', 'gauge', 'Exit status of the last backup operation, 0 on success',
+            [((('operation', op),), run['exit_status']) for op, run in runs])
+        metric('gitcubby_backup_last_run_timestamp_seconds', 'gauge', 'Time the last backup operation finished',
+            [((('operation', op),), run['finished']) for op, run in runs])
+        metric('gitcubby_backup_last_success_timestamp_seconds', 'gauge', 'Time the last successful backup operation finished',
+            [((('operation', op),), run['last_success']) for op, run in runs if run.get('last_success')])
+        metric('gitcubby_backup_runs_total', 'counter', 'Backup operations run',
+            [((('operation', op),), run.get('runs', 0)) for op, run in runs])
+        metric('gitcubby_backup_failures_total', 'counter', 'Backup operations failed',
+            [((('operation', op),), run.get('failures', 0)) for op, run in runs])
+
+        repositories = sorted(self.repositories.items())
+        metric('gitcubby_repository_size_bytes', 'gauge', 'Disk usage of a repository',
+            [((('visibility', vis), ('repo', name)), repo['size']) for (vis, name), repo in repositories])
+        metric('gitcubby_repository_refs', 'gauge', 'Number of refs of a repository',
+            [((('visibility', vis), ('repo', name)), repo['refs']) for (vis, name), repo in repositories])
+        metric('gitcubby_repository_packs', 'gauge', 'Number of packfiles of a repository',
+            [((('visibility', vis), ('repo', name)), repo['packs']) for (vis, name), repo in repositories])
+        metric('gitcubby_repository_loose_objects', 'gauge', 'Number of loose objects of a repository',
+            [((('visibility', vis), ('repo', name)), repo['loose_objects']) for (vis, name), repo in repositories])
+
+        if is_replica():
+            replica = replica_status()
+            metric('gitcubby_replica_lag_seconds', 'gauge', 'Seconds since the replica last matched its primary',
+                [((), replica['lag_seconds'])] if replica['lag_seconds'] is not None else [])
+            metric('gitcubby_replica_failing_repositories', 'gauge', 'Repositories the replica failed to fetch',
+                [((), len(replica['failing']))])
+
+        metric('gitcubby_http_requests_total', 'counter', 'Git HTTP requests handled by lighttpd',
+            [((('visibility', vis), ('service', service), ('status', status)), count)
+             for (vis, service, status), count in sorted(self.http_requests.items())])
+        metric('gitcubby_http_response_bytes_total', 'counter', 'Bytes sent in Git HTTP responses',
+            [((('visibility', vis), ('service', service)), count) for (vis, service), count in sorted(self.http_bytes.items())])
+        lines.append("# HELP gitcubby_http_request_duration_seconds Time lighttpd spent on Git HTTP requests")
+        lines.append("# TYPE gitcubby_http_request_duration_seconds histogram")
+        for (vis, service), histogram in sorted(self.http_latency.items()):
+            labels = (('visibility', vis), ('service', service))
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f"gitcubby_http_request_duration_seconds_bucket{format_labels(labels + (('le', bound),))} {count}")
+            lines.append(f"gitcubby_http_request_duration_seconds_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"gitcubby_http_request_duration_seconds_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(f"gitcubby_http_request_duration_seconds_count{format_labels(labels)} {histogram.count}")
+
+        metric('gitcubby_ssh_sessions_total', 'counter', 'SSH authentication results and closed sessions from the sshd log',
+            [((('event', event),), count) for event, count in self.ssh_events.items()])
+        metric('gitcubby_metrics_scrape_duration_seconds', 'gauge', 'Time spent collecting the metrics of the previous scrape',
+            [((), round(self.scrape_duration, 6))])
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    collector = None
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.collector.collect().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(host, port, collector=None):
+    """Serve /metrics until the process is stopped"""
+    handler = type('Handler', (MetricsHandler,), {'collector': collector or MetricsCollector()})
+    with ThreadingHTTPServer((host, port), handler) as server:
+        server.serve_forever()
@@ -0,0 +1,195 @@
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+
+# Requests carrying more haves than this are negotiations, not clones worth caching
+MAX_CACHEABLE_REQUEST_SIZE = 256 * 1024
+
+# Client specific capabilities that do not change the response
+IGNORED_CAPABILITIES = (b'agent=', b'session-id=')
+
+
+def iter_pkt_lines(data):
+    """
+    Split a pkt-line stream
+
+    Yields:
+        bytes: Payload of each line, None for flush, delim and response-end packets
+
+    Raises:
+        ValueError: If the data is not a valid pkt-line stream
+    """
+    position = 0
+    while position < len(data):
+        length = int(data[position:position + 4], 16)
+        if length < 4:
+            yield None
+            position += 4
+            continue
+        if position + length > len(data):
+            raise ValueError("Truncated pkt-line")
+        yield data[position + 4:position + length]
+        position += length
+
+
+def normalize_upload_pack_request(body):
+    """
+    Remove client specific capabilities from an upload-pack request
+
+    Protocol v2 sends agent and session-id as separate capability lines, v0 appends
+    them to the first want line.
+
+    Returns:
+        bytes: Request without agent and session-id, or None if it can't be parsed
+    """
+    normalized = []
+    try:
+        for payload in iter_pkt_lines(body):
+            if payload is None:
+                normalized.append(b'<special>')
+                continue
+            if payload.startswith(IGNORED_CAPABILITIES):
+                continue
+            if payload.startswith(b'want '):
+                fields = payload.rstrip(b'\n').split(b' ')
+                payload = b' '.join(field for field in fields if not field.startswith(IGNORED_CAPABILITIES))
+            normalized.append(payload.rstrip(b'\n'))
+    except ValueError:
+        return None
+    return b'\n'.join(normalized)
+
+
+def repo_prefix(repo_path):
+    return hashlib.sha1(str(repo_path).encode()).hexdigest()[:16]
+
+
+class PackCache():
+    """On disk cache of upload-pack responses for public repositories
+
+    Entries are keyed by the repository, its fingerprint (ref tips and packs), the
+    protocol and the normalized request, i.e. wants, haves and capabilities. File
+    names start with the repository and fingerprint so entries of a repository are
+    dropped as soon as its fingerprint changes. The total size is bounded with
+    least recently used eviction.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'bypassed': 0, 'stored': 0, 'evicted': 0, 'invalidated': 0,
+            'bytes_served': 0}
+        if self.enabled:
+            self.load()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def load(self):
+        """Index the entries left by a previous run, oldest access first"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith('.'):
+                # Partial response of an interrupted request
+                os.unlink(entry.path)
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self.entries[name] = size
+            self.size += size
+        self.evict()
+
+    def key(self, repo_path, fingerprint, protocol, body):
+        """
+        Returns:
+            str: Cache entry name, or None if the request is not cacheable
+        """
+        if len(body) > MAX_CACHEABLE_REQUEST_SIZE:
+            return None
+        normalized = normalize_upload_pack_request(body)
+        if normalized is None:
+            return None
+        request_hash = hashlib.sha256(protocol.encode() + b'\n' + normalized).hexdigest()
+        return f"{repo_prefix(repo_path)}-{fingerprint[:16]}-{request_hash}"
+
+    def open(self, name):
+        """
+        Returns:
+            file: Cached response opened for reading, or None on a miss
+        """
+        if name not in self.entries:
+            self.stats['misses'] += 1
+            return None
+        try:
+            cached = open(self.cache_dir / name, 'rb')
+        except FileNotFoundError:
+            self.size -= self.entries.pop(name)
+            self.stats['misses'] += 1
+            return None
+        self.entries.move_to_end(name)
+        # The modification time keeps the access order across restarts
+        os.utime(cached.fileno())
+        self.stats['hits'] += 1
+        self.stats['bytes_served'] += self.entries[name]
+        return cached
+
+    def writer(self):
+        """
+        Returns:
+            file: Temporary file a response is written to before store() moves it in place
+        """
+        return tempfile.NamedTemporaryFile(dir=self.cache_dir, prefix='.', delete=False)
+
+    def discard(self, writer):
+        writer.close()
+        try:
+            os.unlink(writer.name)
+        except FileNotFoundError:
+            pass
+
+    def is_current(self, name, fingerprint):
+        """Check an entry name was keyed with the given repository fingerprint"""
+        return name.split('-')[1] == fingerprint[:16]
+
+    def store(self, name, writer):
+        """Move a complete response in place and drop outdated entries of the repository"""
+        writer.close()
+        size = os.path.getsize(writer.name)
+        if size > self.max_bytes:
+            os.unlink(writer.name)
+            return
+        os.replace(writer.name, self.cache_dir / name)
+        if name in self.entries:
+            self.size -= self.entries.pop(name)
+        self.entries[name] = size
+        self.size += size
+        self.stats['stored'] += 1
+
+        # Refs or packs of the repository changed, older entries can never be hit again
+        repo, fingerprint = name.split('-')[:2]
+        outdated = [entry for entry in self.entries if entry.startswith(f"{repo}-") and not entry.startswith(f"{repo}-{fingerprint}-")]
+        for entry in outdated:
+            self.remove(entry)
+            self.stats['invalidated'] += 1
+        self.evict()
+
+    def remove(self, name):
+        self.size -= self.entries.pop(name)
+        try:
+            os.unlink(self.cache_dir / name)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            self.remove(next(iter(self.entries)))
+            self.stats['evicted'] += 1
+
+    def report(self):
+        return dict(self.stats, entries=len(self.entries), size_bytes=self.size, max_bytes=self.max_bytes)
@@ -0,0 +1,32 @@
+import json
+import os
+import socket
+
+from .constants import BACKUP_SCHEDULER_SOCKET
+
+# Keeps an event within a single datagram, the scheduler only needs the repository
+MAX_EVENT_REFS = 100
+
+
+def notify_push(repo_path, refs=(), socket_path=BACKUP_SCHEDULER_SOCKET):
+    """
+    Tell the backup scheduler a repository received a push
+
+    The event is a single datagram, a push never waits for the scheduler and
+    succeeds when the scheduler is not running.
+
+    Args:
+        repo_path: Path of the pushed repository
+        refs: Names of the updated refs
+
+    Returns:
+        bool: True if the event was delivered
+    """
+    event = json.dumps({'repo': os.path.abspath(repo_path), 'refs': list(refs)[:MAX_EVENT_REFS]}).encode()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(event, socket_path)
+        return True
+    except OSError:
+        return False
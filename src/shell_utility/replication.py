@@ -0,0 +1,372 @@
+import base64
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit
+
+from .catalog import REPO_TYPES, RepoCatalog, repo_key, repo_key_for_path, repo_root_for
+from .constants import (GITCUBBY_MODE, REPLICA_NOTIFY_URLS, REPLICA_PRIMARY_URL, REPLICA_SOCKET, REPLICA_STATE_FILE,
+    REPLICA_SYNC_INTERVAL)
+from .repository import is_repository, iter_repositories, repo_fingerprint
+from .restore_status import restore_in_progress
+from .user_interface import UserInterface
+from .util import atomic_write_text
+
+logger = logging.getLogger(__name__)
+
+# Served by the primary to its replicas, behind lighttpd authentication
+REPLICATION_PATH = '/_gitcubby/replication'
+# Served by a replica, the primary posts pushed repositories here
+REPLICA_NOTIFY_PATH = '/_gitcubby/replica/notify'
+# Served by a replica, replication lag and failing repositories
+REPLICA_STATUS_PATH = '/_gitcubby/replica'
+
+HTTP_TIMEOUT = 10
+NOTIFY_TIMEOUT = 2
+# Seconds a notified repository waits for further pushes before it is fetched
+NOTIFY_DEBOUNCE = 1
+SYNC_WORKERS = 4
+# Hidden, so neither iter_repositories nor the HTTP service see a repository before its first fetch completed
+STAGING_DIR = '.replica'
+
+
+def is_replica():
+    return GITCUBBY_MODE == 'replica'
+
+
+def require_primary():
+    """Exit with an error on a replica, its repositories only change by following the primary"""
+    if is_replica():
+        UserInterface().print_error_and_exit(f"This is a read-only replica, run this on {redact_url(REPLICA_PRIMARY_URL)}")
+
+
+def redact_url(url):
+    """Strip the credentials from a URL so it can be shown and logged"""
+    parts = urlsplit(url)
+    if not parts.username and not parts.password:
+        return url
+    host = parts.hostname + (f":{parts.port}" if parts.port else '')
+    return urlunsplit((parts.scheme, host, parts.path, parts.query, parts.fragment))
+
+
+def basic_auth_header(url):
+    """
+    Returns:
+        str: Authorization header value for the credentials of a URL, None if it has none
+    """
+    parts = urlsplit(url)
+    if not parts.username:
+        return None
+    credentials = f"{parts.username}:{parts.password or ''}".encode()
+    return f"Basic {base64.b64encode(credentials).decode()}"
+
+
+def read_head(repo_path):
+    """
+    Returns:
+        str: Ref HEAD points to, e.g. refs/heads/main, None for a detached HEAD
+    """
+    try:
+        head = (Path(repo_path) / 'HEAD').read_text().strip()
+    except OSError:
+        return None
+    return head[len('ref: '):] if head.startswith('ref: ') else None
+
+
+def replication_state():
+    """Describe the repositories of a primary for its replicas
+
+    Only stats and small files are read, replicas poll this every few seconds.
+
+    Returns:
+        dict: Time, restore flag and catalog key to fingerprint and HEAD of every repository
+    """
+    repos = {}
+    for repo_type in REPO_TYPES:
+        root = repo_root_for(repo_type)
+        for repo_name in iter_repositories(root):
+            path = Path(root) / repo_name
+            repos[repo_key(repo_type, repo_name)] = {'fingerprint': repo_fingerprint(path), 'head': read_head(path)}
+    # A replica must not remove the repositories a running restore did not bring back yet
+    return {'time': time.time(), 'restoring': restore_in_progress(), 'repos': repos}
+
+
+def notify_replicas(repo_path, urls=REPLICA_NOTIFY_URLS):
+    """Tell the replicas a repository received a push
+
+    The notifications are sent by a detached child process, the push never waits
+    for a replica. Replicas that miss a notification catch up on their next poll.
+
+    Args:
+        repo_path: Repository directory
+        urls: Comma separated replica URLs
+
+    Returns:
+        bool: True if notifications are being sent
+    """
+    urls = [url.strip().rstrip('/') for url in urls.split(',') if url.strip()]
+    key = repo_key_for_path(os.path.abspath(repo_path))
+    if not urls or key is None:
+        return False
+    if os.fork() != 0:
+        return True
+    # The child must not hold the hook's output open, git waits for it to close
+    try:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        body = json.dumps({'repo': key}).encode()
+        for url in urls:
+            request = urllib.request.Request(url + REPLICA_NOTIFY_PATH, data=body, method='POST',
+                headers={'Content-Type': 'application/json'})
+            try:
+                urllib.request.urlopen(request, timeout=NOTIFY_TIMEOUT).close()
+            except OSError:
+                pass
+    finally:
+        os._exit(0)
+
+
+def forward_notification(key, socket_path=REPLICA_SOCKET):
+    """Hand a repository notified by the primary to the replica sync process"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(json.dumps({'repo': key}).encode(), str(socket_path))
+        return True
+    except OSError:
+        return False
+
+
+def read_replica_state(state_file=REPLICA_STATE_FILE):
+    try:
+        return json.loads(Path(state_file).read_text())
+    except (OSError, ValueError):
+        return {'repos': {}}
+
+
+def replica_status(state_file=REPLICA_STATE_FILE):
+    """Summarize the replication state for the status endpoint and the metrics
+
+    Returns:
+        dict: Primary, lag in seconds since the replica last matched the primary (None
+            before the first complete sync), time of the last complete sync, last error
+            and the number of repositories and failing repositories
+    """
+    state = read_replica_state(state_file)
+    last_sync = state.get('last_sync')
+    repos = state.get('repos', {})
+    return {
+        'primary': state.get('primary'),
+        'lag_seconds': round(time.time() - last_sync, 3) if last_sync else None,
+        'last_sync': last_sync,
+        'last_attempt': state.get('last_attempt'),
+        'error': state.get('error'),
+        'repositories': len(repos),
+        'failing': sorted(key for key, repo in repos.items() if repo.get('error')),
+    }
+
+
+def _git(repo_path, *args, env=None):
+    return subprocess.run(['git', '-c', 'safe.directory=*', '-C', str(repo_path), *args],
+        capture_output=True, text=True, env=env)
+
+
+class ReplicaSync():
+    """Keeps the repositories of a replica in line with its primary
+
+    The primary's replication state lists every repository with its fingerprint.
+    It is polled every REPLICA_SYNC_INTERVAL seconds, and right away for the
+    repositories the primary notifies through the replica's HTTP service. Only
+    repositories whose fingerprint differs from the last fetched one are fetched,
+    every ref is mirrored and refs gone from the primary are pruned. Repositories
+    removed from the primary are removed here as well.
+
+    The lag is the age of the last poll after which every repository matched the
+    primary, it is kept in REPLICA_STATE_FILE for the status endpoint and metrics.
+
+    Usage:
+        ReplicaSync().run()
+    """
+
+    def __init__(self, primary_url=REPLICA_PRIMARY_URL, interval=REPLICA_SYNC_INTERVAL,
+                 state_file=REPLICA_STATE_FILE, socket_path=REPLICA_SOCKET):
+        self.primary_url = primary_url.rstrip('/')
+        self.interval = interval
+        self.state_file = Path(state_file)
+        self.socket_path = Path(socket_path)
+        self.state = read_replica_state(state_file)
+        self.state['primary'] = redact_url(self.primary_url)
+
+    def save_state(self):
+        atomic_write_text(self.state_file, json.dumps(self.state, indent=2, sort_keys=True))
+
+    def plain_url(self, path=''):
+        return redact_url(self.primary_url) + path
+
+    def git_env(self):
+        """Pass the credentials as a header in the environment, never on the command line or in a config file"""
+        env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+        header = basic_auth_header(self.primary_url)
+        if header:
+            env.update(GIT_CONFIG_COUNT='1', GIT_CONFIG_KEY_0='http.extraHeader',
+                GIT_CONFIG_VALUE_0=f"Authorization: {header}")
+        return env
+
+    def fetch_primary_state(self):
+        request = urllib.request.Request(self.plain_url(REPLICATION_PATH))
+        header = basic_auth_header(self.primary_url)
+        if header:
+            request.add_header('Authorization', header)
+        with urllib.request.urlopen(request, timeout=HTTP_TIMEOUT) as response:
+            return json.loads(response.read())
+
+    def repo_path(self, key):
+        repo_type, repo_name = key.split('/', 1)
+        return Path(repo_root_for(repo_type)) / repo_name
+
+    def fetch_repository(self, key, head):
+        """
+        Mirror every ref of a repository from the primary, cloning it on first sight
+
+        Raises:
+            RuntimeError: If git fails
+        """
+        path = self.repo_path(key)
+        target = path
+        if not is_repository(path):
+            # Built hidden and moved into place once complete
+            repo_type, repo_name = key.split('/', 1)
+            target = Path(repo_root_for(repo_type)) / STAGING_DIR / repo_name
+            shutil.rmtree(target, ignore_errors=True)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            result = _git(target.parent, 'init', '--quiet', '--bare', target.name)
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.strip())
+        result = _git(target, 'fetch', '--quiet', '--prune', '--no-write-fetch-head', self.plain_url(f"/{key}"),
+            '+refs/*:refs/*', env=self.git_env())
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip() or f"git fetch exited with {result.returncode}")
+        if head:
+            _git(target, 'symbolic-ref', 'HEAD', head)
+        if target != path:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.rename(target, path)
+
+    def sync_repository(self, key, primary):
+        """
+        Returns:
+            dict: Replication state of the repository
+        """
+        previous = self.state['repos'].get(key, {})
+        try:
+            self.fetch_repository(key, primary['head'])
+            logger.info(f"Fetched {key} from {self.plain_url()}")
+            return {'fingerprint': primary['fingerprint'], 'synced': time.time(), 'error': None}
+        except Exception as e:
+            logger.error(f"Fetch of {key} from {self.plain_url()} failed: {e}")
+            return dict(previous, error=str(e))
+
+    def remove_repository(self, key):
+        path = self.repo_path(key)
+        logger.info(f"Removing {key}, it is gone from the primary")
+        shutil.rmtree(path, ignore_errors=True)
+
+    def sync(self, keys=None):
+        """
+        Bring the replica in line with the primary
+
+        Args:
+            keys: Notified repositories fetched even if their fingerprint looks current,
+                all changed repositories are fetched if not given
+
+        Returns:
+            bool: True if every repository matches the primary
+        """
+        started = time.time()
+        self.state['last_attempt'] = started
+        try:
+            primary = self.fetch_primary_state()
+        except Exception as e:
+            logger.error(f"Reading the replication state of {self.plain_url()} failed: {e}")
+            self.state['error'] = str(e)
+            self.save_state()
+            return False
+
+        repos = self.state['repos']
+        if keys is None:
+            pending = [key for key, repo in primary['repos'].items()
+                if repos.get(key, {}).get('fingerprint') != repo['fingerprint'] or repos.get(key, {}).get('error')
+                or not is_repository(self.repo_path(key))]
+        else:
+            pending = [key for key in keys if key in primary['repos']]
+        with ThreadPoolExecutor(max_workers=SYNC_WORKERS) as executor:
+            results = dict(zip(pending, executor.map(lambda key: self.sync_repository(key, primary['repos'][key]),
+                pending)))
+        repos.update(results)
+
+        removed = []
+        if keys is None and not primary.get('restoring'):
+            for repo_type in REPO_TYPES:
+                for repo_name in iter_repositories(repo_root_for(repo_type)):
+                    key = repo_key(repo_type, repo_name)
+                    if key not in primary['repos']:
+                        self.remove_repository(key)
+                        removed.append(key)
+            for key in set(repos) - set(primary['repos']):
+                del repos[key]
+
+        if results or removed:
+            with RepoCatalog().update() as catalog:
+                catalog.reconcile()
+
+        in_sync = all(not repo.get('error') for repo in results.values())
+        if keys is None and in_sync:
+            self.state['last_sync'] = started
+        self.state['error'] = None if in_sync else f"{sum(bool(repo.get('error')) for repo in results.values())} repository(s) failed"
+        self.save_state()
+        return in_sync
+
+    def bind(self):
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(str(self.socket_path))
+        sock.settimeout(NOTIFY_DEBOUNCE)
+        return sock
+
+    def run(self):
+        if not self.primary_url:
+            logger.error("REPLICA_PRIMARY_URL is not set, replica sync not started")
+            return False
+        sock = self.bind()
+        logger.info(f"Replicating {self.plain_url()} every {self.interval}s and on push notifications")
+        notified = set()
+        next_sync = time.monotonic()
+        while True:
+            quiet = False
+            try:
+                notified.add(json.loads(sock.recv(4096))['repo'])
+            except socket.timeout:
+                quiet = True
+            except (ValueError, KeyError, TypeError):
+                logger.warning("Ignoring malformed replica notification")
+            # Checked after every notification, a steady stream of pushes must not hold off the full sync
+            if time.monotonic() >= next_sync:
+                next_sync = time.monotonic() + self.interval
+                notified.clear()
+                self.sync()
+            # Pushes come in bursts, wait for a quiet moment
+            elif quiet and notified:
+                keys = sorted(notified)
+                notified.clear()
+                self.sync(keys)
@@ -0,0 +1,141 @@
+import hashlib
+import os
+from pathlib import Path
+
+# Paths whose modification time changes when a ref is created, updated or deleted
+REF_MTIME_PATHS = ['HEAD', 'packed-refs', 'refs/heads', 'refs/tags']
+
+
+def is_repository(path):
+    """Check if a directory is a bare git repository
+
+    Args:
+        path: Directory to check
+
+    Returns:
+        bool: True if the directory holds a config file and an objects directory
+    """
+    path = Path(path)
+    return (path / 'config').is_file() and (path / 'objects').is_dir()
+
+
+def iter_repositories(repo_root):
+    """Find bare repositories below a repository root
+
+    Only the directories leading to a repository are visited, the walk never descends
+    into a repository itself so the cost is proportional to the number of repositories
+    rather than the number of files they hold.
+
+    Args:
+        repo_root: Root directory such as PRIVATE_REPO_ROOT
+
+    Yields:
+        str: Repository name relative to the root, including the .git suffix
+    """
+    repo_root = Path(repo_root)
+    if not repo_root.is_dir():
+        return
+
+    pending = [repo_root]
+    while pending:
+        directory = pending.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+
+        names = {entry.name for entry in entries}
+        if directory != repo_root and 'config' in names and 'objects' in names:
+            yield str(Path(directory).relative_to(repo_root))
+            continue
+
+        for entry in entries:
+            # Skip hidden directories used for staging and bookkeeping
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(Path(entry.path))
+
+
+def repo_updated_time(path):
+    """Get the time a repository's refs were last changed
+
+    Args:
+        path: Repository directory
+
+    Returns:
+        float: Latest modification time of HEAD, packed-refs and the ref directories
+    """
+    latest = 0.0
+    for name in REF_MTIME_PATHS:
+        try:
+            latest = max(latest, (Path(path) / name).stat().st_mtime)
+        except OSError:
+            continue
+    return latest
+
+
+def repo_size(path):
+    """Get the disk usage of a repository in bytes
+
+    Args:
+        path: Repository directory
+
+    Returns:
+        int: Total size of the files below the repository
+    """
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(directory, name)).st_size
+            except OSError:
+                continue
+    return total
+
+
+def _hash_file(digest, path, label):
+    try:
+        digest.update(f"{label}\0".encode())
+        digest.update(Path(path).read_bytes())
+        digest.update(b"\0")
+    except OSError:
+        pass
+
+
+def repo_fingerprint(path):
+    """Fingerprint the refs and packs of a repository
+
+    The fingerprint covers HEAD, packed-refs, every loose ref and the names and sizes
+    of the files in objects/pack. Pack names embed the pack checksum so a push, ref
+    update or repack changes the fingerprint while an idle repository keeps it.
+
+    Args:
+        path: Repository directory
+
+    Returns:
+        str: Hex digest identifying the current repository state
+    """
+    path = Path(path)
+    digest = hashlib.sha256()
+    _hash_file(digest, path / 'HEAD', 'HEAD')
+    _hash_file(digest, path / 'packed-refs', 'packed-refs')
+    _hash_file(digest, path / 'objects' / 'info' / 'alternates', 'alternates')
+
+    refs_root = path / 'refs'
+    for directory, _, files in sorted(os.walk(refs_root)):
+        for name in sorted(files):
+            ref_path = Path(directory) / name
+            _hash_file(digest, ref_path, str(ref_path.relative_to(path)))
+
+    try:
+        packs = sorted(os.scandir(path / 'objects' / 'pack'), key=lambda entry: entry.name)
+    except OSError:
+        packs = []
+    for entry in packs:
+        try:
+            digest.update(f"{entry.name}\0{entry.stat().st_size}\0".encode())
+        except OSError:
+            continue
+
+    return digest.hexdigest()
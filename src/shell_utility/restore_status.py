@@ -0,0 +1,79 @@
+import json
+import time
+from pathlib import Path
+
+from .constants import RESTORE_STATUS_FILE
+from .locks import RepoLock
+
+RESTORE_LOCK_NAME = 'restore'
+
+
+def restore_lock(shared=False, blocking=True):
+    """Lock held exclusively by a running progressive restore"""
+    return RepoLock(RESTORE_STATUS_FILE, RESTORE_LOCK_NAME, shared=shared, blocking=blocking)
+
+
+def read_restore_status(status_file=RESTORE_STATUS_FILE):
+    """
+    Returns:
+        dict: Status of the last progressive restore, or None if there never was one
+    """
+    try:
+        return json.loads(Path(status_file).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def restore_in_progress():
+    """
+    Check if a progressive restore is running
+
+    Returns:
+        bool: True if the restore lock is held
+    """
+    lock = restore_lock(shared=True, blocking=False)
+    if lock.acquire():
+        lock.release()
+        return False
+    return True
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60}s"
+    return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+
+
+def describe_restore_status(status):
+    """
+    Summarize a restore status for display
+
+    Returns:
+        list: Lines describing the progress, ETA and failed repositories
+    """
+    shards = status.get('shards', {})
+    total = len(shards)
+    restored = [name for name, shard in shards.items() if shard['state'] == 'restored']
+    failed = [name for name, shard in shards.items() if shard['state'] == 'failed']
+    total_bytes = sum(shard.get('size', 0) for shard in shards.values()) or 1
+    restored_bytes = sum(shard.get('size', 0) for name, shard in shards.items() if name in restored)
+
+    state = status['state']
+    if state == 'running' and not restore_in_progress():
+        state = 'interrupted'
+    lines = [
+        f"State:      {state}",
+        f"Progress:   {len(restored)}/{total} repositories, {restored_bytes * 100 // total_bytes}% of the data",
+    ]
+    if state == 'running':
+        lines.append(f"Running:    {format_duration(time.time() - status['started'])}")
+        if status.get('eta'):
+            lines.append(f"ETA:        {format_duration(max(0, status['eta'] - time.time()))}")
+    elif status.get('finished'):
+        lines.append(f"Took:       {format_duration(status['finished'] - status['started'])}")
+    if failed:
+        lines.append(f"Failed:     {', '.join(sorted(failed))}")
+    return lines
@@ -0,0 +1,25 @@
+import os
+
+from .constants import LOCK_PATH
+from .locks import RepoLock
+
+# Taken exclusively while a backup stages a repository, pushes wait for it in the pre-receive hook
+SNAPSHOT_LOCK_NAME = 'snapshot'
+
+# Hidden directory below each backup path holding the staged repositories, iter_repositories skips it
+SNAPSHOT_DIR = '.snapshot'
+
+
+def wait_for_snapshot(repo_path):
+    """Hold a push back while a backup stages the repository
+
+    Staging copies the refs and links the packs, a push waits milliseconds at most.
+
+    Args:
+        repo_path: Repository directory, GIT_DIR of the hook
+    """
+    # Created at startup, without it no backup has taken a lock and none is staging
+    if not os.path.isdir(LOCK_PATH):
+        return
+    with RepoLock(os.path.abspath(repo_path), SNAPSHOT_LOCK_NAME, shared=True):
+        pass
@@ -0,0 +1,221 @@
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from .catalog import repo_key
+from .constants import REPO_STATS_FILE
+from .repository import repo_fingerprint, repo_size, repo_updated_time
+from .util import atomic_write_text
+
+STATS_VERSION = 1
+
+# Fields listrepos --stats sorts by, largest or most recent first
+STATS_SORT_FIELDS = ('size', 'packs', 'loose_objects', 'refs', 'last_push')
+
+LOOSE_OBJECT_DIR_LENGTH = 2
+
+
+def _git(repo_path, *args):
+    return subprocess.run(['git', '-c', 'safe.directory=*', '-C', str(repo_path), *args],
+        capture_output=True, text=True)
+
+
+def count_loose_objects(repo_path):
+    """
+    Returns:
+        tuple: Number and total size of the loose objects of a repository
+    """
+    count = 0
+    size = 0
+    objects_dir = Path(repo_path) / 'objects'
+    try:
+        fanout = [entry for entry in os.scandir(objects_dir)
+            if len(entry.name) == LOOSE_OBJECT_DIR_LENGTH and entry.is_dir(follow_symlinks=False)]
+    except OSError:
+        return 0, 0
+    for directory in fanout:
+        try:
+            for entry in os.scandir(directory.path):
+                count += 1
+                size += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+    return count, size
+
+
+def count_packs(repo_path):
+    """
+    Returns:
+        tuple: Number of packfiles and total size of objects/pack, indexes and bitmaps included
+    """
+    count = 0
+    size = 0
+    try:
+        entries = list(os.scandir(Path(repo_path) / 'objects' / 'pack'))
+    except OSError:
+        return 0, 0
+    for entry in entries:
+        try:
+            size += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+        if entry.name.endswith('.pack'):
+            count += 1
+    return count, size
+
+
+def stats_fingerprint(repo_path):
+    """Fingerprint of a repository covering its loose objects as well
+
+    The repository fingerprint ignores loose objects, a prune or gc only removes them.
+    Adding or removing a loose object changes the modification time of its fanout
+    directory, removing the last one of a directory the time of objects/.
+
+    Returns:
+        str: Hex digest identifying the refs, packs and loose objects of a repository
+    """
+    digest = hashlib.sha256(repo_fingerprint(repo_path).encode())
+    objects_dir = Path(repo_path) / 'objects'
+    try:
+        digest.update(f"objects\0{objects_dir.stat().st_mtime_ns}\0".encode())
+        fanout = sorted((entry for entry in os.scandir(objects_dir)
+            if len(entry.name) == LOOSE_OBJECT_DIR_LENGTH and entry.is_dir(follow_symlinks=False)),
+            key=lambda entry: entry.name)
+    except OSError:
+        fanout = []
+    for directory in fanout:
+        try:
+            digest.update(f"{directory.name}\0{directory.stat(follow_symlinks=False).st_mtime_ns}\0".encode())
+        except OSError:
+            continue
+    return digest.hexdigest()
+
+
+def compute_repo_stats(repo_path):
+    """Collect the statistics of a repository
+
+    Args:
+        repo_path: Repository directory
+
+    Returns:
+        dict: Size, pack and loose object counts, ref count, default branch tip and last push time
+    """
+    packs, pack_bytes = count_packs(repo_path)
+    loose_objects, loose_bytes = count_loose_objects(repo_path)
+    refs = _git(repo_path, 'for-each-ref', '--format=%(refname)')
+    head = _git(repo_path, 'symbolic-ref', '-q', 'HEAD')
+    # Empty for a repository without commits
+    tip = _git(repo_path, 'log', '-1', '--format=%H%x00%ct%x00%s', 'HEAD')
+    tip_fields = tip.stdout.strip().split('\0', 2) if tip.returncode == 0 and tip.stdout.strip() else None
+    return {
+        'size': repo_size(repo_path),
+        'packs': packs,
+        'pack_bytes': pack_bytes,
+        'loose_objects': loose_objects,
+        'loose_bytes': loose_bytes,
+        'refs': refs.stdout.count('\n') if refs.returncode == 0 else 0,
+        'head': head.stdout.strip() or None,
+        'head_commit': tip_fields[0] if tip_fields else None,
+        'head_time': int(tip_fields[1]) if tip_fields else None,
+        'head_subject': tip_fields[2] if tip_fields else None,
+        'last_push': repo_updated_time(repo_path) or None,
+    }
+
+
+class RepoStatsCache():
+    """Statistics of every repository, recomputed only when a repository changed
+
+    The cache is a JSON file keyed like the catalog, "<type>/<name>.git". Each entry
+    holds the stats fingerprint it was computed for, a repository whose refs, packs
+    and loose objects did not change since is answered from the cache without
+    recomputing them.
+    The git user's commands and the metrics exporter share the file.
+    """
+
+    def __init__(self, stats_file=REPO_STATS_FILE):
+        self.stats_file = Path(stats_file)
+        self.lock_file = self.stats_file.with_name(self.stats_file.name + '.lock')
+        self.data = self.load()
+
+    def load(self):
+        try:
+            data = json.loads(self.stats_file.read_text())
+            if data.get('version') == STATS_VERSION:
+                return data
+        except (OSError, ValueError):
+            pass
+        return {'version': STATS_VERSION, 'repos': {}}
+
+    def save(self):
+        atomic_write_text(self.stats_file, json.dumps(self.data, indent=2, sort_keys=True))
+
+    @contextmanager
+    def update(self):
+        """Lock the cache, reload it and save it when the block completes
+
+        Yields:
+            RepoStatsCache: This cache, holding the latest data
+        """
+        self.lock_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.data = self.load()
+                yield self
+                self.save()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @property
+    def repos(self):
+        return self.data['repos']
+
+    def refresh(self, repositories, prune=False):
+        """Bring the statistics of some repositories up to date
+
+        The statistics are computed without holding the lock, a repository pushed to
+        meanwhile keeps its old fingerprint and is recomputed on the next refresh.
+
+        Args:
+            repositories: Dict of catalog key to repository directory
+            prune: Forget every repository not in repositories
+
+        Returns:
+            dict: Catalog key to statistics, for the repositories that exist
+        """
+        # Other processes may have refreshed repositories since this cache was loaded
+        self.data = self.load()
+        fresh = {}
+        existing = [key for key, path in repositories.items() if Path(path).is_dir()]
+        for key in existing:
+            path = repositories[key]
+            fingerprint = stats_fingerprint(path)
+            cached = self.repos.get(key)
+            if cached is None or cached.get('fingerprint') != fingerprint:
+                fresh[key] = dict(compute_repo_stats(path), fingerprint=fingerprint, computed=time.time())
+
+        if fresh or (prune and set(self.repos) - set(repositories)):
+            with self.update():
+                self.repos.update(fresh)
+                if prune:
+                    for key in set(self.repos) - set(repositories):
+                        del self.repos[key]
+        return {key: self.repos[key] for key in existing if key in self.repos}
+
+
+def repo_stats(entries):
+    """Statistics of catalog entries, recomputed where the repository changed
+
+    Args:
+        entries: Catalog entries, e.g. from RepoCatalog.find()
+
+    Returns:
+        dict: Catalog key to statistics
+    """
+    repositories = {repo_key(entry['type'], f"{entry['name']}.git"): entry['path'] for entry in entries}
+    return RepoStatsCache().refresh(repositories)
@@ -0,0 +1,296 @@
+import calendar
+import os
+import re
+import sqlite3
+import time
+from pathlib import Path
+
+from .constants import ACCESS_LOG_PATH, SSH_AUTH_LOG_PATH, USAGE_DB
+from .logtail import LogTailer
+
+USAGE_OPERATIONS = ('clone', 'fetch', 'push')
+# Marker of the git-shell request lines gitcubby-shell appends to the sshd log
+SHELL_LOG_TAG = 'gitcubby-shell'
+# Response header naming the operation of a git request, logged by lighttpd
+OPERATION_HEADER = 'X-GitCubby-Operation'
+
+# lighttpd accesslog.format, see lighttpd.conf
+ACCESS_LOG_PATTERN = re.compile(
+    r'^\S+ \S+ (?P<user>\S+) \[(?P<hour>[^:]+:\d\d):\d\d:\d\d (?P<zone>[+-]\d{4})\] '
+    r'"POST /(?P<visibility>private|public)/(?P<repo>\S+?)/(?P<service>git-upload-pack|git-receive-pack)[ ?][^"]*" '
+    r'(?P<status>\d{3}) (?P<bytes>\d+|-) .*"(?P<operation>[a-z-]*)" \d+$')
+SHELL_LOG_PATTERN = re.compile(
+    SHELL_LOG_TAG + r'\[\d+\]: time=(?P<time>\d+) user=(?P<user>\S+) operation=(?P<operation>\S+) '
+    r'repo=(?P<visibility>private|public)/(?P<repo>\S+) bytes=(?P<bytes>\d+) status=(?P<status>\d+)')
+SHELL_COMMAND_PATTERN = re.compile(r"^(?P<service>git-upload-pack|git-receive-pack) '?/?(?P<path>[^']+?)/?'?$")
+
+_hour_cache = {}
+
+
+def normalize_repo_name(name):
+    return name if name.endswith('.git') else f"{name}.git"
+
+
+def access_log_hour(hour, zone):
+    """Start of the hour of an access log time such as 18/Oct/2026:10, cached as logs hold runs of the same hour"""
+    key = (hour, zone)
+    if key not in _hour_cache:
+        local = calendar.timegm(time.strptime(hour, '%d/%b/%Y:%H'))
+        offset = (int(zone[1:3]) * 3600 + int(zone[3:5]) * 60) * (1 if zone[0] == '+' else -1)
+        if len(_hour_cache) > 1024:
+            _hour_cache.clear()
+        _hour_cache[key] = local - offset
+    return _hour_cache[key]
+
+
+def parse_access_line(line):
+    """
+    Parse a git request of the lighttpd access log
+
+    Returns:
+        tuple: (hour, visibility, repo, user, operation, bytes), or None if the line is no clone, fetch or push
+    """
+    match = ACCESS_LOG_PATTERN.match(line)
+    if not match or match.group('status') != '200':
+        return None
+    operation = match.group('operation')
+    if operation not in USAGE_OPERATIONS:
+        if operation not in ('', '-'):
+            # Ref listings and negotiation rounds
+            return None
+        operation = 'push' if match.group('service') == 'git-receive-pack' else 'fetch'
+    size = match.group('bytes')
+    return (access_log_hour(match.group('hour'), match.group('zone')), match.group('visibility'),
+        normalize_repo_name(match.group('repo')), match.group('user'), operation, 0 if size == '-' else int(size))
+
+
+def parse_shell_line(line):
+    """
+    Parse a git-shell request line of the sshd log
+
+    Returns:
+        tuple: (hour, visibility, repo, user, operation, bytes), or None for other lines
+    """
+    if SHELL_LOG_TAG not in line:
+        return None
+    match = SHELL_LOG_PATTERN.search(line)
+    if not match or match.group('status') != '0' or match.group('operation') not in USAGE_OPERATIONS:
+        return None
+    return (int(match.group('time')) // 3600 * 3600, match.group('visibility'), normalize_repo_name(match.group('repo')),
+        match.group('user'), match.group('operation'), int(match.group('bytes')))
+
+
+def parse_shell_command(command):
+    """
+    Split a git command run through SSH
+
+    Returns:
+        tuple: (service, visibility, repo) or None if it is no upload-pack or receive-pack of a repository
+    """
+    match = SHELL_COMMAND_PATTERN.match(command or '')
+    if not match:
+        return None
+    visibility, _, repo = match.group('path').partition('/')
+    if visibility not in ('private', 'public') or not repo:
+        return None
+    return match.group('service'), visibility, normalize_repo_name(repo)
+
+
+def format_shell_line(user, operation, visibility, repo, size, status):
+    return (f"{SHELL_LOG_TAG}[{os.getpid()}]: time={int(time.time())} user={user or '-'} operation={operation} "
+            f"repo={visibility}/{repo} bytes={size} status={status}\n")
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def describe_usage(usage):
+    return (f"{usage['clones']} clones, {usage['fetches']} fetches, {usage['pushes']} pushes, "
+            f"{format_bytes(usage['bytes'])} served")
+
+
+def open_usage_store():
+    """
+    Returns:
+        UsageStore: Read-only store, or None if no usage was ingested yet
+    """
+    if not Path(USAGE_DB).exists():
+        return None
+    return UsageStore(read_only=True)
+
+
+class UploadPackScanner():
+    """Classifies an upload-pack request from its pkt-lines while it streams past
+
+    A request carrying "done" ends the negotiation and is answered with a pack, it
+    is a clone when the client announced no objects it has and a fetch otherwise.
+    Other requests are protocol v2 ref listings or negotiation rounds.
+    """
+
+    HAVE = b'0032have '
+    DONE = b'0009done\n'
+    # Longest marker minus one, kept across chunk boundaries
+    CARRY = 8
+
+    def __init__(self):
+        self.tail = b''
+        self.has_have = False
+        self.has_done = False
+
+    def feed(self, chunk):
+        data = self.tail + chunk
+        self.has_have = self.has_have or self.HAVE in data
+        self.has_done = self.has_done or self.DONE in data
+        self.tail = data[-self.CARRY:]
+
+    @property
+    def operation(self):
+        if not self.has_done:
+            return 'negotiate'
+        return 'fetch' if self.has_have else 'clone'
+
+
+class UsageStore():
+    """Hourly clone, fetch and push counts and served bytes per repository and user
+
+    The rollups are kept in SQLite, readable by the git user, together with the log
+    positions they cover. Both are updated in one transaction, a crashed ingester
+    neither loses nor double counts requests.
+    """
+
+    def __init__(self, db_path=USAGE_DB, read_only=False):
+        self.db_path = Path(db_path)
+        if read_only:
+            self.connection = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=10)
+            return
+        created = not self.db_path.exists()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.db_path), timeout=10)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "hour INTEGER NOT NULL, visibility TEXT NOT NULL, repo TEXT NOT NULL, user TEXT NOT NULL, "
+                "clones INTEGER NOT NULL DEFAULT 0, fetches INTEGER NOT NULL DEFAULT 0, "
+                "pushes INTEGER NOT NULL DEFAULT 0, bytes INTEGER NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (visibility, repo, hour, user)) WITHOUT ROWID")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS usage_hour ON usage (hour)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS log_positions (path TEXT PRIMARY KEY, inode INTEGER, "
+                "offset INTEGER NOT NULL) WITHOUT ROWID")
+        if created:
+            os.chmod(self.db_path, 0o644)
+
+    def close(self):
+        self.connection.close()
+
+    def position(self, path):
+        """
+        Returns:
+            tuple: (inode, offset) the log was ingested up to, (None, 0) for a new log
+        """
+        row = self.connection.execute("SELECT inode, offset FROM log_positions WHERE path = ?", (str(path),)).fetchone()
+        return tuple(row) if row else (None, 0)
+
+    def record(self, rollups, positions):
+        """
+        Add rollups and advance the log positions in one transaction
+
+        Args:
+            rollups: (hour, visibility, repo, user) to [clones, fetches, pushes, bytes]
+            positions: Log path to (inode, offset)
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO usage (hour, visibility, repo, user, clones, fetches, pushes, bytes) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (visibility, repo, hour, user) DO UPDATE SET "
+                "clones = clones + excluded.clones, fetches = fetches + excluded.fetches, "
+                "pushes = pushes + excluded.pushes, bytes = bytes + excluded.bytes",
+                [key + tuple(counts) for key, counts in rollups.items()])
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO log_positions (path, inode, offset) VALUES (?, ?, ?)",
+                [(str(path), inode, offset) for path, (inode, offset) in positions.items()])
+
+    def prune(self, before):
+        """Drop rollups of hours before a timestamp"""
+        with self.connection:
+            return self.connection.execute("DELETE FROM usage WHERE hour < ?", (before,)).rowcount
+
+    def repo_usage(self, visibility, repo, since):
+        """
+        Returns:
+            dict: clones, fetches, pushes, bytes and users, the latter ordered by activity
+        """
+        rows = self.connection.execute(
+            "SELECT user, SUM(clones), SUM(fetches), SUM(pushes), SUM(bytes) FROM usage "
+            "WHERE visibility = ? AND repo = ? AND hour >= ? GROUP BY user",
+            (visibility, normalize_repo_name(repo), since)).fetchall()
+        usage = {'clones': 0, 'fetches': 0, 'pushes': 0, 'bytes': 0, 'users': []}
+        for user, clones, fetches, pushes, size in sorted(rows, key=lambda row: -(row[1] + row[2] + row[3])):
+            usage['clones'] += clones
+            usage['fetches'] += fetches
+            usage['pushes'] += pushes
+            usage['bytes'] += size
+            usage['users'].append(user)
+        return usage
+
+    def usage_by_repo(self, since):
+        """
+        Returns:
+            dict: (visibility, repo) to dict of clones, fetches, pushes and bytes
+        """
+        rows = self.connection.execute(
+            "SELECT visibility, repo, SUM(clones), SUM(fetches), SUM(pushes), SUM(bytes) FROM usage "
+            "WHERE hour >= ? GROUP BY visibility, repo", (since,))
+        return {
+            (visibility, repo): {'clones': clones, 'fetches': fetches, 'pushes': pushes, 'bytes': size}
+            for visibility, repo, clones, fetches, pushes, size in rows
+        }
+
+
+class UsageIngester():
+    """Tails the access log and the sshd log into the usage rollups
+
+    Usage:
+        ingester = UsageIngester(UsageStore())
+        ingester.ingest()
+    """
+
+    def __init__(self, store, logs=None):
+        """
+        Args:
+            store: UsageStore the rollups are added to
+            logs: Log path to line parser, defaults to the access log and the sshd log
+        """
+        self.store = store
+        logs = logs or {ACCESS_LOG_PATH: parse_access_line, SSH_AUTH_LOG_PATH: parse_shell_line}
+        self.tailers = [(LogTailer(path, *store.position(path)), parser) for path, parser in logs.items()]
+
+    def ingest(self):
+        """
+        Read the lines appended since the last call
+
+        Returns:
+            int: Number of requests added to the rollups
+        """
+        rollups = {}
+        requests = 0
+        for tailer, parser in self.tailers:
+            while True:
+                lines = tailer.read_lines()
+                if not lines:
+                    break
+                for line in lines:
+                    entry = parser(line)
+                    if entry is None:
+                        continue
+                    hour, visibility, repo, user, operation, size = entry
+                    counts = rollups.setdefault((hour, visibility, repo, user), [0, 0, 0, 0])
+                    counts[USAGE_OPERATIONS.index(operation)] += 1
+                    counts[3] += size
+                    requests += 1
+        self.store.record(rollups, {tailer.path: tailer.position for tailer, _ in self.tailers})
+        return requests
@@ -1,5 +1,40 @@
+import os
+import tempfile
+from pathlib import Path
+
+
 def clean_repo_name(repo_name):
     if repo_name.endswith('.git'):
         return repo_name[:-4]
     else:
-        return repo_name
\ No newline at end of file
+        return repo_name
+
+
+def atomic_write_text(path, content, mode=0o644):
+    """Write a file atomically by writing a temporary file and renaming it into place
+
+    When running as root the new file is given the owner of its parent directory so
+    files shared with the git user stay writable by it.
+
+    Args:
+        path: Destination file path
+        content: Text content to write
+        mode: File permissions of the written file
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        if os.geteuid() == 0:
+            parent_stat = path.parent.stat()
+            os.chown(tmp_path, parent_stat.st_uid, parent_stat.st_gid)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
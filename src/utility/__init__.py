@@ -2,6 +2,12 @@ from .logger import GCLogger
 from .state_manager import GCStateManager
 from .gpg import GCGpg
 from .ssh import GCSsh
+from .manifest import GCBackupManifest
 from .backup import GCBackup
+from .maintenance import GCMaintenance
+from .integrity import GCIntegrityCheck
+from .startup import GCStartup
+from .scheduler import GCBackupScheduler
+from .provisioning import GCProvisioning
 from .common import *
 from .constants import *
@@ -1,40 +1,76 @@
-import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from pathlib import Path
-from . import GCGpg, GCLogger, GCStateManager
+
+from shell_utility.backup_stats import record_backup_run
+from shell_utility.locks import RepoLock
+from shell_utility.repository import is_repository
+from shell_utility.restore_status import restore_in_progress
+from . import GCBackupManifest, GCGpg, GCLogger, GCStateManager
 from .constants import (BACKUP_PATHS, BACKUP_COMPONENT_NAME, GPG_COMPONENT_NAME, FULL_BACKUPS_TO_KEEP, 
     PERIODIC_ROOT_PATH, PERIODIC_SCRIPT_NAME , PERIODIC_WANTED_BACKUP_SCRIPT_PATH, BACKUP_TARGET,
-    BACKUP_SCHEDULE, RESTORE_TIMEOUT_SECONDS, BACKUP_TIMEOUT_SECONDS, VERIFY_TIMEOUT_SECONDS, FORCE_RESTORE)
+    BACKUP_SCHEDULE, RESTORE_TIMEOUT_SECONDS, BACKUP_TIMEOUT_SECONDS, VERIFY_TIMEOUT_SECONDS, FORCE_RESTORE,
+    BACKUP_SHARDED, BACKUP_WORKERS, BACKUP_ENGINE, RESTORE_PROGRESSIVE, BACKUP_MANIFEST_PATH, BACKUP_SCHEDULER,
+    BACKUP_PROGRESS, BACKUP_REQUIRE_INTEGRITY)
+from .bundle import GCBundleBackup
+from .chunkstore import GCChunkBackup
+from .integrity import GCIntegrityCheck
+from .maintenance import MAINTENANCE_LOCK_NAME
+from .restore import GCProgressiveRestore
+from .snapshot import GCSnapshotStage, staging_root
+from .shards import (SHARD_SYSTEM_NAME, index_shard, list_backup_shards, read_shard_index, record_shard_sizes,
+    run_duplicity, write_shard_index)
 
 
 
 gc_logger = GCLogger(__name__)
 logger = gc_logger.get_logger()
 
+BACKUP_LOCK_NAME = 'backup'
+
 
 class GCBackup():
-    def __init__(self):
+    def __init__(self, gpg=None, configure=True):
+        """
+        Args:
+            gpg: Optional GCGpg instance, saves a second GPG initialization during startup
+            configure: Restore into empty data paths and configure the backup schedule,
+                the resident scheduler only runs backups
+        """
         self.backup_enabled = False
+        # Set when the last perform_backup left the changes for a later run
+        self.skipped = False
         if not GCStateManager(GPG_COMPONENT_NAME).is_configured():
             logger.error("GPG is not configured. Skipping backup.") # Might fall back to unencrypted backups
             return
         self.state_manager = GCStateManager(BACKUP_COMPONENT_NAME)
+        gpg = gpg or GCGpg()
+        self.encrypt_key = gpg.get_encryption_fingerprint("encryption")
+        self.sign_key = gpg.get_encryption_fingerprint("signing")
+        self.backup_enabled = True
+        if not configure:
+            return
+
         self.restore_from_backup(FORCE_RESTORE)
         
         # Configure backup schedule on each start, allows changing schedule
         self.configure_backup_schedule()
 
-        self.encrypt_key = GCGpg().get_encryption_fingerprint("encryption")
-        self.sign_key = GCGpg().get_encryption_fingerprint("signing")
-
     def configure_backup_schedule(self):
+        if BACKUP_SCHEDULER:
+            # The resident scheduler runs the backups, cron must not run them as well
+            logger.info(f"Backups run on push and {BACKUP_SCHEDULE.upper()} by the backup scheduler.")
+            self.remove_backup_schedule()
+            self.state_manager.mark_configured()
+            return
+
         logger.info(f"Configuring backup schedule to {BACKUP_SCHEDULE.upper()}.")
         if (PERIODIC_WANTED_BACKUP_SCRIPT_PATH.exists()):
              logger.debug("Backup schedule already configured.")
              return
 
-        for path in PERIODIC_ROOT_PATH.iterdir():
-            script_link_path = path / PERIODIC_SCRIPT_NAME
-            if script_link_path.exists(): script_link_path.unlink()
+        self.remove_backup_schedule()
         try:
             PERIODIC_WANTED_BACKUP_SCRIPT_PATH.symlink_to('/usr/local/bin/backup')
             self.state_manager.mark_configured()
@@ -42,7 +78,22 @@ class GCBackup():
             logger.exception(f"Failed to configure backup schedule: {e}")
             self.state_manager.mark_unconfigured()
 
-    def is_path_empty(self, path):
+    @staticmethod
+    def remove_backup_schedule():
+        for path in PERIODIC_ROOT_PATH.iterdir():
+            script_link_path = path / PERIODIC_SCRIPT_NAME
+            if script_link_path.is_symlink(): script_link_path.unlink()
+
+    @staticmethod
+    def uses_cron():
+        """
+        Returns:
+            bool: True if crond runs the backups
+        """
+        return not BACKUP_SCHEDULER
+
+    @staticmethod
+    def is_path_empty(path):
         check_path = Path(path)
         try:
             if not check_path.exists():
@@ -59,10 +110,28 @@ class GCBackup():
     def restore_from_backup(self, force=False):
         logger.info(f"Attempting restore from backup")
 
+        if self.uses_progressive_restore():
+            progressive = GCProgressiveRestore()
+            if progressive.is_interrupted():
+                # The repository roots are partially filled, carry on with the pending repositories
+                if not restore_in_progress():
+                    logger.info("Resuming interrupted restore")
+                    progressive.spawn()
+                return True
+
         if any(not self.is_path_empty(path) for path in BACKUP_PATHS) or force:
             logger.warning("Date files/directories are not empty skipping restore")
             return
 
+        if BACKUP_ENGINE == 'bundle':
+            return GCBundleBackup(self.encrypt_key, self.sign_key).restore()
+        if BACKUP_ENGINE == 'chunk':
+            return GCChunkBackup(self.encrypt_key, self.sign_key).restore()
+        if self.uses_progressive_restore():
+            return GCProgressiveRestore().start()
+        if BACKUP_SHARDED:
+            return self.restore_sharded_backup()
+
         cmd = [
             'duplicity',
             'restore',
@@ -70,32 +139,11 @@ class GCBackup():
             BACKUP_TARGET,
             '/'
         ]
+        return run_duplicity(cmd, RESTORE_TIMEOUT_SECONDS, "Restore")
 
-        try:
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=RESTORE_TIMEOUT_SECONDS
-            )
-            
-            if result.returncode == 0:
-                logger.info("Restore completed successfully")
-                if result.stdout:
-                    logger.info(f"Restore details: {result.stdout}")
-                return True
-            else:
-                logger.error("Restore failed")
-                if result.stderr:
-                    logger.error(f"Error: {result.stderr}")
-                return False
-                
-        except subprocess.TimeoutExpired:
-            logger.error(f"Restore timed out after {RESTORE_TIMEOUT_SECONDS} seconds")
-            return False
-        except Exception as e:
-            logger.error(f"Restore failed with exception: {e}")
-            return False
+    @staticmethod
+    def uses_progressive_restore():
+        return BACKUP_ENGINE == 'duplicity' and BACKUP_SHARDED and RESTORE_PROGRESSIVE
 
     def is_configured(self):
         """
@@ -114,9 +162,72 @@ class GCBackup():
         except Exception as e:
             logger.error(f"Failed to initialize backup: {e}") # We do notfail on first run
 
-    def perform_backup(self):
+    def perform_backup(self, force=False):
+        # Runs of the scheduler, cron and bin/backup never overlap
+        self.skipped = False
+        lock = RepoLock(str(BACKUP_MANIFEST_PATH), BACKUP_LOCK_NAME, blocking=False)
+        if not lock.acquire():
+            logger.warning("Another backup is running, skipping backup.")
+            self.skipped = True
+            return True
+        try:
+            return self.run_backup(force)
+        finally:
+            lock.release()
+
+    @record_backup_run('backup')
+    def run_backup(self, force=False):
         logger.info("Starting backup.")
+        if GCProgressiveRestore().is_interrupted():
+            # A backup now would drop the repositories that are not restored yet from the shard index
+            logger.warning("A restore is in progress, skipping backup.")
+            self.skipped = True
+            return True
+        manifest = GCBackupManifest()
+        fingerprints = manifest.current()
+        changed_paths = manifest.changed(fingerprints)
+        if not changed_paths and not force:
+            logger.info("No repositories changed since the last backup, skipping.")
+            return True
+        logger.info(f"{len(changed_paths)} path(s) changed since the last backup: {', '.join(changed_paths)}")
+
+        corrupt = self.find_corrupt_repositories(fingerprints if force else changed_paths)
+        if corrupt and BACKUP_ENGINE == 'duplicity' and not BACKUP_SHARDED:
+            logger.error("Skipping backup, a single duplicity backup set cannot leave out a repository. "
+                         "BACKUP_SHARDED, the bundle or the chunk engine back up the other repositories.")
+            return False
+        if corrupt:
+            # The previous fingerprint is kept so they are backed up once they pass again
+            recorded = manifest.load()
+            for path in corrupt:
+                if path in recorded:
+                    fingerprints[path] = recorded[path]
+                else:
+                    fingerprints.pop(path, None)
+            changed_paths = [path for path in changed_paths if path not in corrupt]
+
+        if BACKUP_ENGINE == 'bundle':
+            selected = changed_paths
+            if force:
+                selected = [path for path in fingerprints if path not in corrupt] if corrupt else None
+            success = GCBundleBackup(self.encrypt_key, self.sign_key).perform_backup(selected)
+            if success:
+                manifest.record(fingerprints)
+            return success and not corrupt
+        if BACKUP_ENGINE == 'chunk':
+            # Each snapshot is complete, unchanged files are not read again
+            success = GCChunkBackup(self.encrypt_key, self.sign_key).perform_backup(excluded=corrupt)
+            if success:
+                manifest.record(fingerprints)
+            return success and not corrupt
+        if BACKUP_SHARDED:
+            success = self.perform_sharded_backup(manifest, fingerprints, changed_paths, force, excluded=corrupt)
+            return success and not corrupt
+
+        # Staged copies left behind by an interrupted sharded or bundle backup
         include_args = []
+        for backup_path in BACKUP_PATHS:
+            include_args.extend(['--exclude', str(staging_root(backup_path))])
         for backup_path in BACKUP_PATHS:
             include_args.extend(['--include', backup_path])
 
@@ -127,7 +238,7 @@ class GCBackup():
             '--sign-key', self.sign_key,
             '--encrypt-key', self.encrypt_key,
             '--allow-source-mismatch',
-        ] + include_args + [
+        ] + (['--progress'] if BACKUP_PROGRESS else []) + include_args + [
             '--exclude', '**',  # Exclude everything else
             '/',  # Source root
             BACKUP_TARGET  # Destination
@@ -135,66 +246,68 @@ class GCBackup():
     
         logger.debug(f"Running command (destination removed for security): {' '.join(cmd[:-1] )}")
 
-        try:
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=BACKUP_TIMEOUT_SECONDS  # 1 hour timeout
-            )
-            
-            if result.stdout:
-                logger.info(f"Backup output:\n{result.stdout}")
-            
-            if result.returncode == 0:
-                logger.info("Backup completed successfully")
-                return True
-            else:
-                logger.error(f"Backup failed with exit code {result.returncode}")
-                if result.stderr:
-                    logger.error(f"Error output:\n{result.stderr}")
-                return False
-                
-        except subprocess.TimeoutExpired:
-            logger.error("Backup timed out after 1 hour")
-            return False
-        except Exception as e:
-            logger.error(f"Backup failed with exception: {e}")
-            return False
+        # Wait for running maintenance and keep it off the repositories while duplicity reads them
+        with ExitStack() as locks:
+            for repo_path in fingerprints:
+                if Path(repo_path).is_dir():
+                    locks.enter_context(RepoLock(repo_path, MAINTENANCE_LOCK_NAME, shared=True))
+            success = run_duplicity(cmd, BACKUP_TIMEOUT_SECONDS, "Backup")
+        if success:
+            manifest.record(fingerprints)
+        return success
+
+    def find_corrupt_repositories(self, paths):
+        """
+        Check the repositories about to be backed up when BACKUP_REQUIRE_INTEGRITY is set
 
+        Args:
+            paths: Changed paths, paths that are not repositories are ignored
+
+        Returns:
+            list: Repository paths that failed git fsck
+        """
+        if not BACKUP_REQUIRE_INTEGRITY:
+            return []
+        repositories = [path for path in paths if is_repository(path)]
+        results = GCIntegrityCheck().check(repositories)
+        corrupt = [str(path) for path, ok in results.items() if not ok]
+        if corrupt:
+            logger.error(f"Not backing up {len(corrupt)} repository(s) failing the integrity check, their last good "
+                         f"backup is kept: {', '.join(corrupt)}")
+        return corrupt
+
+    @record_backup_run('cleanup')
     def cleanup_backups(self):
         """Remove old backups, keeping only the specified number of full backups"""
-        logger.info(f"Cleaning up old backups, keeping {self.keep_full} full backups.")
+        logger.info(f"Cleaning up old backups, keeping {FULL_BACKUPS_TO_KEEP} full backups.")
+
+        if BACKUP_ENGINE == 'bundle':
+            return GCBundleBackup(self.encrypt_key, self.sign_key).cleanup()
+        if BACKUP_ENGINE == 'chunk':
+            return GCChunkBackup(self.encrypt_key, self.sign_key).cleanup()
+        if BACKUP_SHARDED:
+            return self.cleanup_sharded_backups()
         
         cmd = [
             'duplicity',
             'remove-all-but-n-full',
             str(FULL_BACKUPS_TO_KEEP),
             '--force',
-            self.backup_target
+            BACKUP_TARGET
         ]
         
-        try:
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=600  # 10 minute timeout
-            )
-            
-            if result.returncode == 0:
-                logger.info("Cleanup completed successfully")
-                return True
-            else:
-                logger.error(f"Cleanup failed: {result.stderr}")
-                return False
-                
-        except Exception as e:
-            logger.exception(f"Cleanup failed with exception: {e}")
-            return False
+        return run_duplicity(cmd, 600, "Cleanup")
 
+    @record_backup_run('verify')
     def verify_backup(self):
         logger.info("Verifying backup.")
+
+        if BACKUP_ENGINE == 'bundle':
+            return GCBundleBackup(self.encrypt_key, self.sign_key).verify()
+        if BACKUP_ENGINE == 'chunk':
+            return GCChunkBackup(self.encrypt_key, self.sign_key).verify()
+        if BACKUP_SHARDED:
+            return self.verify_sharded_backup()
         
         cmd = [
             'duplicity',
@@ -205,21 +318,142 @@ class GCBackup():
             'tmp/verify-test'
         ]
         
-        try:
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=VERIFY_TIMEOUT_SECONDS
-            )
-            
-            if result.returncode == 0:
-                logger.info("Backup verification successful")
-                return True
-            else:
-                logger.error(f"Backup verification failed: {result.stderr}")
+        return run_duplicity(cmd, VERIFY_TIMEOUT_SECONDS, "Verification")
+
+    def run_shards(self, shards, build_command, timeout, action, lock=False):
+        """
+        Run a duplicity command per shard on a bounded pool of duplicity processes
+
+        Args:
+            shards: Shards to process
+            build_command: Callable returning the duplicity command for a shard
+            timeout: Timeout in seconds for each shard
+            action: Action name used in log messages
+            lock: Hold the maintenance lock of repository shards while they are processed
+
+        Returns:
+            dict: Shard name to success mapping
+        """
+        if not shards:
+            return {}
+        logger.info(f"{action} of {len(shards)} shard(s) with {BACKUP_WORKERS} worker(s).")
+        with ThreadPoolExecutor(max_workers=BACKUP_WORKERS) as executor:
+            futures = {
+                shard.name: executor.submit(run_duplicity, build_command(shard), timeout, f"{action} of shard {shard.name}",
+                    shard.source if lock and shard.is_repository else None)
+                for shard in shards
+            }
+            return {name: future.result() for name, future in futures.items()}
+
+    def perform_sharded_backup(self, manifest, fingerprints, changed_paths, force=False, excluded=()):
+        """
+        Back up each changed repository into its own backup set
+
+        Only shards holding a changed path are backed up. The shard index is uploaded
+        on every run so removed repositories drop out of it. Excluded repositories keep
+        their previous backup, or stay out of the index if they never had one.
+        """
+        shards = list_backup_shards()
+        changed = set(changed_paths)
+        recorded = manifest.load()
+        pending = [shard for shard in shards if shard.source not in excluded
+            and (force or any(key in changed for key in shard.fingerprint_keys))]
+        indexed = [shard for shard in shards if shard.source not in excluded or shard.source in recorded]
+        # Repositories a failed restore left offline keep their backup reachable until they are back
+        indexed_names = {shard.name for shard in indexed}
+        unrestored = [shard for shard in GCProgressiveRestore().unrestored_shards() if shard.name not in indexed_names]
+        if unrestored:
+            logger.warning(f"Keeping {len(unrestored)} unrestored repository(s) in the shard index: "
+                           f"{', '.join(shard.name for shard in unrestored)}")
+        record_shard_sizes(indexed, {shard.name for shard in pending})
+        write_shard_index(indexed + unrestored)
+
+        def backup_command(shard):
+            return [
+                'duplicity',
+                'incremental',
+                '--full-if-older-than', '7D',
+                '--sign-key', self.sign_key,
+                '--encrypt-key', self.encrypt_key,
+                '--allow-source-mismatch',
+            ] + (['--progress'] if BACKUP_PROGRESS else []) + shard.selection_args() + [
+                str(stage.staged.get(Path(shard.source), shard.source)),
+                shard.target
+            ]
+
+        # Repository shards are read from their staged copies, the live ones only without staging
+        with GCSnapshotStage([shard.source for shard in pending if shard.is_repository]) as stage:
+            results = self.run_shards(pending + [index_shard()], backup_command, BACKUP_TIMEOUT_SECONDS, "Backup",
+                lock=not stage.enabled)
+
+        # Only record fingerprints of shards that made it to the target
+        for shard in pending:
+            if results.get(shard.name):
+                for key in shard.fingerprint_keys:
+                    if key in fingerprints:
+                        recorded[key] = fingerprints[key]
+        if results.get(index_shard().name):
+            recorded = {key: value for key, value in recorded.items() if key in fingerprints}
+        manifest.record(recorded)
+
+        failed = [name for name, success in results.items() if not success]
+        if failed:
+            logger.error(f"Backup failed for {len(failed)} shard(s): {', '.join(failed)}")
+            return False
+        logger.info(f"Backup of {len(pending)} changed shard(s) completed successfully")
+        return True
+
+    def restore_sharded_backup(self):
+        """
+        Restore the shard index, then the system shard, then all repository shards in parallel
+        """
+        with tempfile.TemporaryDirectory() as index_dir:
+            index = index_shard()
+            if not run_duplicity(['duplicity', 'restore', '--force', index.target, index_dir],
+                    RESTORE_TIMEOUT_SECONDS, "Restore of shard index"):
                 return False
-                
-        except Exception as e:
-            logger.exception(f"Verification failed with exception: {e}")
+            shards = read_shard_index(index_dir)
+
+        def restore_command(shard):
+            return ['duplicity', 'restore', '--force', shard.target, shard.source]
+
+        # The system shard holds the web users, restore it before the long tail of repositories
+        system_shards = [shard for shard in shards if shard.name == SHARD_SYSTEM_NAME]
+        repo_shards = [shard for shard in shards if shard.name != SHARD_SYSTEM_NAME]
+        results = self.run_shards(system_shards, restore_command, RESTORE_TIMEOUT_SECONDS, "Restore")
+        results.update(self.run_shards(repo_shards, restore_command, RESTORE_TIMEOUT_SECONDS, "Restore"))
+
+        failed = [name for name, success in results.items() if not success]
+        if failed:
+            logger.error(f"Restore failed for {len(failed)} shard(s): {', '.join(failed)}")
             return False
+        logger.info(f"Restore of {len(results)} shard(s) completed successfully")
+        return True
+
+    def verify_sharded_backup(self):
+        """
+        Verify each shard against its local source
+        """
+        def verify_command(shard):
+            return [
+                'duplicity',
+                'verify',
+                '--sign-key', self.sign_key,
+                '--encrypt-key', self.encrypt_key,
+            ] + shard.selection_args() + [
+                shard.target,
+                shard.source
+            ]
+
+        results = self.run_shards(list_backup_shards(), verify_command, VERIFY_TIMEOUT_SECONDS, "Verification")
+        return all(results.values())
+
+    def cleanup_sharded_backups(self):
+        """
+        Remove old backup chains of each shard
+        """
+        def cleanup_command(shard):
+            return ['duplicity', 'remove-all-but-n-full', str(FULL_BACKUPS_TO_KEEP), '--force', shard.target]
+
+        results = self.run_shards(list_backup_shards() + [index_shard()], cleanup_command, 600, "Cleanup")
+        return all(results.values())
@@ -0,0 +1,553 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+
+from gnupg import GPG
+
+from shell_utility.backup_stats import add_backup_bytes
+from shell_utility.forks import fork_parent, write_alternates
+from shell_utility.repository import iter_repositories
+from shell_utility.util import atomic_write_text
+
+from . import GCLogger
+from .constants import (BACKUP_PATHS, BACKUP_TARGET, BACKUP_WORKERS, BUNDLE_STATE_PATH, ENCRYPTION_PASSPHRASE,
+    FULL_BACKUPS_TO_KEEP, SIGN_PASSPHRASE)
+from .gitcmd import chown_to_git_user, run_git
+from .snapshot import GCSnapshotStage
+
+gc_logger = GCLogger(__name__)
+logger = gc_logger.get_logger()
+
+CHAIN_FILE = 'chain.json.gpg'
+INDEX_SUFFIX = '.json.gpg'
+
+
+def bundle_target_root(target=BACKUP_TARGET):
+    """
+    Resolve the local directory a bundle backup is written to
+
+    Args:
+        target: A file:// URL or a local path such as a mounted volume
+
+    Raises:
+        ValueError: If the target is not local
+    """
+    parsed = urlparse(target)
+    if parsed.scheme in ('', 'file'):
+        return Path(parsed.path if parsed.scheme else target)
+    raise ValueError(f"The bundle backup engine needs a file:// or local target, got a {parsed.scheme} target")
+
+
+class GCBundleBackup():
+    """Backup engine writing one incremental git bundle per repository
+
+    Each repository has chains of bundles below <target>/bundles/<type>/<name>.git/<chain>/.
+    The first bundle of a chain holds every ref, later bundles only the objects added
+    since the ref tips recorded by the previous one. Bundles and the chain metadata
+    are encrypted and signed with the backup GPG keys. A repack rewrites packfiles
+    without changing refs, so it costs nothing here.
+
+    Forks sharing objects through git alternates are bundled after their parent and
+    leave out everything reachable from the parent's backed up refs. Their chain is
+    tied to the parent's chain and starts over with it, a restore brings the parent
+    back first.
+
+    Each backup that changes the set of repositories writes an index of them below
+    <target>/indexes/. A restore brings back the repositories of the latest index,
+    deleted or renamed repositories stay deleted, and cleanup removes the chains of
+    repositories no kept index lists.
+    """
+
+    def __init__(self, encrypt_key, sign_key, target=BACKUP_TARGET):
+        self.encrypt_key = encrypt_key
+        self.sign_key = sign_key
+        self.root = bundle_target_root(target)
+        self.gpg = GPG()
+
+    # Encryption helpers
+
+    def encrypt_stream(self, stream, destination):
+        """Encrypt a readable stream into destination, written atomically"""
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = destination.with_name(f".{destination.name}.tmp")
+        result = self.gpg.encrypt_file(stream, recipients=[self.encrypt_key], sign=self.sign_key,
+            passphrase=SIGN_PASSPHRASE, armor=False, output=str(tmp_path))
+        if not result.ok:
+            tmp_path.unlink(missing_ok=True)
+            raise RuntimeError(f"Encryption of {destination.name} failed: {result.status}")
+        os.replace(tmp_path, destination)
+        add_backup_bytes(destination.stat().st_size)
+
+    def decrypt_to_file(self, source, destination):
+        with open(source, 'rb') as f:
+            result = self.gpg.decrypt_file(f, passphrase=ENCRYPTION_PASSPHRASE, output=str(destination))
+        if not result.ok:
+            raise RuntimeError(f"Decryption of {source} failed: {result.status}")
+
+    def write_json(self, data, destination):
+        with tempfile.TemporaryFile() as f:
+            f.write(json.dumps(data, indent=2).encode())
+            f.seek(0)
+            self.encrypt_stream(f, destination)
+
+    def read_json(self, source):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_path = Path(tmp_dir) / 'data.json'
+            self.decrypt_to_file(source, json_path)
+            return json.loads(json_path.read_text())
+
+    def write_chain(self, chain_dir, chain):
+        self.write_json(chain, chain_dir / CHAIN_FILE)
+
+    def read_chain(self, chain_dir):
+        return self.read_json(chain_dir / CHAIN_FILE)
+
+    # Repository indexes
+
+    def index_files(self):
+        """List the repository indexes in the target, oldest first"""
+        indexes_root = self.root / 'indexes'
+        if not indexes_root.is_dir():
+            return []
+        return sorted(path for path in indexes_root.iterdir() if path.name.endswith(INDEX_SUFFIX))
+
+    def read_index(self, index_file):
+        return self.read_json(index_file)['repositories']
+
+    def write_index(self, repo_keys):
+        """Record the backed up repositories, unless the latest index already lists the same ones"""
+        indexes = self.index_files()
+        if indexes and sorted(self.read_index(indexes[-1])) == sorted(repo_keys):
+            return
+        name = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        self.write_json({'created': time.time(), 'repositories': sorted(repo_keys)},
+            self.root / 'indexes' / f"{name}{INDEX_SUFFIX}")
+        logger.info(f"Bundle index {name} lists {len(repo_keys)} repository(s)")
+
+    # Chain bookkeeping
+
+    def repository_dir(self, repo_key):
+        return self.root / 'bundles' / repo_key
+
+    def chain_dirs(self, repo_key):
+        """List the chains of a repository, oldest first"""
+        repo_dir = self.repository_dir(repo_key)
+        if not repo_dir.is_dir():
+            return []
+        return sorted(path for path in repo_dir.iterdir() if (path / CHAIN_FILE).exists())
+
+    def state_path(self, repo_key):
+        return Path(BUNDLE_STATE_PATH) / f"{repo_key}.json"
+
+    def load_state(self, repo_key):
+        """
+        Load the ref tips of the last bundle written for a repository
+
+        The state is kept locally to avoid decrypting the chain on each run and is
+        recovered from the latest chain when missing.
+        """
+        try:
+            return json.loads(self.state_path(repo_key).read_text())
+        except (OSError, ValueError):
+            pass
+        chains = self.chain_dirs(repo_key)
+        if not chains:
+            return None
+        chain = self.read_chain(chains[-1])
+        return {'chain': chains[-1].name, 'refs': chain['entries'][-1]['refs'], 'head': chain['entries'][-1]['head'],
+            'parent': chain.get('parent'), 'parent_chain': chain.get('parent_chain')}
+
+    def save_state(self, repo_key, state):
+        atomic_write_text(self.state_path(repo_key), json.dumps(state, indent=2), mode=0o600)
+
+    # Repository helpers
+
+    def read_refs(self, repo_path):
+        result = run_git(repo_path, 'for-each-ref', '--format=%(objectname) %(refname)',
+            capture_output=True, text=True, check=True)
+        refs = {}
+        for line in result.stdout.splitlines():
+            sha, ref = line.split(' ', 1)
+            refs[ref] = sha
+        return refs
+
+    def read_head(self, repo_path):
+        result = run_git(repo_path, 'symbolic-ref', '-q', 'HEAD', capture_output=True, text=True)
+        return result.stdout.strip() or None
+
+    def has_objects(self, repo_path, shas):
+        if not shas:
+            return True
+        result = run_git(repo_path, 'cat-file', '--batch-check', input='\n'.join(shas) + '\n',
+            capture_output=True, text=True)
+        return result.returncode == 0 and 'missing' not in result.stdout
+
+    def has_new_objects(self, repo_path, prerequisites):
+        """
+        Check if any ref reaches an object the prerequisites do not
+
+        Objects rather than commits, a new tag on an already backed up commit, tree
+        or blob only adds a tag object and still needs a bundle.
+        """
+        if not prerequisites:
+            return True
+        process = subprocess.Popen(
+            ['git', '-c', 'safe.directory=*', '-C', str(repo_path), 'rev-list', '--objects', '--all', '--stdin'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process.stdin.write(''.join(f"^{sha}\n" for sha in prerequisites).encode())
+        process.stdin.close()
+        # The first object answers the question, the rest of the walk is not needed
+        found = bool(process.stdout.readline())
+        if found:
+            process.kill()
+        stderr = process.stderr.read()
+        if process.wait() != 0 and not found:
+            raise subprocess.CalledProcessError(process.returncode, 'git rev-list', stderr=stderr)
+        return found
+
+    # Backup
+
+    def backup_repository(self, repo_path, repo_key):
+        """
+        Write the next bundle of a repository's chain
+
+        Args:
+            repo_path: Repository directory
+            repo_key: Repository path relative to '/', e.g. private/project.git
+
+        Returns:
+            bool: True if the repository is backed up
+        """
+        try:
+            refs = self.read_refs(repo_path)
+            head = self.read_head(repo_path)
+            state = self.load_state(repo_key)
+            parent = self.parent_state(repo_path, repo_key)
+            same_parent = state is not None and (state.get('parent'), state.get('parent_chain')) == parent[:2]
+            if state and state['refs'] == refs and state['head'] == head and same_parent:
+                logger.debug(f"Refs of {repo_key} have not moved, skipping")
+                return True
+
+            prerequisites = sorted(set(state['refs'].values())) if state else []
+            chains = self.chain_dirs(repo_key)
+            if (state and same_parent and chains and chains[-1].name == state['chain']
+                    and self.has_objects(repo_path, prerequisites)):
+                chain_dir = chains[-1]
+                chain = self.read_chain(chain_dir)
+            else:
+                # Start a new chain with a full bundle, for a fork full above its parent
+                prerequisites = []
+                chain_dir = self.repository_dir(repo_key) / time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+                chain = {'repository': repo_key, 'entries': [], 'parent': parent[0], 'parent_chain': parent[1]}
+            prerequisites = sorted(set(prerequisites) | set(parent[2]))
+
+            seq = len(chain['entries']) + 1
+            entry = {'seq': seq, 'file': None, 'refs': refs, 'head': head, 'prerequisites': prerequisites,
+                'created': time.time()}
+            if refs and self.has_new_objects(repo_path, prerequisites):
+                entry['file'] = f"{seq:06d}.bundle.gpg"
+                self.write_bundle(repo_path, prerequisites, chain_dir / entry['file'])
+
+            chain['entries'].append(entry)
+            self.write_chain(chain_dir, chain)
+            self.save_state(repo_key, {'chain': chain_dir.name, 'refs': refs, 'head': head, 'parent': parent[0],
+                'parent_chain': parent[1]})
+            logger.info(f"Bundle {seq} of {repo_key} written to chain {chain_dir.name}")
+            return True
+        except Exception as e:
+            logger.exception(f"Bundle backup of {repo_key} failed: {e}")
+            return False
+
+    def parent_state(self, repo_path, repo_key):
+        """
+        Look up the backup of the repository a fork borrows objects from
+
+        Returns:
+            tuple: Parent key, parent chain and the parent's backed up ref tips, all empty
+                for a repository that is not a fork
+
+        Raises:
+            RuntimeError: If the parent has no bundle backup yet
+        """
+        parent = fork_parent(repo_path)
+        if parent is None:
+            return None, None, []
+        parent_key = str(parent.relative_to('/'))
+        state = self.load_state(parent_key)
+        if state is None:
+            raise RuntimeError(f"{parent_key}, the parent of {repo_key}, has no bundle backup")
+        return parent_key, state['chain'], list(state['refs'].values())
+
+    def write_bundle(self, repo_path, prerequisites, destination):
+        """Stream git bundle create through gpg into destination"""
+        process = subprocess.Popen(
+            ['git', '-c', 'safe.directory=*', '-C', str(repo_path), 'bundle', 'create', '--quiet', '-', '--all', '--stdin'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process.stdin.write(''.join(f"^{sha}\n" for sha in prerequisites).encode())
+        process.stdin.close()
+        try:
+            self.encrypt_stream(process.stdout, destination)
+        finally:
+            process.stdout.close()
+            stderr = process.stderr.read().decode(errors='replace')
+            process.wait()
+        if process.returncode != 0:
+            destination.unlink(missing_ok=True)
+            raise RuntimeError(f"git bundle create failed: {stderr.strip()}")
+
+    def backup_system_files(self):
+        """Encrypt the non-repository files in BACKUP_PATHS, e.g. the web users"""
+        for backup_path in BACKUP_PATHS:
+            path = Path(backup_path)
+            if path.is_file():
+                with open(path, 'rb') as f:
+                    self.encrypt_stream(f, self.root / 'system' / (str(path.relative_to('/')) + '.gpg'))
+
+    def repositories(self):
+        """List the local repositories as (path, key) pairs"""
+        repositories = []
+        for backup_path in BACKUP_PATHS:
+            path = Path(backup_path)
+            if path.is_dir():
+                for repo_name in iter_repositories(path):
+                    repositories.append((path / repo_name, str(path.relative_to('/') / repo_name)))
+        return repositories
+
+    def backup_staged_repository(self, stage, repo_path, repo_key):
+        """Back up the staged copy of a repository, or the live one while holding its maintenance lock"""
+        with stage.read_path(repo_path) as source:
+            return self.backup_repository(source, repo_key)
+
+    def perform_backup(self, changed_paths=None):
+        """
+        Bundle every repository whose refs moved
+
+        Args:
+            changed_paths: Optional paths from the backup manifest, other repositories are skipped
+
+        Returns:
+            bool: True if every repository was backed up
+        """
+        logger.info(f"Starting bundle backup to {self.root}")
+        self.backup_system_files()
+        repositories = self.repositories()
+        live_keys = [key for path, key in repositories]
+        parents = {key: fork_parent(path) for path, key in repositories}
+        parents = {key: str(parent.relative_to('/')) if parent else None for key, parent in parents.items()}
+        if changed_paths is not None:
+            # Forks follow their parent, a new parent chain starts a new fork chain
+            selected = {key for path, key in repositories if str(path) in changed_paths}
+            for key in fork_order(parents):
+                if parents[key] in selected:
+                    selected.add(key)
+            repositories = [(path, key) for path, key in repositories if key in selected]
+
+        results = []
+        paths = {key: path for path, key in repositories}
+        with GCSnapshotStage(paths.values()) as stage, ThreadPoolExecutor(max_workers=BACKUP_WORKERS) as executor:
+            # Parents are bundled before their forks
+            for level in fork_levels(list(paths), parents):
+                results.extend(executor.map(lambda key: self.backup_staged_repository(stage, paths[key], key), level))
+        if not all(results):
+            logger.error(f"Bundle backup failed for {results.count(False)} repository(s)")
+            return False
+        # A repository without a chain yet, e.g. one failing the integrity check, cannot be restored
+        self.write_index([key for key in live_keys if self.chain_dirs(key)])
+        logger.info(f"Bundle backup of {len(repositories)} repository(s) completed successfully")
+        return True
+
+    # Restore
+
+    def remote_repositories(self):
+        """List the repository keys with at least one chain in the target, including deleted ones"""
+        bundles_root = self.root / 'bundles'
+        keys = []
+        for type_dir in sorted(bundles_root.iterdir()) if bundles_root.is_dir() else []:
+            for repo_name in iter_bundle_repositories(type_dir):
+                keys.append(str(type_dir.relative_to(bundles_root) / repo_name))
+        return keys
+
+    def restore_repository(self, repo_key):
+        """
+        Replay the latest chain of a repository into /<repo_key>
+
+        Returns:
+            bool: True if the repository was restored
+        """
+        chains = self.chain_dirs(repo_key)
+        if not chains:
+            return False
+        repo_path = Path('/') / repo_key
+        try:
+            chain = self.read_chain(chains[-1])
+            repo_path.parent.mkdir(parents=True, exist_ok=True)
+            run_git(repo_path.parent, 'init', '--quiet', '--bare', repo_path.name, check=True, capture_output=True)
+            if chain.get('parent'):
+                # The bundles of a fork need the objects of its parent, restored before it
+                write_alternates(repo_path, [Path('/') / chain['parent'] / 'objects'])
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                for entry in chain['entries']:
+                    if not entry['file']:
+                        continue
+                    bundle_path = Path(tmp_dir) / 'restore.bundle'
+                    self.decrypt_to_file(chains[-1] / entry['file'], bundle_path)
+                    run_git(repo_path, 'bundle', 'unbundle', str(bundle_path), check=True, capture_output=True)
+                    bundle_path.unlink()
+
+            final = chain['entries'][-1]
+            updates = ''.join(f"update {ref} {sha}\n" for ref, sha in final['refs'].items())
+            run_git(repo_path, 'update-ref', '--stdin', input=updates, text=True, check=True, capture_output=True)
+            if final['head']:
+                run_git(repo_path, 'symbolic-ref', 'HEAD', final['head'], check=True, capture_output=True)
+            chown_to_git_user(repo_path)
+            self.save_state(repo_key, {'chain': chains[-1].name, 'refs': final['refs'], 'head': final['head'],
+                'parent': chain.get('parent'), 'parent_chain': chain.get('parent_chain')})
+            logger.info(f"Restored {repo_key} from {len(chain['entries'])} chain entries")
+            return True
+        except Exception as e:
+            logger.exception(f"Bundle restore of {repo_key} failed: {e}")
+            return False
+
+    def restore_system_files(self):
+        system_root = self.root / 'system'
+        if not system_root.is_dir():
+            return
+        for encrypted in system_root.rglob('*.gpg'):
+            destination = Path('/') / str(encrypted.relative_to(system_root))[:-len('.gpg')]
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            self.decrypt_to_file(encrypted, destination)
+
+    def restore(self):
+        logger.info(f"Starting bundle restore from {self.root}")
+        try:
+            self.restore_system_files()
+        except Exception as e:
+            logger.exception(f"Restore of system files failed: {e}")
+            return False
+        indexes = self.index_files()
+        if indexes:
+            repo_keys = self.read_index(indexes[-1])
+        else:
+            logger.warning("No bundle index in the target, restoring every repository with a chain")
+            repo_keys = self.remote_repositories()
+        parents = {}
+        for repo_key in repo_keys:
+            chains = self.chain_dirs(repo_key)
+            parents[repo_key] = self.read_chain(chains[-1]).get('parent') if chains else None
+        results = []
+        with ThreadPoolExecutor(max_workers=BACKUP_WORKERS) as executor:
+            # Parents are restored before their forks
+            for level in fork_levels(repo_keys, parents):
+                results.extend(executor.map(self.restore_repository, level))
+        if not all(results):
+            logger.error(f"Bundle restore failed for {results.count(False)} repository(s)")
+            return False
+        logger.info(f"Bundle restore of {len(repo_keys)} repository(s) completed successfully")
+        return True
+
+    # Verify and cleanup
+
+    def verify_repository(self, repo_key):
+        """Check every bundle of the latest chain decrypts and applies to the live repository"""
+        chains = self.chain_dirs(repo_key)
+        repo_path = Path('/') / repo_key
+        try:
+            chain = self.read_chain(chains[-1])
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                for entry in chain['entries']:
+                    if not entry['file']:
+                        continue
+                    bundle_path = Path(tmp_dir) / 'verify.bundle'
+                    self.decrypt_to_file(chains[-1] / entry['file'], bundle_path)
+                    run_git(repo_path, 'bundle', 'verify', '--quiet', str(bundle_path), check=True, capture_output=True)
+                    bundle_path.unlink()
+            return True
+        except Exception as e:
+            logger.error(f"Bundle verification of {repo_key} failed: {e}")
+            return False
+
+    def verify(self):
+        repo_keys = [key for key in self.remote_repositories() if (Path('/') / key).is_dir()]
+        with ThreadPoolExecutor(max_workers=BACKUP_WORKERS) as executor:
+            results = list(executor.map(self.verify_repository, repo_keys))
+        return all(results)
+
+    def cleanup(self, keep=FULL_BACKUPS_TO_KEEP):
+        """
+        Remove all but the newest keep indexes and chains of each repository
+
+        Deleted repositories none of the kept indexes lists are removed with all their chains.
+        """
+        indexes = self.index_files()
+        for index_file in indexes[:-keep]:
+            logger.info(f"Removing bundle index {index_file.name}")
+            index_file.unlink()
+        # Without an index, e.g. backups written before indexes existed, every repository is kept
+        listed = None
+        if indexes:
+            listed = {key for index_file in indexes[-keep:] for key in self.read_index(index_file)}
+        for repo_key in self.remote_repositories():
+            # A backup running alongside may have written the first chain of a new repository
+            # but not yet the index listing it
+            if listed is not None and repo_key not in listed and not (Path('/') / repo_key).is_dir():
+                logger.info(f"Removing bundle chains of {repo_key}, no kept index lists it")
+                shutil.rmtree(self.repository_dir(repo_key))
+                self.state_path(repo_key).unlink(missing_ok=True)
+                continue
+            for chain_dir in self.chain_dirs(repo_key)[:-keep]:
+                logger.info(f"Removing bundle chain {repo_key}/{chain_dir.name}")
+                shutil.rmtree(chain_dir)
+        return True
+
+
+def iter_bundle_repositories(type_dir):
+    """Find repository directories (named *.git) below a bundle type directory"""
+    pending = [type_dir]
+    while pending:
+        directory = pending.pop()
+        for entry in sorted(directory.iterdir()):
+            if not entry.is_dir():
+                continue
+            if entry.name.endswith('.git'):
+                yield str(entry.relative_to(type_dir))
+            else:
+                pending.append(entry)
+
+
+def fork_depth(key, parents):
+    """Count the parents of a repository, 0 for a repository that is not a fork"""
+    depth = 0
+    seen = {key}
+    while parents.get(key) and parents[key] not in seen:
+        key = parents[key]
+        seen.add(key)
+        depth += 1
+    return depth
+
+
+def fork_order(parents):
+    """List repository keys with every parent before its forks"""
+    return sorted(parents, key=lambda key: fork_depth(key, parents))
+
+
+def fork_levels(keys, parents):
+    """
+    Group repositories so each group only depends on earlier ones
+
+    Args:
+        keys: Repository keys
+        parents: Repository key to the key of its parent, None if it is not a fork
+
+    Returns:
+        list: Lists of keys, repositories without a parent first, then their forks and so on
+    """
+    levels = {}
+    for key in keys:
+        levels.setdefault(fork_depth(key, parents), []).append(key)
+    return [levels[depth] for depth in sorted(levels)]
@@ -0,0 +1,505 @@
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import stat
+import time
+import zlib
+from pathlib import Path
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from gnupg import GPG
+
+from shell_utility.backup_stats import add_backup_bytes
+from shell_utility.locks import RepoLock
+from shell_utility.repository import is_repository, iter_repositories
+from shell_utility.util import atomic_write_text
+
+from . import GCLogger
+from .bundle import bundle_target_root
+from .constants import (BACKUP_PATHS, BACKUP_SNAPSHOTS_TO_KEEP, BACKUP_TARGET, CHUNK_STATE_PATH,
+    ENCRYPTION_PASSPHRASE, SIGN_PASSPHRASE)
+from .gitcmd import chown_to_git_user
+from .snapshot import GCSnapshotStage, iter_tree, staging_root
+
+gc_logger = GCLogger(__name__)
+logger = gc_logger.get_logger()
+
+STORE_LOCK_NAME = 'chunkstore'
+KEY_FILE = Path('keys') / 'data.key.gpg'
+
+# Chunk sizes of the content-defined chunking, a chunk is cut at the first content boundary
+# after CHUNK_MIN_SIZE and at CHUNK_MAX_SIZE at the latest
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_AVG_SIZE = 1024 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+# A chunk ends after a run of bytes that all belong to a fixed quarter of the byte values. The run
+# is longer before the average size than after it, like the normalized chunking of FastCDC, so chunk
+# sizes cluster around the average. Searching with bytes.translate and bytes.find runs at C speed.
+# Changing the table or the run lengths moves every boundary, new chunks would no longer match stored ones.
+BOUNDARY_TABLE = bytes(0 if hashlib.sha256(bytes([value])).digest()[0] & 3 == 0 else 1 for value in range(256))
+SMALL_BOUNDARY = bytes(10)
+LARGE_BOUNDARY = bytes(8)
+
+NONCE_SIZE = 12
+# First byte of a chunk payload before encryption, packfiles are compressed already and stored as is
+RAW = b'r'
+COMPRESSED = b'z'
+
+
+def cut_point(data):
+    """
+    Find the end of the first chunk in data
+
+    Args:
+        data: Buffer starting at the chunk, at least CHUNK_MAX_SIZE bytes unless it holds the end of the file
+
+    Returns:
+        int: Length of the chunk
+    """
+    length = len(data)
+    if length <= CHUNK_MIN_SIZE:
+        return length
+    end = min(length, CHUNK_MAX_SIZE)
+    normal = min(end, CHUNK_AVG_SIZE) - CHUNK_MIN_SIZE
+    classes = bytes(data[CHUNK_MIN_SIZE:end]).translate(BOUNDARY_TABLE)
+    position = classes.find(SMALL_BOUNDARY, 0, normal)
+    if position >= 0:
+        return CHUNK_MIN_SIZE + position + len(SMALL_BOUNDARY)
+    position = classes.find(LARGE_BOUNDARY, normal)
+    if position >= 0:
+        return CHUNK_MIN_SIZE + position + len(LARGE_BOUNDARY)
+    return end
+
+
+def iter_chunks(f):
+    """Split a binary stream into content-defined chunks
+
+    An insertion or removal only changes the chunks around it, the boundaries
+    after it are found again, so a grown file shares most of its chunks with the
+    previous version.
+
+    Yields:
+        bytes: Consecutive chunks of the stream
+    """
+    buffer = b''
+    offset = 0
+    eof = False
+    while True:
+        if not eof and len(buffer) - offset < CHUNK_MAX_SIZE:
+            data = f.read(CHUNK_MAX_SIZE * 2)
+            eof = not data
+            buffer = buffer[offset:] + data
+            offset = 0
+        if offset == len(buffer):
+            return
+        length = cut_point(memoryview(buffer)[offset:offset + CHUNK_MAX_SIZE])
+        yield buffer[offset:offset + length]
+        offset += length
+
+
+class GCChunkBackup():
+    """Backup engine storing files as deduplicated, encrypted content-defined chunks
+
+    Files below BACKUP_PATHS are cut into chunks where their content says so, each
+    chunk is stored once under <target>/chunks/<xx>/<id>, compressed and encrypted
+    with AES-GCM. The chunk id is a keyed hash of its content, identical chunks of
+    other files, repositories and snapshots are stored once. The data key is kept
+    in the target encrypted and signed with the backup GPG keys.
+
+    Every backup writes an encrypted manifest to <target>/snapshots/ listing each
+    file and its chunks. Retention is a mark and sweep, after removing expired
+    snapshots every chunk no remaining manifest references is deleted. A file unchanged
+    since the last backup is not read again, its chunks are taken from the local
+    cache in CHUNK_STATE_PATH.
+    """
+
+    def __init__(self, encrypt_key, sign_key, target=BACKUP_TARGET):
+        self.encrypt_key = encrypt_key
+        self.sign_key = sign_key
+        self.root = bundle_target_root(target)
+        self.gpg = GPG()
+        self.keys = None
+
+    # Keys and encryption
+
+    def load_keys(self, create=False):
+        """
+        Decrypt the data key from the target, a new one is created for an empty target
+
+        Returns:
+            tuple: The chunk id and encryption keys
+        """
+        if self.keys is not None:
+            return self.keys
+        key_path = self.root / KEY_FILE
+        if key_path.exists():
+            with open(key_path, 'rb') as f:
+                result = self.gpg.decrypt_file(f, passphrase=ENCRYPTION_PASSPHRASE)
+            if not result.ok:
+                raise RuntimeError(f"Decryption of the chunk store key failed: {result.status}")
+            material = result.data
+        elif create:
+            material = secrets.token_bytes(64)
+            key_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = key_path.with_name(f".{key_path.name}.tmp")
+            result = self.gpg.encrypt(material, recipients=[self.encrypt_key], sign=self.sign_key,
+                passphrase=SIGN_PASSPHRASE, armor=False, output=str(tmp_path))
+            if not result.ok:
+                tmp_path.unlink(missing_ok=True)
+                raise RuntimeError(f"Encryption of the chunk store key failed: {result.status}")
+            os.replace(tmp_path, key_path)
+        else:
+            raise RuntimeError(f"No chunk store key in {self.root}")
+        self.keys = (material[:32], AESGCM(material[32:]))
+        return self.keys
+
+    def seal(self, data, context):
+        nonce = secrets.token_bytes(NONCE_SIZE)
+        return nonce + self.load_keys()[1].encrypt(nonce, data, context)
+
+    def unseal(self, data, context):
+        try:
+            return self.load_keys()[1].decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], context)
+        except InvalidTag:
+            raise RuntimeError(f"Authentication of {context.decode()} failed") from None
+
+    def write_file(self, path, data):
+        """Write a target file atomically and count it in the backup statistics"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        add_backup_bytes(len(data))
+
+    def write_object(self, path, value, context):
+        self.write_file(path, self.seal(zlib.compress(json.dumps(value).encode()), context))
+
+    def read_object(self, path, context):
+        return json.loads(zlib.decompress(self.unseal(path.read_bytes(), context)))
+
+    # Chunks
+
+    def chunk_id(self, data):
+        return hmac.new(self.load_keys()[0], data, hashlib.sha256).hexdigest()
+
+    def chunk_path(self, chunk_id):
+        return self.root / 'chunks' / chunk_id[:2] / chunk_id
+
+    def store_chunk(self, data):
+        """
+        Store a chunk unless the target has it already
+
+        Returns:
+            str: The chunk id
+        """
+        chunk_id = self.chunk_id(data)
+        path = self.chunk_path(chunk_id)
+        if not path.exists():
+            compressed = zlib.compress(data, 1)
+            payload = COMPRESSED + compressed if len(compressed) < len(data) else RAW + data
+            self.write_file(path, self.seal(payload, chunk_id.encode()))
+        return chunk_id
+
+    def load_chunk(self, chunk_id):
+        """
+        Read, decrypt and authenticate a chunk
+
+        Raises:
+            RuntimeError: If the chunk was modified or does not match its id
+        """
+        payload = self.unseal(self.chunk_path(chunk_id).read_bytes(), chunk_id.encode())
+        data = zlib.decompress(payload[1:]) if payload[:1] == COMPRESSED else payload[1:]
+        if not hmac.compare_digest(self.chunk_id(data), chunk_id):
+            raise RuntimeError(f"Chunk {chunk_id} does not match its content")
+        return data
+
+    # Snapshots and reference counts
+
+    def snapshots_dir(self):
+        return self.root / 'snapshots'
+
+    def snapshots(self):
+        """List the snapshot names, oldest first"""
+        directory = self.snapshots_dir()
+        if not directory.is_dir():
+            return []
+        return sorted(path.name for path in directory.iterdir() if not path.name.startswith('.'))
+
+    def new_snapshot_name(self):
+        name = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        existing = set(self.snapshots())
+        suffix = 1
+        candidate = name
+        while candidate in existing:
+            candidate = f"{name}.{suffix}"
+            suffix += 1
+        return candidate
+
+    def read_snapshot(self, name):
+        return self.read_object(self.snapshots_dir() / name, f"snapshot:{name}".encode())
+
+    def referenced_chunks(self):
+        """
+        Returns:
+            set: Ids of the chunks any snapshot manifest references
+        """
+        referenced = set()
+        for name in self.snapshots():
+            referenced |= snapshot_chunks(self.read_snapshot(name))
+        return referenced
+
+    def store_lock(self):
+        """Exclusive lock of the target, backups and cleanups never run at once"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        return RepoLock(self.root, STORE_LOCK_NAME)
+
+    # Local file cache
+
+    def cache_path(self):
+        return Path(CHUNK_STATE_PATH) / 'files.json'
+
+    def load_cache(self):
+        try:
+            cache = json.loads(self.cache_path().read_text())
+            if cache.get('target') == str(self.root):
+                return cache['files']
+        except (OSError, ValueError, KeyError):
+            pass
+        return {}
+
+    def save_cache(self, files):
+        atomic_write_text(self.cache_path(), json.dumps({'target': str(self.root), 'files': files}), mode=0o600)
+
+    # Backup
+
+    def backup_file(self, path, source, st, cache, files):
+        """
+        Chunk a file, reusing the chunks of the last backup if it did not change
+
+        Args:
+            path: Path of the file in the backup
+            source: Path the file is read from, its staged copy or path itself
+
+        Returns:
+            list: Chunk ids of the file
+        """
+        signature = [st.st_size, st.st_mtime_ns, st.st_ino]
+        cached = cache.get(str(path))
+        if (cached and cached['signature'] == signature
+                and all(self.chunk_path(chunk_id).exists() for chunk_id in cached['chunks'])):
+            files[str(path)] = cached
+            return cached['chunks']
+        with open(source, 'rb') as f:
+            chunks = [self.store_chunk(chunk) for chunk in iter_chunks(f)]
+        files[str(path)] = {'signature': signature, 'chunks': chunks}
+        return chunks
+
+    def backup_tree(self, root, cache, files, skip=(), source=None):
+        """
+        List a backup path and store the chunks of its files
+
+        Args:
+            root: File or directory to back up
+            cache: File cache of the previous backup
+            files: File cache of this backup, filled in
+            skip: Directories left out together with their content
+            source: Directory read instead of root, e.g. the staged copy of a repository
+
+        Returns:
+            list: Manifest entries of root and everything below it
+        """
+        root = Path(root)
+        source = Path(source) if source else root
+        entries = []
+        for source_path in iter_tree(source, skip):
+            path = root / source_path.relative_to(source)
+            try:
+                st = source_path.lstat()
+                entry = {'path': str(path), 'mode': stat.S_IMODE(st.st_mode), 'uid': st.st_uid, 'gid': st.st_gid,
+                    'mtime': st.st_mtime_ns}
+                if stat.S_ISDIR(st.st_mode):
+                    entry['type'] = 'dir'
+                elif stat.S_ISLNK(st.st_mode):
+                    entry.update(type='symlink', target=os.readlink(source_path))
+                elif stat.S_ISREG(st.st_mode):
+                    entry.update(type='file', size=st.st_size,
+                        chunks=self.backup_file(path, source_path, st, cache, files))
+                else:
+                    continue
+            except FileNotFoundError:
+                # Removed while walking, e.g. a lock file or an old pack after a repack
+                logger.debug(f"{path} disappeared during the backup")
+                continue
+            entries.append(entry)
+        return entries
+
+    def perform_backup(self, excluded=()):
+        """
+        Write a snapshot of every path in BACKUP_PATHS
+
+        Args:
+            excluded: Repository paths left out, their entries are copied from the previous snapshot
+
+        Returns:
+            bool: True if the snapshot was written
+        """
+        logger.info(f"Starting chunk store backup to {self.root}")
+        try:
+            with self.store_lock():
+                self.load_keys(create=True)
+                snapshots = self.snapshots()
+                previous = self.read_snapshot(snapshots[-1]) if snapshots and excluded else None
+                cache = self.load_cache()
+                files = {}
+                entries = []
+                repositories = {}
+                for backup_path in BACKUP_PATHS:
+                    path = Path(backup_path)
+                    if path.is_dir():
+                        repositories[path] = [path / repo_name for repo_name in iter_repositories(path)]
+                staged = [repo_path for paths in repositories.values() for repo_path in paths
+                    if str(repo_path) not in excluded]
+                with GCSnapshotStage(staged) as stage:
+                    for backup_path in BACKUP_PATHS:
+                        path = Path(backup_path)
+                        if not path.exists():
+                            continue
+                        skip = set(repositories.get(path, [])) | {staging_root(path)}
+                        entries.extend(self.backup_tree(path, cache, files, skip=skip))
+                        for repo_path in repositories.get(path, []):
+                            if str(repo_path) in excluded:
+                                entries.extend(entries_below(previous, repo_path) if previous else [])
+                                continue
+                            with stage.read_path(repo_path) as source:
+                                entries.extend(self.backup_tree(repo_path, cache, files, source=source))
+
+                snapshot = {'created': time.time(), 'entries': entries}
+                name = self.new_snapshot_name()
+                # Written after its chunks, a crash in between leaves chunks the next cleanup sweeps
+                self.write_object(self.snapshots_dir() / name, snapshot, f"snapshot:{name}".encode())
+                self.save_cache(files)
+        except Exception as e:
+            logger.exception(f"Chunk store backup failed: {e}")
+            return False
+        logger.info(f"Chunk store snapshot {name} of {len(entries)} path(s) completed successfully")
+        return True
+
+    # Restore
+
+    def restore_file(self, entry):
+        path = Path(entry['path'])
+        tmp_path = path.with_name(f".{path.name}.restore")
+        with open(tmp_path, 'wb') as f:
+            for chunk_id in entry['chunks']:
+                f.write(self.load_chunk(chunk_id))
+        os.replace(tmp_path, path)
+
+    def restore(self, name=None):
+        """
+        Restore every path of a snapshot, the latest one by default
+
+        Returns:
+            bool: True if the snapshot was restored
+        """
+        logger.info(f"Starting chunk store restore from {self.root}")
+        try:
+            snapshots = self.snapshots()
+            if not snapshots:
+                logger.warning(f"No chunk store snapshot in {self.root}, nothing to restore")
+                return True
+            name = name or snapshots[-1]
+            entries = self.read_snapshot(name)['entries']
+            for entry in entries:
+                path = Path(entry['path'])
+                path.parent.mkdir(parents=True, exist_ok=True)
+                if entry['type'] == 'dir':
+                    path.mkdir(exist_ok=True)
+                elif entry['type'] == 'symlink':
+                    path.unlink(missing_ok=True)
+                    os.symlink(entry['target'], path)
+                else:
+                    self.restore_file(entry)
+                if entry['type'] != 'symlink':
+                    os.chmod(path, entry['mode'])
+                if os.geteuid() == 0:
+                    os.lchown(path, entry['uid'], entry['gid'])
+            # Directories last, writing their content changed their times
+            for entry in reversed(entries):
+                if entry['type'] != 'symlink':
+                    os.utime(entry['path'], ns=(entry['mtime'], entry['mtime']))
+            for entry in entries:
+                if entry['type'] == 'dir' and is_repository(entry['path']):
+                    chown_to_git_user(entry['path'])
+        except Exception as e:
+            logger.exception(f"Chunk store restore of snapshot {name} failed: {e}")
+            return False
+        logger.info(f"Chunk store restore of snapshot {name}, {len(entries)} path(s), completed successfully")
+        return True
+
+    # Verify and cleanup
+
+    def verify(self):
+        """Decrypt and authenticate every chunk of the latest snapshot"""
+        try:
+            snapshots = self.snapshots()
+            if not snapshots:
+                logger.error(f"No chunk store snapshot in {self.root}")
+                return False
+            chunk_ids = snapshot_chunks(self.read_snapshot(snapshots[-1]))
+            for chunk_id in chunk_ids:
+                self.load_chunk(chunk_id)
+        except Exception as e:
+            logger.error(f"Chunk store verification failed: {e}")
+            return False
+        logger.info(f"Verified {len(chunk_ids)} chunk(s) of snapshot {snapshots[-1]}")
+        return True
+
+    def cleanup(self, keep=BACKUP_SNAPSHOTS_TO_KEEP):
+        """
+        Remove all but the newest keep snapshots and every chunk the remaining ones do not reference
+
+        Chunks of an interrupted backup, written before its manifest, are removed as well.
+
+        Returns:
+            bool: True if the cleanup completed
+        """
+        try:
+            with self.store_lock():
+                snapshots = self.snapshots()
+                expired = snapshots[:-keep] if keep > 0 else []
+                for name in expired:
+                    (self.snapshots_dir() / name).unlink()
+                    logger.info(f"Removed chunk store snapshot {name}")
+                referenced = self.referenced_chunks()
+
+                removed = 0
+                chunks_root = self.root / 'chunks'
+                for directory in chunks_root.iterdir() if chunks_root.is_dir() else []:
+                    for path in directory.iterdir():
+                        if path.name not in referenced:
+                            path.unlink()
+                            removed += 1
+        except Exception as e:
+            logger.exception(f"Chunk store cleanup failed: {e}")
+            return False
+        logger.info(f"Removed {len(expired)} snapshot(s) and {removed} unreferenced chunk(s)")
+        return True
+
+def snapshot_chunks(snapshot):
+    """
+    Returns:
+        set: Ids of the chunks a snapshot references
+    """
+    return {chunk_id for entry in snapshot['entries'] if entry['type'] == 'file' for chunk_id in entry['chunks']}
+
+
+def entries_below(snapshot, path):
+    """
+    Returns:
+        list: Manifest entries of path and everything below it
+    """
+    prefix = f"{path}{os.sep}"
+    return [entry for entry in snapshot['entries'] if entry['path'] == str(path) or entry['path'].startswith(prefix)]
@@ -1,8 +1,50 @@
+import hashlib
+import json
+import os
+import tempfile
 from os import environ
+from pathlib import Path
+
+CONFIG_SNAPSHOT_VERSION = 1
+# Resolved environment of the container, read by processes started without it such as cron jobs
+CONFIG_SNAPSHOT_PATH = Path('/etc/gitcubby/config_snapshot.json')
+SHELL_CONSTANTS_PATH = Path('/usr/local/bin/shell_utility/constants.py')
+
+# Set by entrypoint.py, the environment is authoritative and the snapshot is rewritten from it
+CONFIG_SOURCE_VARIABLE = 'GITCUBBY_CONFIG_SOURCE'
+
+_config_inputs = {}
+_git_shell_variables = {}
+_config_snapshot = None
+
+
+def config_from_environment():
+    return environ.get(CONFIG_SOURCE_VARIABLE) == 'environment'
+
+
+def load_config_snapshot():
+    """
+    Load the configuration snapshot once per process
+
+    Returns:
+        dict: Environment variable name to its raw value when the snapshot was written
+    """
+    global _config_snapshot
+    if _config_snapshot is None:
+        try:
+            snapshot = json.loads(CONFIG_SNAPSHOT_PATH.read_text())
+            _config_snapshot = snapshot['environment'] if snapshot.get('version') == CONFIG_SNAPSHOT_VERSION else {}
+        except (OSError, ValueError, KeyError):
+            _config_snapshot = {}
+    return _config_snapshot
+
 
 def get_env_stripped(key, default=None, cast=None, required=False):
     """
     Get environment variable, strip whitespace, and optionally cast type
+
+    Variables missing from the environment are taken from the configuration
+    snapshot, unless the environment is authoritative (the container init).
     
     Args:
         key: Environment variable name
@@ -15,6 +57,9 @@ def get_env_stripped(key, default=None, cast=None, required=False):
         ValueError: If cast fails
     """
     value = environ.get(key)
+    if value is None and not config_from_environment():
+        value = load_config_snapshot().get(key)
+    _config_inputs[key] = value
     
     if value is None:
         if required:
@@ -39,51 +84,118 @@ def get_env_stripped(key, default=None, cast=None, required=False):
     return value
 
 
-def set_environment_variable():
-    with open('/usr/local/bin/environment', 'w') as f:
-        f.write("#!/usr/bash")
-        for k in environ:
-            f.write(f"export {k}={environ.get(k)}\n") 
+def parse_bool(value):
+    """
+    Parse a boolean environment variable value
+
+    Args:
+        value: String such as true/false, yes/no, on/off or 1/0
+
+    Raises:
+        ValueError: If the value is not a recognised boolean
+    """
+    normalized = value.strip().lower()
+    if normalized in ('1', 'true', 'yes', 'on'):
+        return True
+    if normalized in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError(f"'{value}' is not a boolean")
+
+
+def _atomic_write(path, content, mode):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def _inputs_hash(data):
+    return hashlib.sha256(json.dumps([CONFIG_SNAPSHOT_VERSION, data], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _recorded_hash(path, marker):
+    """Read the inputs hash recorded in the header of a generated file"""
+    try:
+        with open(path) as f:
+            for _ in range(3):
+                line = f.readline()
+                if marker in line:
+                    return line.split(marker, 1)[1].strip().strip('",')
+    except OSError:
+        pass
+    return None
 
-import re
-from pathlib import Path
 
 def set_git_shell_variable(key, value, section=None):
     """
-    Set a variable in constants.py with optional section organization
+    Set a variable for shell_utility/constants.py with optional section organization
+
+    Variables are collected and written in one batch by write_config().
     
     Args:
         key: Variable name
         value: Variable value
         section: Optional section comment (e.g., "# Network Settings")
     """
-    constants_file = Path('/usr/local/bin/shell_utility/constants.py')
-    constants_file.parent.mkdir(parents=True, exist_ok=True)
-    
-    if constants_file.exists():
-        lines = constants_file.read_text().split('\n')
-    else:
-        lines = ['# Auto-generated constants', '']
-    
-    key_pattern = re.compile(rf'^\s*{re.escape(key)}\s*=')
-    found = False
-    new_lines = []
-    
-    for line in lines:
-        if key_pattern.match(line):
-            new_lines.append(f"{key} = {repr(value)}")
-            found = True
-        else:
-            new_lines.append(line)
-    
-    if not found:
-        # Add section header if provided and not exists
+    _git_shell_variables[key] = (value, section)
+
+
+def write_git_shell_constants(constants_file=SHELL_CONSTANTS_PATH):
+    """
+    Generate shell_utility/constants.py from the collected variables
+
+    The file is replaced atomically and only when a variable changed.
+
+    Returns:
+        bool: True if the file was written
+    """
+    variables = {key: value for key, (value, _) in _git_shell_variables.items()}
+    inputs_hash = _inputs_hash(variables)
+    if _recorded_hash(constants_file, '# Inputs: ') == inputs_hash:
+        return False
+
+    lines = ['# Auto-generated constants', f'# Version: {CONFIG_SNAPSHOT_VERSION}', f'# Inputs: {inputs_hash}', '']
+    sections = {}
+    for key, (value, section) in _git_shell_variables.items():
+        sections.setdefault(section, []).append(f"{key} = {repr(value)}")
+    for section, assignments in sections.items():
         if section:
-            if section not in '\n'.join(new_lines):
-                if new_lines and new_lines[-1].strip():
-                    new_lines.append('')
-                new_lines.append(section)
-        
-        new_lines.append(f"{key} = {repr(value)}")
-    
-    constants_file.write_text('\n'.join(new_lines) + '\n')
+            lines.append(section)
+        lines.extend(assignments)
+        lines.append('')
+    _atomic_write(constants_file, '\n'.join(lines), 0o644)
+    return True
+
+
+def write_config_snapshot(snapshot_file=CONFIG_SNAPSHOT_PATH):
+    """
+    Record the environment variables read by the constants for processes started without them
+
+    Only written by the container init and only when a value changed. The snapshot holds
+    the key material, it is readable by root only.
+
+    Returns:
+        bool: True if the snapshot was written
+    """
+    if not config_from_environment():
+        return False
+    environment = {key: value for key, value in _config_inputs.items() if value is not None}
+    inputs_hash = _inputs_hash(environment)
+    if _recorded_hash(snapshot_file, '"inputs": ') == inputs_hash:
+        return False
+    snapshot = {'inputs': inputs_hash, 'version': CONFIG_SNAPSHOT_VERSION, 'environment': environment}
+    _atomic_write(snapshot_file, json.dumps(snapshot, indent=0), 0o600)
+    return True
+
+
+def write_config():
+    """Write the shell constants and the configuration snapshot, called once the constants are resolved"""
+    write_git_shell_constants()
+    write_config_snapshot()
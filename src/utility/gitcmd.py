@@ -0,0 +1,45 @@
+import os
+import pwd
+import subprocess
+
+from .constants import USER
+
+
+def run_git(repo_path, *args, as_git_user=False, **kwargs):
+    """
+    Run a git command against a repository
+
+    The repositories are owned by the git user while the container init and
+    scheduled jobs run as root, so safe.directory is relaxed for these calls.
+
+    Args:
+        repo_path: Repository directory
+        *args: git sub command and arguments
+        as_git_user: Run the command as the git user when running as root, use for
+            commands that write into the repository
+        **kwargs: Passed to subprocess.run
+
+    Returns:
+        subprocess.CompletedProcess: The completed git process
+    """
+    cmd = ['git', '-c', 'safe.directory=*', '-C', str(repo_path), *args]
+    if as_git_user and os.geteuid() == 0:
+        kwargs.setdefault('user', USER)
+        kwargs.setdefault('group', USER)
+    return subprocess.run(cmd, **kwargs)
+
+
+def chown_to_git_user(path):
+    """
+    Give a directory tree to the git user, used after creating repositories as root
+
+    Args:
+        path: Root of the tree to change
+    """
+    if os.geteuid() != 0:
+        return
+    git_user = pwd.getpwnam(USER)
+    os.lchown(path, git_user.pw_uid, git_user.pw_gid)
+    for directory, dirs, files in os.walk(path):
+        for name in dirs + files:
+            os.lchown(os.path.join(directory, name), git_user.pw_uid, git_user.pw_gid)
@@ -0,0 +1,129 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from shell_utility.locks import RepoLock
+from shell_utility.repository import iter_repositories, repo_fingerprint
+from shell_utility.util import atomic_write_text
+
+from . import GCLogger
+from .constants import (INTEGRITY_STATE_PATH, INTEGRITY_TIMEOUT_SECONDS, INTEGRITY_WORKERS, PRIVATE_REPO_ROOT,
+    PUBLIC_REPO_ROOT)
+from .maintenance import MAINTENANCE_LOCK_NAME
+from .process import run_process
+
+gc_logger = GCLogger(__name__)
+logger = gc_logger.get_logger()
+
+# Checks that every ref reaches a complete history, without inflating the objects
+CONNECTIVITY_CHECK = ['fsck', '--connectivity-only', '--no-dangling', '--no-progress']
+# Also hashes and parses every object
+FULL_CHECK = ['fsck', '--no-dangling', '--no-progress']
+
+
+class GCIntegrityCheck():
+    """git fsck of every repository on a bounded pool of processes
+
+    Results are cached by repository fingerprint, so only repositories whose refs
+    or packs changed since their last successful check are checked again. A full
+    check result also covers a later connectivity check, not the other way round.
+    Failed repositories are checked on every run until they pass.
+    """
+
+    def __init__(self, state_path=INTEGRITY_STATE_PATH):
+        self.state_path = Path(state_path)
+
+    def load_state(self):
+        try:
+            return json.loads(self.state_path.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def repositories(self):
+        repositories = []
+        for repo_root in (PRIVATE_REPO_ROOT, PUBLIC_REPO_ROOT):
+            for repo_name in iter_repositories(repo_root):
+                repositories.append(Path(repo_root) / repo_name)
+        return repositories
+
+    def is_current(self, result, fingerprint, full):
+        return (result is not None and result['ok'] and result['fingerprint'] == fingerprint
+            and (result['full'] or not full))
+
+    def check_repository(self, repo_path, full=False):
+        """
+        Run git fsck on a repository
+
+        Args:
+            repo_path: Repository directory
+            full: Check every object instead of the connectivity only
+
+        Returns:
+            dict: Fingerprint, mode, outcome and the last error line of the check
+        """
+        # Taken shared like backups, a repack never removes a pack mid-check
+        with RepoLock(repo_path, MAINTENANCE_LOCK_NAME, shared=True):
+            fingerprint = repo_fingerprint(repo_path)
+            check = FULL_CHECK if full else CONNECTIVITY_CHECK
+            result = run_process(['git', '-c', 'safe.directory=*', '-C', str(repo_path), *check],
+                INTEGRITY_TIMEOUT_SECONDS, f"Integrity check of {repo_path}")
+        # fsck reports broken objects on stdout, stderr mostly carries notices such as an unborn HEAD
+        problems = [line for line in result.tail if not line.startswith('notice:')]
+        error = None if result.success else (problems[-1] if problems else result.last_error)
+        if result.success:
+            logger.info(f"Integrity check of {repo_path} passed in {result.duration:.1f}s")
+        else:
+            logger.error(f"Integrity check of {repo_path} failed: {error}")
+        return {
+            'fingerprint': fingerprint,
+            'full': full,
+            'ok': result.success,
+            'error': error,
+            'checked': time.time(),
+        }
+
+    def check(self, paths=None, full=False, force=False):
+        """
+        Check repositories, skipping those unchanged since their last successful check
+
+        Args:
+            paths: Repository directories to check, all repositories if not given
+            full: Check every object instead of the connectivity only
+            force: Check unchanged repositories as well
+
+        Returns:
+            dict: Repository path to True if it passed
+        """
+        state = self.load_state()
+        paths = [Path(path) for path in paths] if paths is not None else self.repositories()
+        pending = [path for path in paths
+            if force or not self.is_current(state.get(str(path)), repo_fingerprint(path), full)]
+        logger.info(f"Checking {len(pending)} of {len(paths)} repositories with {INTEGRITY_WORKERS} worker(s).")
+
+        with ThreadPoolExecutor(max_workers=INTEGRITY_WORKERS) as executor:
+            results = dict(zip(pending, executor.map(lambda path: self.check_repository(path, full), pending)))
+
+        # Reloaded, another check may have finished meanwhile
+        state = self.load_state()
+        known = {str(path) for path in self.repositories()}
+        state = {path: result for path, result in state.items() if path in known}
+        for path, result in results.items():
+            state[str(path)] = result
+        atomic_write_text(self.state_path, json.dumps(state, indent=2, sort_keys=True), mode=0o600)
+        return {path: state.get(str(path), {}).get('ok', False) for path in paths}
+
+    def run(self, full=False, force=False):
+        """
+        Check every repository
+
+        Returns:
+            bool: True if every repository passed
+        """
+        results = self.check(full=full, force=force)
+        failed = [str(path) for path, ok in results.items() if not ok]
+        if failed:
+            logger.error(f"Integrity check failed for {len(failed)} repository(s): {', '.join(failed)}")
+            return False
+        logger.info(f"Integrity check of {len(results)} repository(s) passed")
+        return True
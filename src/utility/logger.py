@@ -1,60 +1,255 @@
+import atexit
+import gzip
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import shutil
 import sys
-from pathlib import Path
+import threading
+import time
+from datetime import datetime, timezone
+
+# Imported first, it generates shell_utility/constants.py
+from .constants import (LOG_FILE_PATH, LOG_FORMAT, DATE_FORMAT, LOG_BACKUP_COUNT, LOG_JSON, LOG_LEVEL, LOG_LEVELS,
+    LOG_MAX_MB, LOG_QUEUE_SIZE, LOG_ROTATE_HOURS)
+from shell_utility.locks import RepoLock
+
+LOG_ROTATE_LOCK_NAME = 'rotate'
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def parse_log_level(name, default=logging.INFO):
+    level = logging.getLevelName(str(name).strip().upper())
+    return level if isinstance(level, int) else default
+
+
+def parse_component_levels(value):
+    """
+    Parse LOG_LEVELS
+
+    Returns:
+        dict: Component name to log level
+    """
+    levels = {}
+    for item in value.split(','):
+        component, _, level = item.partition('=')
+        if component.strip() and level.strip():
+            levels[component.strip()] = parse_log_level(level)
+    return levels
+
+
+def resolve_log_level(name, component_levels=None):
+    """
+    Log level of a logger from LOG_LEVEL and LOG_LEVELS
+
+    A component matches a logger of the same name, its children and a logger whose
+    last part it is, so backup matches utility.backup.
+
+    Args:
+        name: Logger name, usually a module __name__
+        component_levels: Parsed LOG_LEVELS, read from the environment if not given
+
+    Returns:
+        int: Log level
+    """
+    if component_levels is None:
+        component_levels = parse_component_levels(LOG_LEVELS)
+    for component, level in component_levels.items():
+        if name == component or name.startswith(f"{component}.") or name.rsplit('.', 1)[-1] == component:
+            return level
+    return parse_log_level(LOG_LEVEL)
+
+
+def compress_log(source, dest):
+    """Rotator of GCRotatingFileHandler, gzips the rotated log"""
+    pending = f"{source}.rotating"
+    # Renamed first so writers of other processes move to the new file while it is compressed
+    os.rename(source, pending)
+    with open(pending, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.chmod(dest, 0o644)
+    os.unlink(pending)
+
+
+class GCJsonFormatter(logging.Formatter):
+    """One JSON object per record, structured fields passed as extra={'fields': {...}} are kept"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry['fields'] = fields
+        return json.dumps(entry, default=str)
+
+
+class GCRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Log file rotated by size and time, shared by all GitCubby processes
+
+    Rotated files are gzip compressed. The entrypoint, cron jobs and the resident
+    processes write the same file, so a rotation is done by one process under a
+    lock and the others reopen the log when its inode changes. Time based rotation
+    happens on the first record of a new period, periods start at midnight UTC.
+    """
+
+    def __init__(self, filename, max_bytes=0, rotate_seconds=0, backup_count=0):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+        self.rotate_seconds = rotate_seconds
+        self.inode = None
+        self.namer = lambda name: f"{name}.gz"
+        self.rotator = compress_log
+
+    def _open(self):
+        created = not os.path.exists(self.baseFilename)
+        stream = super()._open()
+        if created:
+            try:
+                # Processes of the git user log as well
+                os.chmod(self.baseFilename, 0o666)
+            except OSError:
+                pass
+        self.inode = os.fstat(stream.fileno()).st_ino
+        return stream
+
+    def due(self, stat, size):
+        if self.maxBytes > 0 and stat.st_size + size >= self.maxBytes:
+            return True
+        if self.rotate_seconds > 0 and stat.st_size > 0:
+            return int(stat.st_mtime // self.rotate_seconds) != int(time.time() // self.rotate_seconds)
+        return False
+
+    def shouldRollover(self, record):
+        try:
+            stat = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            stat = None
+        if self.stream is not None and (stat is None or stat.st_ino != self.inode):
+            # Rotated by another process
+            self.stream.close()
+            self.stream = None
+        if stat is None:
+            return False
+        return self.due(stat, len(self.format(record)) + 1)
+
+    def doRollover(self):
+        with RepoLock(self.baseFilename, LOG_ROTATE_LOCK_NAME):
+            try:
+                stat = os.stat(self.baseFilename)
+            except FileNotFoundError:
+                return
+            # Another process may have rotated while this one waited for the lock
+            if not self.due(stat, 0):
+                if self.stream is not None and stat.st_ino != self.inode:
+                    self.stream.close()
+                    self.stream = None
+                return
+            super().doRollover()
+
+
+class GCQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the background writer, drops them instead of blocking when the queue is full"""
+
+    def __init__(self, record_queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': f"Dropped {self.dropped} log records, the log writer fell behind"}))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def start_pipeline():
+    """
+    Start the background log writer of this process once
+
+    Returns:
+        GCQueueHandler: Handler attached to every GCLogger
+    """
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is not None:
+            return _pipeline
+
+        if not LOG_FILE_PATH.exists():
+            LOG_FILE_PATH.parent.mkdir(parents=True, exist_ok=True)
+
+        file_handler = GCRotatingFileHandler(str(LOG_FILE_PATH), max_bytes=LOG_MAX_MB * 1024 * 1024,
+            rotate_seconds=LOG_ROTATE_HOURS * 3600, backup_count=max(LOG_BACKUP_COUNT, 1))
+        file_handler.setLevel(logging.DEBUG)
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setLevel(logging.DEBUG)
+        if LOG_JSON:
+            file_handler.setFormatter(GCJsonFormatter())
+            console_handler.setFormatter(GCJsonFormatter())
+        else:
+            file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT))
+            console_handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+
+        record_queue = queue.Queue(maxsize=max(LOG_QUEUE_SIZE, 1))
+        listener = logging.handlers.QueueListener(record_queue, file_handler, console_handler,
+            respect_handler_level=True)
+        listener.start()
+        # Flushes the queue when the process exits
+        atexit.register(listener.stop)
+        _pipeline = GCQueueHandler(record_queue)
+        return _pipeline
 
-from .constants import LOG_FILE_PATH, LOG_FORMAT, DATE_FORMAT
 
 class GCLogger:
+    """Module logger writing to main.log and stdout through a background writer
 
-    def __init__(self, name, log_level=logging.INFO):
+    Log calls only put the record on a bounded queue, a thread of the process
+    formats and writes it, so no caller waits on disk or a slow stdout.
+    """
+
+    def __init__(self, name, log_level=None):
+        """
+        Args:
+            name: Usually __name__ from the calling module
+            log_level: Overrides the level from LOG_LEVEL and LOG_LEVELS
+        """
         self.logger = logging.getLogger(name)
         self.get_logger()
-        self.set_log_level(log_level)
+        self.set_log_level(log_level if log_level is not None else resolve_log_level(name))
 
 
     def get_logger(self):
         """
         Get a logger instance for a module
-        
-        Args:
-            name: Usually __name__ from the calling module
-        
+
         Returns:
             logging.Logger: Configured logger instance
         """
-        
+
         # Only configure if not already configured
         if not self.logger.handlers:
-        
-            if not LOG_FILE_PATH.exists():
-                LOG_FILE_PATH.parent.mkdir(parents=True, exist_ok=True)
-                LOG_FILE_PATH.touch()
-                LOG_FILE_PATH.chmod(0o666)
-
-            self.logger.setLevel(logging.INFO)
-            
-            # File handler
-            file_handler = logging.FileHandler(str(LOG_FILE_PATH))
-            file_handler.setLevel(logging.DEBUG)
-            file_formatter = logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT)
-            file_handler.setFormatter(file_formatter)
-            
-            # Console handler (for errors and warnings)
-            console_handler = logging.StreamHandler(sys.stdout)
-            console_handler.setLevel(logging.INFO)
-            console_formatter = logging.Formatter('%(levelname)s: %(message)s')
-            console_handler.setFormatter(console_formatter)
-            
-            self.logger.addHandler(file_handler)
-            self.logger.addHandler(console_handler)
-        
+            self.logger.addHandler(start_pipeline())
+
         return self.logger
 
     def set_log_level(self,level):
         """
         Set the global log level
-        
+
         Args:
             level: logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR
         """
-        self.logger.setLevel(level)
\ No newline at end of file
+        self.logger.setLevel(level)
@@ -0,0 +1,157 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from shell_utility.forks import find_forks, fork_parent
+from shell_utility.locks import RepoLock
+from shell_utility.repository import iter_repositories, repo_fingerprint
+from shell_utility.util import atomic_write_text
+
+from . import GCLogger, GCStateManager
+from .constants import (MAINTENANCE_COMPONENT_NAME, MAINTENANCE_SCHEDULE, MAINTENANCE_STATE_PATH, MAINTENANCE_WORKERS,
+    MAINTENANCE_SCRIPT_NAME, PERIODIC_ROOT_PATH, PERIODIC_WANTED_MAINTENANCE_SCRIPT_PATH, PRIVATE_REPO_ROOT,
+    PUBLIC_REPO_ROOT)
+from .gitcmd import run_git
+
+gc_logger = GCLogger(__name__)
+logger = gc_logger.get_logger()
+
+MAINTENANCE_LOCK_NAME = 'maintenance'
+
+# Each step runs as the git user so repacked files keep their owner
+MAINTENANCE_STEPS = [
+    # Roll loose objects and small packs into a geometric progression of packs,
+    # covered by a multi-pack-index with a reachability bitmap
+    ['repack', '-d', '-l', '--geometric=2', '--write-midx', '--write-bitmap-index'],
+    ['commit-graph', 'write', '--reachable', '--split', '--changed-paths'],
+    ['pack-refs', '--all'],
+    ['prune', '--expire=2.weeks.ago'],
+]
+
+
+def maintenance_steps(is_fork, has_forks):
+    """
+    Adapt MAINTENANCE_STEPS to a repository sharing objects through git alternates
+
+    A fork's packs never hold the objects it borrows, so it gets no reachability
+    bitmap. A parent is never pruned, its forks may still need objects it dropped.
+
+    Returns:
+        list: The steps to run
+    """
+    steps = []
+    for step in MAINTENANCE_STEPS:
+        if is_fork and step[0] == 'repack':
+            step = [arg for arg in step if arg != '--write-bitmap-index']
+        if has_forks and step[0] == 'prune':
+            continue
+        steps.append(step)
+    return steps
+
+
+class GCMaintenance():
+    """Scheduled repack, bitmap, commit-graph and pruning of every repository
+
+    Repositories whose fingerprint has not changed since their last maintenance are
+    skipped. Each repository is maintained under its maintenance lock, backups take
+    the same lock shared so they never read a repository mid-repack.
+    """
+
+    def __init__(self):
+        self.state_manager = GCStateManager(MAINTENANCE_COMPONENT_NAME)
+
+    def is_configured(self):
+        """
+        Check if Maintenance is configured
+
+        Returns:
+            bool: True if Maintenance is configured
+        """
+        return self.state_manager.is_configured()
+
+    def configure_maintenance_schedule(self):
+        logger.info(f"Configuring maintenance schedule to {MAINTENANCE_SCHEDULE.upper()}.")
+        if (PERIODIC_WANTED_MAINTENANCE_SCRIPT_PATH.exists()):
+            logger.debug("Maintenance schedule already configured.")
+            return
+
+        for path in PERIODIC_ROOT_PATH.iterdir():
+            script_link_path = path / MAINTENANCE_SCRIPT_NAME
+            if script_link_path.exists(): script_link_path.unlink()
+        try:
+            PERIODIC_WANTED_MAINTENANCE_SCRIPT_PATH.symlink_to('/usr/local/bin/maintenance')
+            self.state_manager.mark_configured()
+        except Exception as e:
+            logger.exception(f"Failed to configure maintenance schedule: {e}")
+            if self.is_configured():
+                self.state_manager.mark_unconfigured()
+
+    def load_state(self):
+        try:
+            return json.loads(Path(MAINTENANCE_STATE_PATH).read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def repositories(self):
+        repositories = []
+        for repo_root in (PRIVATE_REPO_ROOT, PUBLIC_REPO_ROOT):
+            for repo_name in iter_repositories(repo_root):
+                repositories.append(Path(repo_root) / repo_name)
+        return repositories
+
+    def maintain_repository(self, repo_path, has_forks=False):
+        """
+        Run the maintenance steps on a repository
+
+        Args:
+            repo_path: Repository directory
+            has_forks: True if other repositories borrow objects from this one
+
+        Returns:
+            str: Fingerprint after maintenance, or None if a step failed
+        """
+        start = time.monotonic()
+        with RepoLock(repo_path, MAINTENANCE_LOCK_NAME):
+            for step in maintenance_steps(fork_parent(repo_path) is not None, has_forks):
+                result = run_git(repo_path, *step, as_git_user=True, capture_output=True, text=True)
+                if result.returncode != 0:
+                    logger.error(f"Maintenance step '{step[0]}' failed for {repo_path}: {result.stderr.strip()}")
+                    return None
+            fingerprint = repo_fingerprint(repo_path)
+        logger.info(f"Maintained {repo_path} in {time.monotonic() - start:.1f}s")
+        return fingerprint
+
+    def run(self, force=False):
+        """
+        Maintain every repository that changed since its last maintenance
+
+        Args:
+            force: Maintain all repositories
+
+        Returns:
+            bool: True if every repository was maintained successfully
+        """
+        state = self.load_state()
+        repositories = self.repositories()
+        pending = [path for path in repositories if force or state.get(str(path)) != repo_fingerprint(path)]
+        logger.info(f"Maintaining {len(pending)} of {len(repositories)} repositories with {MAINTENANCE_WORKERS} worker(s).")
+
+        parents = find_forks()
+        with ThreadPoolExecutor(max_workers=MAINTENANCE_WORKERS) as executor:
+            fingerprints = dict(zip(pending, executor.map(
+                lambda path: self.maintain_repository(path, has_forks=str(path) in parents), pending)))
+
+        # Forget removed repositories, keep the previous fingerprint of failed ones
+        known = {str(path) for path in repositories}
+        state = {path: fingerprint for path, fingerprint in state.items() if path in known}
+        for path, fingerprint in fingerprints.items():
+            if fingerprint:
+                state[str(path)] = fingerprint
+        atomic_write_text(MAINTENANCE_STATE_PATH, json.dumps(state, indent=2, sort_keys=True), mode=0o600)
+
+        failed = [path for path, fingerprint in fingerprints.items() if fingerprint is None]
+        if failed:
+            logger.error(f"Maintenance failed for {len(failed)} repository(s)")
+            return False
+        return True
@@ -0,0 +1,79 @@
+import hashlib
+import json
+from pathlib import Path
+
+from shell_utility.repository import iter_repositories, repo_fingerprint
+from shell_utility.util import atomic_write_text
+
+from . import GCLogger
+from .constants import BACKUP_PATHS, BACKUP_MANIFEST_PATH
+
+gc_logger = GCLogger(__name__)
+logger = gc_logger.get_logger()
+
+
+class GCBackupManifest():
+    """Per-repository fingerprints recorded after each successful backup
+
+    Each repository below a directory in BACKUP_PATHS is fingerprinted from its refs,
+    packed-refs and pack checksums, other files by their content. Comparing the current
+    fingerprints with the recorded ones tells which paths changed since the last backup.
+    """
+
+    def __init__(self, manifest_path=BACKUP_MANIFEST_PATH):
+        self.manifest_path = Path(manifest_path)
+
+    def load(self):
+        """
+        Load the fingerprints recorded by the last successful backup
+
+        Returns:
+            dict: Path to fingerprint mapping, empty if no backup was recorded
+        """
+        try:
+            return json.loads(self.manifest_path.read_text()).get('fingerprints', {})
+        except (OSError, ValueError):
+            return {}
+
+    def current(self, backup_paths=BACKUP_PATHS):
+        """
+        Fingerprint the current state of the backup paths
+
+        Returns:
+            dict: Path to fingerprint mapping
+        """
+        fingerprints = {}
+        for backup_path in backup_paths:
+            path = Path(backup_path)
+            if path.is_dir():
+                for repo_name in iter_repositories(path):
+                    fingerprints[str(path / repo_name)] = repo_fingerprint(path / repo_name)
+            elif path.is_file():
+                fingerprints[str(path)] = hashlib.sha256(path.read_bytes()).hexdigest()
+        return fingerprints
+
+    def changed(self, current, recorded=None):
+        """
+        List the paths whose fingerprint differs from the recorded one
+
+        Args:
+            current: Fingerprints from current()
+            recorded: Previously recorded fingerprints, loaded from disk if not given
+
+        Returns:
+            list: Sorted paths that were added, changed or removed
+        """
+        if recorded is None:
+            recorded = self.load()
+        paths = set(current) | set(recorded)
+        return sorted(path for path in paths if current.get(path) != recorded.get(path))
+
+    def record(self, fingerprints):
+        """
+        Record fingerprints after a successful backup
+
+        Args:
+            fingerprints: Fingerprints taken before the backup started
+        """
+        atomic_write_text(self.manifest_path, json.dumps({'fingerprints': fingerprints}, indent=2, sort_keys=True), mode=0o600)
+        logger.debug(f"Recorded backup manifest with {len(fingerprints)} entries")
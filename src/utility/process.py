@@ -0,0 +1,261 @@
+import os
+import re
+import selectors
+import signal
+import subprocess
+import time
+from collections import deque
+
+from . import GCLogger
+
+gc_logger = GCLogger(__name__)
+logger = gc_logger.get_logger()
+
+# Longest output line kept in one piece, longer lines are split
+MAX_LINE_BYTES = 8192
+# Output lines kept for the result summary
+TAIL_LINES = 20
+# Seconds between progress messages of a long running process
+PROGRESS_LOG_INTERVAL = 30
+# Seconds a process group gets to exit after SIGTERM before it is killed
+KILL_GRACE_SECONDS = 10
+
+# Progress line printed by duplicity --progress, e.g.
+# 5.1MB 00:00:12 [417.0KB/s] [=====>     ] 53% ETA 10sec
+DUPLICITY_PROGRESS_PATTERN = re.compile(
+    r'(?P<size>[\d.]+)\s*(?P<unit>[KMGT]?B) (?P<elapsed>\d+:\d\d:\d\d) \[(?P<speed>[^\]]*)\] '
+    r'\[[^\]]*\] (?P<percent>\d+)% ETA (?P<eta>.+?)\s*$')
+# Volume messages and volume file names of backups and restores, e.g. Processed volume 3
+DUPLICITY_VOLUME_PATTERN = re.compile(r'(?:Processed volume |\.vol)(?P<number>\d+)\b')
+# Lines of the statistics block printed after a backup, e.g. TotalDestinationSizeChange 1234 (1.21 KB)
+DUPLICITY_STATISTIC_PATTERN = re.compile(r'^(?P<name>[A-Z][A-Za-z]+) (?P<value>-?\d+(?:\.\d+)?)(?: \(.*\))?$')
+DUPLICITY_STATISTICS = ('StartTime', 'EndTime', 'ElapsedTime', 'SourceFiles', 'SourceFileSize', 'NewFiles',
+    'NewFileSize', 'DeletedFiles', 'ChangedFiles', 'ChangedFileSize', 'ChangedDeltaSize', 'DeltaEntries',
+    'RawDeltaSize', 'TotalDestinationSizeChange', 'Errors')
+UNIT_BYTES = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+
+
+def parse_eta(value):
+    """
+    Returns:
+        int: Seconds of an ETA such as 1h2min, 10min3sec or 10sec, None if duplicity has no estimate
+    """
+    match = re.fullmatch(r'(?:(\d+)h)?(?:(\d+)min)?(?:(\d+)sec)?', value.strip())
+    if not match or not any(match.groups()):
+        return None
+    hours, minutes, seconds = (int(group or 0) for group in match.groups())
+    return hours * 3600 + minutes * 60 + seconds
+
+
+class DuplicityOutputParser():
+    """Turns duplicity output lines into progress events and collects its statistics
+
+    Recognizes the progress lines of --progress, volume messages and the statistics
+    block of a backup. Only the latest progress and the statistics are kept, memory
+    does not grow with the output.
+    """
+
+    def __init__(self):
+        self.volumes = 0
+        self.progress = None
+        self.stats = {}
+
+    def feed(self, line):
+        """
+        Args:
+            line: Output line without line ending
+
+        Returns:
+            dict: Event with a type of progress, volume or statistic, or None for other lines
+        """
+        match = DUPLICITY_PROGRESS_PATTERN.search(line)
+        if match:
+            self.progress = {
+                'type': 'progress',
+                'percent': int(match.group('percent')),
+                'bytes': int(float(match.group('size')) * UNIT_BYTES[match.group('unit')]),
+                'speed': match.group('speed'),
+                'eta': parse_eta(match.group('eta')),
+            }
+            return self.progress
+        match = DUPLICITY_VOLUME_PATTERN.search(line)
+        if match:
+            self.volumes = max(self.volumes, int(match.group('number')))
+            return {'type': 'volume', 'volumes': self.volumes}
+        match = DUPLICITY_STATISTIC_PATTERN.match(line)
+        if match and match.group('name') in DUPLICITY_STATISTICS:
+            value = float(match.group('value'))
+            self.stats[match.group('name')] = int(value) if value.is_integer() else value
+            return {'type': 'statistic', 'name': match.group('name'), 'value': self.stats[match.group('name')]}
+        return None
+
+    @property
+    def destination_bytes(self):
+        """Bytes added to the backup target by a backup, 0 if duplicity reported none"""
+        return max(0, self.stats.get('TotalDestinationSizeChange', 0))
+
+    def summary(self):
+        parts = []
+        if self.volumes:
+            parts.append(f"{self.volumes} volume(s)")
+        if 'TotalDestinationSizeChange' in self.stats:
+            parts.append(f"{self.destination_bytes} bytes written")
+        if self.stats.get('Errors'):
+            parts.append(f"{self.stats['Errors']} error(s)")
+        return ', '.join(parts)
+
+
+class GCProcessResult():
+    """Outcome of run_process, a compact summary instead of the full output"""
+
+    def __init__(self, returncode, duration, timed_out, tail, error_tail, parser=None):
+        self.returncode = returncode
+        self.duration = duration
+        self.timed_out = timed_out
+        self.tail = tail
+        self.error_tail = error_tail
+        self.parser = parser
+
+    @property
+    def last_error(self):
+        """Last stderr line, or the last output line if there was none"""
+        lines = self.error_tail or self.tail
+        return lines[-1] if lines else 'no output'
+
+    @property
+    def success(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def summary(self):
+        details = [f"{self.duration:.1f}s"]
+        if self.parser and self.parser.summary():
+            details.append(self.parser.summary())
+        return ', '.join(details)
+
+
+def kill_process_group(process):
+    """Terminate the process and everything it started, e.g. the gpg children of duplicity"""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    try:
+        process.wait(timeout=KILL_GRACE_SECONDS)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    process.wait()
+
+
+def run_process(cmd, timeout, description, parser=None, **popen_kwargs):
+    """
+    Run a command, streaming its output into the log line by line
+
+    stdout is logged at debug and stderr at warning level while the command runs.
+    Memory stays bounded, only the last TAIL_LINES lines and the parser state are
+    kept. The command runs in its own process group, on timeout the whole group is
+    terminated and killed after KILL_GRACE_SECONDS.
+
+    Args:
+        cmd: Command to run
+        timeout: Timeout in seconds, None waits forever
+        description: Short description used in log messages
+        parser: Optional parser with a feed(line) method returning events, e.g. DuplicityOutputParser
+        **popen_kwargs: Passed to subprocess.Popen
+
+    Returns:
+        GCProcessResult: Exit code, duration, timeout and the last output and stderr lines
+    """
+    start = time.monotonic()
+    deadline = start + timeout if timeout else None
+    tail = deque(maxlen=TAIL_LINES)
+    error_tail = deque(maxlen=TAIL_LINES)
+    process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        start_new_session=True, **popen_kwargs)
+
+    selector = selectors.DefaultSelector()
+    buffers = {}
+    for stream, level in ((process.stdout, 'debug'), (process.stderr, 'warning')):
+        os.set_blocking(stream.fileno(), False)
+        selector.register(stream, selectors.EVENT_READ, level)
+        buffers[stream] = b''
+
+    timed_out = False
+    last_progress_log = start
+
+    def handle_line(raw, level):
+        nonlocal last_progress_log
+        line = raw.decode(errors='replace').rstrip('\r')
+        if not line.strip():
+            return
+        tail.append(line)
+        if level == 'warning':
+            error_tail.append(line)
+        event = parser.feed(line) if parser else None
+        if event and event['type'] == 'progress':
+            # Progress lines come every few seconds, a summary every PROGRESS_LOG_INTERVAL is enough
+            if time.monotonic() - last_progress_log >= PROGRESS_LOG_INTERVAL:
+                last_progress_log = time.monotonic()
+                eta = f", ETA {event['eta']}s" if event['eta'] is not None else ''
+                logger.info(f"{description}: {event['percent']}% done{eta}", extra={'fields': event})
+            return
+        getattr(logger, level)(f"{description}: {line}", extra={'fields': event} if event else None)
+
+    try:
+        while selector.get_map():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 and not timed_out:
+                    timed_out = True
+                    logger.error(f"{description} timed out after {timeout} seconds, killing it")
+                    kill_process_group(process)
+                    # The pipes are closed now, read what is left without waiting
+                    remaining = 0
+            for key, _ in selector.select(timeout=remaining if remaining is None else max(remaining, 0)):
+                stream = key.fileobj
+                chunk = os.read(stream.fileno(), 65536)
+                if not chunk:
+                    selector.unregister(stream)
+                    if buffers[stream]:
+                        handle_line(buffers[stream], key.data)
+                    continue
+                data = buffers[stream] + chunk
+                # duplicity redraws its progress line with carriage returns
+                lines = data.replace(b'\r', b'\n').split(b'\n')
+                buffers[stream] = lines.pop()
+                while len(buffers[stream]) > MAX_LINE_BYTES:
+                    lines.append(buffers[stream][:MAX_LINE_BYTES])
+                    buffers[stream] = buffers[stream][MAX_LINE_BYTES:]
+                for line in lines:
+                    handle_line(line, key.data)
+            if timed_out and process.poll() is not None:
+                break
+    finally:
+        selector.close()
+        process.stdout.close()
+        process.stderr.close()
+        if process.poll() is None:
+            kill_process_group(process)
+
+    returncode = process.wait()
+    return GCProcessResult(returncode, time.monotonic() - start, timed_out, list(tail), list(error_tail), parser)
+
+
+def run_duplicity_process(cmd, timeout, description):
+    """
+    Run duplicity through run_process and log a summary
+
+    Returns:
+        GCProcessResult: Result, its parser is a DuplicityOutputParser
+    """
+    logger.debug(f"Running {description}: {' '.join(cmd[:2])}")
+    result = run_process(cmd, timeout, description, parser=DuplicityOutputParser())
+    if result.success:
+        logger.info(f"{description} completed successfully in {result.summary()}")
+    elif not result.timed_out:
+        logger.error(f"{description} failed with exit code {result.returncode} after {result.summary()}: "
+                     f"{result.last_error}")
+    return result
@@ -0,0 +1,462 @@
+import hashlib
+import json
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import yaml
+
+from shell_utility.catalog import REPO_TYPES, RepoCatalog, repo_key, repo_key_for_path, repo_root_for
+from shell_utility.credentials import CredentialStore, digest_hash
+from shell_utility.forks import dissociate_fork, fork_parent, relink_forks, repo_forks, update_parent_config
+from shell_utility.repository import is_repository, iter_repositories
+from shell_utility.replication import is_replica
+from shell_utility.restore_status import read_restore_status, restore_in_progress
+from shell_utility.util import atomic_write_text, clean_repo_name
+
+from . import GCLogger
+from .constants import (PROVISIONING_MANIFEST, PROVISIONING_POLL_INTERVAL, PROVISIONING_STATE_PATH,
+    PROVISIONING_WORKERS, REALM)
+from .gitcmd import chown_to_git_user, run_git
+
+gc_logger = GCLogger(__name__)
+logger = gc_logger.get_logger()
+
+YAML_SUFFIXES = ('.yaml', '.yml')
+RESTORE_WAIT_SECONDS = 10
+
+
+def valid_username(username):
+    """Same rule as createwebuser, letters, numbers, dash and underscore"""
+    return isinstance(username, str) and bool(username) and username.replace('-', '').replace('_', '').isalnum()
+
+
+def parse_repository(entry):
+    """
+    Returns:
+        tuple: Catalog key of the repository and of the repository it is renamed from, or None
+
+    Raises:
+        ValueError: If the entry is not a valid repository
+    """
+    if not isinstance(entry, dict) or not isinstance(entry.get('name'), str):
+        raise ValueError(f"Repository entries need a name: {entry!r}")
+    repo_type = entry.get('type', 'private')
+    if repo_type not in REPO_TYPES:
+        raise ValueError(f"Repository {entry['name']} has type {repo_type!r}, expected one of {', '.join(REPO_TYPES)}")
+
+    def key_for(name):
+        name = clean_repo_name(name.strip('/'))
+        parts = Path(name).parts
+        # Hidden directories hold restores, snapshots and replica staging
+        if not parts or any(part.startswith('.') for part in parts) or Path(name).is_absolute():
+            raise ValueError(f"Invalid repository name {name!r}")
+        return repo_key(repo_type, f"{name}.git")
+
+    renamed_from = entry.get('renamed_from')
+    return key_for(entry['name']), key_for(renamed_from) if isinstance(renamed_from, str) else None
+
+
+def parse_user(entry):
+    """
+    Returns:
+        tuple: Username and password hash
+
+    Raises:
+        ValueError: If the entry is not a valid user
+    """
+    # The entry itself is not shown, it holds a password hash
+    name = entry.get('name') if isinstance(entry, dict) else None
+    if not valid_username(name):
+        raise ValueError(f"User entries need a name of letters, numbers, dash and underscore, got {name!r}")
+    username = entry['name']
+    if isinstance(entry.get('password_hash'), str):
+        return username, entry['password_hash'].strip()
+    if isinstance(entry.get('password_file'), str):
+        # Keeps the password itself out of the manifest, e.g. a mounted secret
+        try:
+            password = Path(entry['password_file']).read_text().rstrip('\n')
+        except OSError as e:
+            raise ValueError(f"Password file of user {username} is not readable: {e}")
+        if not password:
+            raise ValueError(f"Password file of user {username} is empty")
+        return username, digest_hash(username, password, REALM)
+    raise ValueError(f"User {username} needs a password_hash or a password_file")
+
+
+def load_manifest(manifest_path):
+    """
+    Read and validate a provisioning manifest
+
+    Example:
+        repositories:
+          - name: team/project
+            type: private
+          - name: website
+            type: public
+            renamed_from: site
+        users:
+          - name: alice
+            password_hash: b13cb531f2fb68a845275222149d26f1  # md5 of alice:git:password
+          - name: ci
+            password_file: /run/secrets/ci_password
+        prune:
+          repositories: false
+          users: true
+
+    Returns:
+        dict: Repository keys to the key they are renamed from, usernames to password
+            hashes and the prune flags
+
+    Raises:
+        ValueError: If the manifest cannot be parsed or holds invalid entries
+    """
+    manifest_path = Path(manifest_path)
+    text = manifest_path.read_text()
+    try:
+        data = yaml.safe_load(text) if manifest_path.suffix in YAML_SUFFIXES else json.loads(text)
+    except (yaml.YAMLError, ValueError) as e:
+        raise ValueError(f"{manifest_path} is not valid: {e}")
+    data = data or {}
+    if not isinstance(data, dict):
+        raise ValueError(f"{manifest_path} must hold a mapping")
+
+    repositories = {}
+    for entry in data.get('repositories') or []:
+        key, renamed_from = parse_repository(entry)
+        if key in repositories:
+            raise ValueError(f"Repository {key} is listed twice")
+        repositories[key] = renamed_from
+    users = {}
+    for entry in data.get('users') or []:
+        username, password_hash = parse_user(entry)
+        if username in users:
+            raise ValueError(f"User {username} is listed twice")
+        users[username] = password_hash
+    prune = data.get('prune') or {}
+    if not isinstance(prune, dict):
+        raise ValueError("prune must map repositories and users to true or false")
+    return {
+        'repositories': repositories,
+        'users': users,
+        'prune_repositories': prune.get('repositories') is True,
+        'prune_users': prune.get('users') is True,
+    }
+
+
+def repo_path_for(key):
+    repo_type, repo_name = key.split('/', 1)
+    return Path(repo_root_for(repo_type)) / repo_name
+
+
+def make_parent(repo_path):
+    """Create the missing parent directories of a repository, owned by the git user like the repository"""
+    parent = Path(repo_path).parent
+    missing = [directory for directory in [parent, *parent.parents] if not directory.exists()]
+    parent.mkdir(parents=True, exist_ok=True)
+    if missing:
+        chown_to_git_user(missing[-1])
+
+
+class GCProvisioning():
+    """Declarative provisioning of repositories and web users from a manifest
+
+    The manifest is compared with the repositories on disk and the users in the
+    credential store, only the difference is applied. Everything runs in this
+    process: new repositories are initialized on a pool of git processes, renames,
+    removals and user changes follow, and the catalog is updated once at the end.
+    Nothing is removed unless the manifest asks for pruning.
+
+    A replica takes its repositories from the primary, only its web users are
+    provisioned. While a progressive restore runs the repositories are deferred,
+    an empty repository created first would be skipped by the restore and one
+    not restored yet would be pruned.
+
+    Usage:
+        GCProvisioning().run(dry_run=True)
+    """
+
+    def __init__(self, manifest_path=PROVISIONING_MANIFEST, state_path=PROVISIONING_STATE_PATH,
+                 workers=PROVISIONING_WORKERS):
+        self.manifest_path = Path(manifest_path)
+        self.state_path = Path(state_path)
+        self.workers = workers
+
+    def is_configured(self):
+        return self.manifest_path.is_file()
+
+    def manifest_signature(self):
+        try:
+            st = self.manifest_path.stat()
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def load_state(self):
+        try:
+            return json.loads(self.state_path.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self, signature, content, ok, deferred=False):
+        atomic_write_text(self.state_path, json.dumps({
+            'sha256': hashlib.sha256(content).hexdigest(),
+            'signature': signature,
+            'applied': time.time(),
+            'ok': ok,
+            'deferred': deferred,
+        }, indent=2, sort_keys=True), mode=0o600)
+
+    def restore_pending(self):
+        """
+        Returns:
+            bool: True if a progressive restore is running or was interrupted before it completed
+        """
+        status = read_restore_status()
+        return restore_in_progress() or (bool(status) and status.get('state') == 'running')
+
+    def plan(self, manifest, credentials, repositories=True):
+        """
+        Compute the changes that bring the repositories and users in line with a manifest
+
+        Args:
+            repositories (bool): False to only plan the web users
+
+        Returns:
+            dict: Lists of repositories to create, (old, new) renames, repositories
+                to remove, users to set and users to remove
+        """
+        current = {repo_key(repo_type, name) for repo_type in REPO_TYPES
+            for name in iter_repositories(repo_root_for(repo_type))}
+        create, rename = [], []
+        repositories = repositories and not is_replica()
+        if repositories:
+            for key, renamed_from in sorted(manifest['repositories'].items()):
+                if key in current:
+                    continue
+                if renamed_from in current and renamed_from not in manifest['repositories']:
+                    rename.append((renamed_from, key))
+                    current.discard(renamed_from)
+                else:
+                    create.append(key)
+        remove = []
+        if manifest['prune_repositories'] and repositories:
+            remove = sorted(current - set(manifest['repositories']))
+
+        users = set(credentials.list_users())
+        set_users = sorted(username for username, password_hash in manifest['users'].items()
+            if credentials.get_password_hash(username) != password_hash)
+        remove_users = sorted(users - set(manifest['users'])) if manifest['prune_users'] else []
+        return {'create': create, 'rename': rename, 'remove': remove, 'set_users': set_users,
+            'remove_users': remove_users}
+
+    def describe(self, plan):
+        lines = [f"create repository {key}" for key in plan['create']]
+        lines += [f"rename repository {old} to {new}" for old, new in plan['rename']]
+        lines += [f"remove repository {key}" for key in plan['remove']]
+        lines += [f"create or update web user {username}" for username in plan['set_users']]
+        lines += [f"remove web user {username}" for username in plan['remove_users']]
+        return lines
+
+    def init_repository(self, key):
+        path = repo_path_for(key)
+        run_git(path.parent, 'init', '--quiet', '--bare', path.name, check=True, capture_output=True, text=True)
+        chown_to_git_user(path)
+
+    def create_repositories(self, keys):
+        # Parent directories first and one at a time, the pool then only creates leaves
+        for key in keys:
+            make_parent(repo_path_for(key))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(self.init_repository, keys))
+
+    def rename_repository(self, old_key, new_key):
+        """
+        Returns:
+            list: Fork directories relinked to the new location
+        """
+        old_path, new_path = repo_path_for(old_key), repo_path_for(new_key)
+        make_parent(new_path)
+        old_path.rename(new_path)
+        forks = relink_forks(old_path, new_path)
+        for fork in forks:
+            chown_to_git_user(fork / 'objects' / 'info')
+        return forks
+
+    def remove_repository(self, key):
+        """
+        Returns:
+            list: Fork directories that got their own copy of the objects
+        """
+        path = repo_path_for(key)
+        forks = [fork for fork in repo_forks(path) if is_repository(fork)]
+        for fork in forks:
+            dissociate_fork(fork)
+            chown_to_git_user(fork)
+        parent = fork_parent(path)
+        shutil.rmtree(path)
+        if parent is not None and parent.exists():
+            update_parent_config(parent)
+        return forks
+
+    def apply(self, plan, manifest, credentials):
+        """
+        Apply a plan, each failing change is logged and the others go on
+
+        Returns:
+            bool: True if every change was applied
+        """
+        ok = True
+        start = time.monotonic()
+        created = []
+        if plan['create']:
+            try:
+                self.create_repositories(plan['create'])
+            except Exception as e:
+                logger.error(f"Failed to create repositories: {getattr(e, 'stderr', None) or e}")
+                ok = False
+            created = [key for key in plan['create'] if is_repository(repo_path_for(key))]
+            logger.info(f"Created {len(created)} repository(s) with {self.workers} worker(s) "
+                        f"in {time.monotonic() - start:.2f}s")
+
+        renamed, touched_forks = [], []
+        for old_key, new_key in plan['rename']:
+            try:
+                touched_forks += self.rename_repository(old_key, new_key)
+                renamed.append((old_key, new_key))
+                logger.info(f"Renamed repository {old_key} to {new_key}")
+            except Exception as e:
+                logger.error(f"Failed to rename repository {old_key} to {new_key}: {e}")
+                ok = False
+
+        # Forks before their parents, a removed fork needs no copy of the parent's objects
+        removed = []
+        for key in sorted(plan['remove'], key=lambda key: fork_parent(repo_path_for(key)) is None):
+            try:
+                touched_forks += self.remove_repository(key)
+                removed.append(key)
+                logger.info(f"Removed repository {key}, it is not in the manifest")
+            except Exception as e:
+                logger.error(f"Failed to remove repository {key}: {getattr(e, 'stderr', None) or e}")
+                ok = False
+
+        if created or renamed or removed:
+            with RepoCatalog().update() as catalog:
+                for key in created:
+                    catalog.add(*key.split('/', 1))
+                for old_key, new_key in renamed:
+                    repo_type = old_key.split('/', 1)[0]
+                    catalog.rename(repo_type, old_key.split('/', 1)[1], new_key.split('/', 1)[1])
+                for key in removed:
+                    catalog.remove(*key.split('/', 1))
+                for fork in touched_forks:
+                    fork_key = repo_key_for_path(fork)
+                    if fork_key and is_repository(fork):
+                        catalog.add(*fork_key.split('/', 1))
+
+        for username in plan['set_users']:
+            credentials.set_password_hash(username, manifest['users'][username])
+            logger.info(f"Web user {username} created or updated")
+        for username in plan['remove_users']:
+            credentials.remove(username)
+            logger.info(f"Web user {username} removed, it is not in the manifest")
+        return ok
+
+    def run(self, dry_run=False):
+        """
+        Apply the manifest, or only log what applying it would change
+
+        Returns:
+            bool: True if the manifest was valid and every change was applied
+        """
+        if not self.is_configured():
+            logger.info(f"No provisioning manifest at {self.manifest_path}, nothing to provision")
+            return True
+        signature = self.manifest_signature()
+        try:
+            content = self.manifest_path.read_bytes()
+        except OSError as e:
+            logger.error(f"Provisioning manifest not readable: {e}")
+            return False
+        try:
+            manifest = load_manifest(self.manifest_path)
+        except (OSError, ValueError) as e:
+            logger.error(f"Provisioning manifest not applied: {e}")
+            # Recorded so the watcher retries once the manifest is edited, not on every poll
+            if not dry_run:
+                self.save_state(signature, content, False)
+            return False
+
+        deferred = self.restore_pending() and not is_replica()
+        credentials = CredentialStore()
+        try:
+            plan = self.plan(manifest, credentials, repositories=not deferred)
+            changes = self.describe(plan)
+            if dry_run:
+                for change in changes:
+                    logger.info(f"Would {change}")
+                if deferred:
+                    logger.info("Progressive restore in progress, repositories would be deferred until it completes")
+                logger.info(f"Dry run of {self.manifest_path}: {len(changes)} change(s)")
+                return True
+            if is_replica() and manifest['repositories']:
+                logger.info("Replica mode, repositories of the manifest are left to the primary")
+            if deferred:
+                logger.info("Progressive restore in progress, repositories of the manifest are deferred until it completes")
+            ok = self.apply(plan, manifest, credentials) if changes else True
+        finally:
+            credentials.close()
+
+        logger.info(f"Applied {self.manifest_path}: {len(changes)} change(s)" if ok
+                    else f"Applied {self.manifest_path} with errors")
+        self.save_state(signature, content, ok, deferred=deferred)
+        return ok
+
+    def has_changed(self):
+        """
+        Returns:
+            bool: True if the manifest differs from the one last applied, or its repositories
+                were deferred and the restore has completed since
+        """
+        state = self.load_state()
+        if state.get('deferred') and not self.restore_pending():
+            return True
+        signature = self.manifest_signature()
+        if signature is None or signature == state.get('signature'):
+            return False
+        try:
+            content = self.manifest_path.read_bytes()
+        except OSError:
+            return False
+        # Touched or rewritten with the same content, only the signature is recorded
+        if hashlib.sha256(content).hexdigest() == state.get('sha256'):
+            atomic_write_text(self.state_path, json.dumps(dict(state, signature=signature), indent=2,
+                sort_keys=True), mode=0o600)
+            return False
+        return True
+
+    def is_deferred(self):
+        return bool(self.load_state().get('deferred'))
+
+    def run_after_restore(self, interval=RESTORE_WAIT_SECONDS):
+        """
+        Wait for the progressive restore to complete, then apply the deferred repositories
+
+        Returns:
+            bool: True if every change was applied
+        """
+        while self.restore_pending():
+            time.sleep(interval)
+        return self.run()
+
+    def watch(self, interval=PROVISIONING_POLL_INTERVAL):
+        """Poll the manifest and apply it whenever its content changes"""
+        logger.info(f"Watching {self.manifest_path} for changes every {interval}s")
+        while True:
+            try:
+                if self.has_changed():
+                    self.run()
+            except Exception as e:
+                logger.exception(f"Failed to apply {self.manifest_path}: {e}")
+            time.sleep(interval)
@@ -0,0 +1,270 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from shell_utility.catalog import REPO_TYPES, RepoCatalog
+from shell_utility.repository import is_repository
+from shell_utility.restore_status import read_restore_status, restore_lock
+from shell_utility.util import atomic_write_text
+
+from . import GCLogger
+from .constants import BACKUP_WORKERS, RESTORE_STATUS_FILE, RESTORE_TIMEOUT_SECONDS
+from .gitcmd import run_git
+from .shards import SHARD_SYSTEM_NAME, GCBackupShard, index_shard, read_shard_index, run_duplicity
+
+gc_logger = GCLogger(__name__)
+logger = gc_logger.get_logger()
+
+RESTORE_STAGING_DIR = '.restore'
+
+
+class GCProgressiveRestore():
+    """Restore of a sharded backup that brings repositories online one by one
+
+    The shard index and the system shard, holding the web users, are restored while
+    the container starts. The repository shards are then restored by a background
+    process, most recently pushed first, on a pool of BACKUP_WORKERS duplicity
+    processes. Each repository is restored into a hidden staging directory, checked
+    with git fsck and renamed into place, so it is either served complete or not at
+    all. Forks wait for the parent they borrow objects from. Progress and an ETA
+    based on the restored bytes are kept in RESTORE_STATUS_FILE, an interrupted
+    restore is resumed on the next start.
+    """
+
+    def __init__(self, status_file=RESTORE_STATUS_FILE):
+        self.status_file = status_file
+        self.status_lock = threading.Lock()
+        self.status = read_restore_status(status_file)
+
+    def save_status(self):
+        self.status['updated'] = time.time()
+        atomic_write_text(self.status_file, json.dumps(self.status, indent=2), mode=0o644)
+
+    def is_interrupted(self):
+        """
+        Returns:
+            bool: True if a previous restore left repositories pending
+        """
+        return bool(self.status) and self.status['state'] == 'running'
+
+    def unrestored_shards(self):
+        """
+        Shards a failed restore left offline, their backup is the only copy of the repository
+
+        A repository put back in place meanwhile, by hand or a later restore, is no
+        longer listed, its shard is backed up from disk again.
+
+        Returns:
+            list: GCBackupShard of every repository not restored and not on disk
+        """
+        if not self.status:
+            return []
+        return [GCBackupShard.from_dict(shard) for shard in self.status['shards'].values()
+            if shard['state'] != 'restored' and not Path(shard['source']).exists()]
+
+    def start(self):
+        """
+        Restore the index and system shards, then hand the repositories to a background process
+
+        Returns:
+            bool: True if the system shard was restored and the background restore started
+        """
+        with tempfile.TemporaryDirectory() as index_dir:
+            index = index_shard()
+            if not run_duplicity(['duplicity', 'restore', '--force', index.target, index_dir],
+                    RESTORE_TIMEOUT_SECONDS, "Restore of shard index"):
+                return False
+            shards = read_shard_index(index_dir)
+
+        for shard in shards:
+            if shard.name == SHARD_SYSTEM_NAME:
+                if not run_duplicity(['duplicity', 'restore', '--force', shard.target, shard.source],
+                        RESTORE_TIMEOUT_SECONDS, "Restore of shard system"):
+                    return False
+
+        repo_shards = [shard for shard in shards if shard.is_repository]
+        self.status = {
+            'state': 'running',
+            'started': time.time(),
+            'finished': None,
+            'eta': None,
+            'shards': {
+                shard.name: dict(shard.to_dict(), state='pending', took=None)
+                for shard in repo_shards
+            },
+        }
+        self.save_status()
+        self.spawn()
+        return True
+
+    def spawn(self):
+        logger.info(f"Restoring {len(self.status['shards'])} repositories in the background, see {self.status_file}")
+        subprocess.Popen(['/usr/local/bin/restore', '--resume'], start_new_session=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def staging_root(self, shard):
+        """Hidden directory below the repository root, renaming out of it never crosses a filesystem"""
+        repo_name = shard.name.split('/', 1)[1]
+        return Path(shard.source[:-len(repo_name)]) / RESTORE_STAGING_DIR
+
+    def staging_path(self, shard):
+        return self.staging_root(shard) / shard.name.split('/', 1)[1]
+
+    def verify_repository(self, shard, path):
+        result = run_git(path, 'fsck', '--connectivity-only', '--no-progress', capture_output=True, text=True)
+        if result.returncode != 0:
+            logger.error(f"Restored repository {shard.name} failed verification: {result.stderr.strip()}")
+            return False
+        return True
+
+    def add_to_catalog(self, shard):
+        repo_type, repo_name = shard.name.split('/', 1)
+        if repo_type in REPO_TYPES:
+            catalog = RepoCatalog()
+            with catalog.update():
+                catalog.add(repo_type, repo_name)
+
+    def restore_repository(self, shard):
+        """
+        Restore, verify and publish one repository
+
+        Returns:
+            bool: True if the repository is online
+        """
+        start = time.monotonic()
+        staging = self.staging_path(shard)
+        target = Path(shard.source)
+        if target.exists():
+            # Published by an interrupted run before it could record the shard as restored
+            if is_repository(target) and self.verify_repository(shard, target):
+                self.add_to_catalog(shard)
+                logger.info(f"Repository {shard.name} is already online at {target}")
+                return True
+            logger.warning(f"Skipping restore of {shard.name}, {target} already exists")
+            return False
+
+        if staging.exists():
+            shutil.rmtree(staging)
+        staging.parent.mkdir(parents=True, exist_ok=True)
+        if not run_duplicity(['duplicity', 'restore', '--force', shard.target, str(staging)],
+                RESTORE_TIMEOUT_SECONDS, f"Restore of shard {shard.name}"):
+            return False
+
+        if not self.verify_repository(shard, staging):
+            return False
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.rename(staging, target)
+        self.add_to_catalog(shard)
+        logger.info(f"Repository {shard.name} is online, restored in {time.monotonic() - start:.1f}s")
+        return True
+
+    def record(self, name, success, took):
+        with self.status_lock:
+            shard = self.status['shards'][name]
+            shard['state'] = 'restored' if success else 'failed'
+            shard['took'] = took
+
+            # Extrapolate from the bytes this run processed so far, shards are restored in parallel
+            self.restored_bytes += shard.get('size', 0) or 1
+            remaining = sum(s.get('size', 0) or 1 for s in self.status['shards'].values() if s['state'] == 'pending')
+            elapsed = time.time() - self.run_started
+            self.status['eta'] = time.time() + elapsed * remaining / self.restored_bytes
+            self.save_status()
+
+    def resume(self):
+        """
+        Restore the pending repositories, highest priority first
+
+        Returns:
+            bool: True if every repository was restored
+        """
+        lock = restore_lock(blocking=False)
+        if not lock.acquire():
+            logger.info("A restore is already running")
+            return True
+        try:
+            if not self.is_interrupted():
+                return True
+            self.run_started = time.time()
+            self.restored_bytes = 0
+            shards = self.status['shards']
+            pending = sorted((name for name, shard in shards.items() if shard['state'] != 'restored'),
+                key=lambda name: shards[name].get('priority', 0), reverse=True)
+            # Workers take shards in order, so a fork only ever waits for a parent already being restored
+            pending = parents_first(pending, {name: shards[name].get('parent') for name in pending})
+            for name in pending:
+                shards[name]['state'] = 'pending'
+            self.save_status()
+            done = {name: threading.Event() for name in pending}
+
+            def restore(name):
+                start = time.monotonic()
+                parent = shards[name].get('parent')
+                if parent in done:
+                    done[parent].wait()
+                try:
+                    if parent in shards and shards[parent]['state'] != 'restored':
+                        logger.error(f"Skipping restore of {name}, its parent {parent} was not restored")
+                        success = False
+                    else:
+                        success = self.restore_repository(GCBackupShard.from_dict(shards[name]))
+                except Exception as e:
+                    logger.exception(f"Restore of shard {name} failed with exception: {e}")
+                    success = False
+                self.record(name, success, round(time.monotonic() - start, 1))
+                done[name].set()
+                return success
+
+            logger.info(f"Restoring {len(pending)} repositories with {BACKUP_WORKERS} worker(s).")
+            with ThreadPoolExecutor(max_workers=BACKUP_WORKERS) as executor:
+                results = list(executor.map(restore, pending))
+
+            for staging_root in {self.staging_root(GCBackupShard.from_dict(shard)) for shard in shards.values()}:
+                shutil.rmtree(staging_root, ignore_errors=True)
+
+            failed = [name for name, success in zip(pending, results) if not success]
+            self.status['state'] = 'failed' if failed else 'completed'
+            self.status['finished'] = time.time()
+            self.status['eta'] = None
+            self.save_status()
+            if failed:
+                logger.error(f"Restore failed for {len(failed)} repositories: {', '.join(failed)}")
+                return False
+            logger.info(f"Restore of {len(pending)} repositories completed successfully")
+            return True
+        finally:
+            lock.release()
+
+
+def parents_first(names, parents):
+    """
+    Reorder shard names so every parent comes before its forks
+
+    Args:
+        names: Shard names in their preferred order
+        parents: Shard name to the shard name of its parent, None if it is not a fork
+
+    Returns:
+        list: The names, a fork keeps its position unless its parent came later
+    """
+    ordered = []
+    placed = set()
+
+    def place(name, seen):
+        if name in placed or name in seen:
+            return
+        if parents.get(name) in parents:
+            place(parents[name], seen | {name})
+        placed.add(name)
+        ordered.append(name)
+
+    for name in names:
+        place(name, set())
+    return ordered
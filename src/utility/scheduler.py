@@ -0,0 +1,153 @@
+import json
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+
+from . import GCLogger
+from .backup import GCBackup
+from .constants import (BACKUP_SCHEDULE, BACKUP_SCHEDULE_SECONDS, BACKUP_SCHEDULER_SOCKET, BACKUP_DEBOUNCE_SECONDS,
+    BACKUP_MAX_DELAY_SECONDS)
+
+gc_logger = GCLogger(__name__)
+logger = gc_logger.get_logger()
+
+# Seconds before the pushes of a failed or skipped backup are tried again
+RETRY_SECONDS = 60
+
+
+class GCBackupScheduler():
+    """Resident process running the backups in place of cron
+
+    The post-receive hook sends an event for every push to BACKUP_SCHEDULER_SOCKET.
+    A burst of pushes is coalesced into one backup that starts once no push arrived
+    for BACKUP_DEBOUNCE_SECONDS, or BACKUP_MAX_DELAY_SECONDS after the first push of
+    the burst when pushes keep coming. Exactly one backup runs at a time, pushes
+    arriving meanwhile queue up for a single follow-up backup. BACKUP_SCHEDULE is kept
+    as the fallback interval, it catches changes that did not come through a push.
+
+    Usage:
+        GCBackupScheduler().run()
+    """
+
+    def __init__(self, backup=None, socket_path=BACKUP_SCHEDULER_SOCKET, debounce=BACKUP_DEBOUNCE_SECONDS,
+                 max_delay=BACKUP_MAX_DELAY_SECONDS, interval=None):
+        """
+        Args:
+            backup: Optional GCBackup instance
+            socket_path: Datagram socket receiving the push events
+            debounce: Seconds without a push before a backup starts
+            max_delay: Longest delay in seconds of a backup after the first queued push
+            interval: Seconds between backups without pushes, defaults to BACKUP_SCHEDULE
+        """
+        self.backup = backup or GCBackup(configure=False)
+        self.socket_path = Path(socket_path)
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.interval = interval or BACKUP_SCHEDULE_SECONDS.get(BACKUP_SCHEDULE.upper(), BACKUP_SCHEDULE_SECONDS['DAILY'])
+        self.queued = set()
+        self.first_event = None
+        self.last_event = None
+        # Pushes of a backup that did not succeed, handed back by the worker thread
+        self.retry = None
+        self.retry_after = 0
+        # Changes made while the scheduler was down are picked up after the first debounce period
+        self.next_scheduled = time.monotonic() + debounce
+        self.worker = None
+
+    def bind(self):
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(str(self.socket_path))
+        # The hooks run as the git user
+        os.chmod(self.socket_path, 0o666)
+        sock.settimeout(1)
+        return sock
+
+    def receive(self, data):
+        try:
+            event = json.loads(data)
+            repo = event['repo']
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Ignoring malformed push event")
+            return
+        now = time.monotonic()
+        if not self.queued:
+            self.first_event = now
+        self.last_event = now
+        self.queued.add(repo)
+        logger.debug(f"Push to {repo}, {len(self.queued)} repository(ies) queued for backup")
+
+    def due(self, now):
+        """
+        Returns:
+            str: Reason for starting a backup now, or None
+        """
+        if self.queued and now >= self.retry_after:
+            if now - self.last_event >= self.debounce:
+                return 'push'
+            if now - self.first_event >= self.max_delay:
+                return 'push, maximum delay reached'
+        if now >= self.next_scheduled:
+            return 'schedule'
+        return None
+
+    def is_running(self):
+        return self.worker is not None and self.worker.is_alive()
+
+    def start_backup(self, reason):
+        repos = sorted(self.queued)
+        self.queued = set()
+        self.first_event = self.last_event = None
+        self.next_scheduled = time.monotonic() + self.interval
+        logger.info(f"Starting backup ({reason})" + (f" after pushes to {', '.join(repos)}" if repos else ""))
+        self.worker = threading.Thread(target=self.perform_backup, args=(repos,), name='backup', daemon=True)
+        self.worker.start()
+
+    def perform_backup(self, repos=()):
+        start = time.monotonic()
+        try:
+            success = self.backup.perform_backup()
+        except Exception as e:
+            logger.exception(f"Backup failed with exception: {e}")
+            success = False
+        if success and self.backup.skipped:
+            logger.info(f"Backup skipped, retrying in {RETRY_SECONDS}s")
+        else:
+            logger.info(f"Backup {'completed' if success else 'failed'} in {time.monotonic() - start:.1f}s")
+        if repos and (not success or self.backup.skipped):
+            self.retry = repos
+
+    def requeue(self):
+        """Queue the pushes of the last backup again if it failed or was skipped"""
+        repos, self.retry = self.retry, None
+        now = time.monotonic()
+        if not self.queued:
+            self.first_event = now
+        self.last_event = now
+        self.retry_after = now + RETRY_SECONDS
+        self.queued.update(repos)
+        logger.info(f"{len(repos)} repository(ies) queued again for backup")
+
+    def run(self):
+        if not self.backup.backup_enabled:
+            logger.error("Backup is not enabled. Backup scheduler not started.")
+            return False
+        sock = self.bind()
+        logger.info(f"Backup scheduler listening on {self.socket_path}, debounce {self.debounce}s, "
+                    f"maximum delay {self.max_delay}s, fallback every {self.interval}s")
+        while True:
+            try:
+                self.receive(sock.recv(4096))
+            except socket.timeout:
+                pass
+            if self.is_running():
+                continue
+            if self.retry:
+                self.requeue()
+            reason = self.due(time.monotonic())
+            if reason:
+                self.start_backup(reason)
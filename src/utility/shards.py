@@ -0,0 +1,175 @@
+import json
+from contextlib import nullcontext
+from pathlib import Path
+
+from shell_utility.backup_stats import add_backup_bytes
+from shell_utility.forks import fork_parent
+from shell_utility.locks import RepoLock
+from shell_utility.repository import iter_repositories, repo_size, repo_updated_time
+from shell_utility.util import atomic_write_text
+
+from . import GCLogger
+from .constants import BACKUP_PATHS, BACKUP_TARGET, SHARD_INDEX_PATH
+from .maintenance import MAINTENANCE_LOCK_NAME
+from .process import run_duplicity_process
+
+gc_logger = GCLogger(__name__)
+logger = gc_logger.get_logger()
+
+SHARD_INDEX_NAME = 'index'
+SHARD_SYSTEM_NAME = 'system'
+SHARD_INDEX_FILE = 'shards.json'
+
+
+class GCBackupShard():
+    """An independent duplicity backup set stored under its own target prefix
+
+    Repository shards back up a single repository directory, the system shard
+    backs up the files in BACKUP_PATHS and the index shard records which shards
+    exist so a restore into an empty container can find them.
+    """
+
+    def __init__(self, name, source, includes=None, fingerprint_keys=None, priority=0, size=0, parent=None):
+        """
+        Args:
+            name: Shard name, also the target prefix, e.g. private/project.git
+            source: Local directory the shard is backed up from and restored to
+            includes: Optional duplicity include paths, everything else below source is excluded
+            fingerprint_keys: Backup manifest keys covered by this shard
+            priority: Restore priority, higher first, the last push time for repositories
+            size: Size of the source in bytes when it was backed up, used for restore progress,
+                filled in by record_shard_sizes when the shard index is written
+            parent: Shard name of the repository a fork borrows objects from, restored first
+        """
+        self.name = name
+        self.source = str(source)
+        self.includes = includes or []
+        self.fingerprint_keys = fingerprint_keys if fingerprint_keys is not None else [self.source]
+        self.priority = priority
+        self.size = size
+        self.parent = parent
+
+    @property
+    def is_repository(self):
+        return self.name not in (SHARD_INDEX_NAME, SHARD_SYSTEM_NAME)
+
+    @property
+    def target(self):
+        return f"{BACKUP_TARGET.rstrip('/')}/shards/{self.name}"
+
+    def selection_args(self):
+        if not self.includes:
+            return []
+        args = []
+        for include in self.includes:
+            args.extend(['--include', include])
+        return args + ['--exclude', '**']
+
+    def to_dict(self):
+        return {'name': self.name, 'source': self.source, 'includes': self.includes, 'priority': self.priority,
+            'size': self.size, 'parent': self.parent}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['name'], data['source'], data.get('includes'), priority=data.get('priority', 0),
+            size=data.get('size', 0), parent=data.get('parent'))
+
+    def __repr__(self):
+        return f"GCBackupShard({self.name!r})"
+
+
+def index_shard():
+    return GCBackupShard(SHARD_INDEX_NAME, SHARD_INDEX_PATH, fingerprint_keys=[])
+
+
+def list_backup_shards(backup_paths=BACKUP_PATHS):
+    """Split the backup paths into shards
+
+    A fork shard only holds the objects the fork does not borrow from its parent,
+    shared objects are stored once in the parent's shard.
+
+    Returns:
+        list: One shard per repository below a directory in backup_paths, plus a
+            system shard holding the remaining files
+    """
+    shards = []
+    system_files = []
+    for backup_path in backup_paths:
+        path = Path(backup_path)
+        if path.is_dir():
+            for repo_name in iter_repositories(path):
+                repo_path = path / repo_name
+                parent = fork_parent(repo_path)
+                shards.append(GCBackupShard(str(path.relative_to('/') / repo_name), repo_path,
+                    priority=repo_updated_time(repo_path), parent=str(parent.relative_to('/')) if parent else None))
+        else:
+            system_files.append(str(path))
+
+    if system_files:
+        shards.append(GCBackupShard(SHARD_SYSTEM_NAME, '/', includes=system_files, fingerprint_keys=system_files))
+    return shards
+
+
+def record_shard_sizes(shards, changed):
+    """Fill in the size of repository shards for the restore progress
+
+    Measuring walks every file of a repository, only repositories backed up in this
+    run or missing from the last index are measured, the others keep their size.
+
+    Args:
+        shards: Shards about to be written to the index
+        changed: Names of the shards backed up in this run
+    """
+    try:
+        previous = {shard.name: shard.size for shard in read_shard_index()}
+    except (OSError, ValueError, KeyError):
+        previous = {}
+    for shard in shards:
+        if not shard.is_repository:
+            continue
+        if shard.name in changed or shard.name not in previous:
+            shard.size = repo_size(shard.source)
+        else:
+            shard.size = previous[shard.name]
+
+
+def write_shard_index(shards):
+    """Write the shard list into the directory backed up by the index shard"""
+    index = {'shards': [shard.to_dict() for shard in shards]}
+    atomic_write_text(Path(SHARD_INDEX_PATH) / SHARD_INDEX_FILE, json.dumps(index, indent=2), mode=0o600)
+
+
+def read_shard_index(index_dir=SHARD_INDEX_PATH):
+    """Read the shard list from a restored index shard
+
+    Returns:
+        list: Shards recorded by the last sharded backup
+    """
+    index = json.loads((Path(index_dir) / SHARD_INDEX_FILE).read_text())
+    return [GCBackupShard.from_dict(data) for data in index['shards']]
+
+
+def run_duplicity(cmd, timeout, description, lock_path=None):
+    """
+    Run a duplicity command for a single shard
+
+    Args:
+        cmd: duplicity command
+        timeout: Timeout in seconds
+        description: Short description used in log messages
+        lock_path: Optional repository to hold the maintenance lock of while duplicity runs
+
+    Returns:
+        bool: True if duplicity exited successfully
+    """
+    try:
+        lock = RepoLock(lock_path, MAINTENANCE_LOCK_NAME, shared=True) if lock_path else nullcontext()
+        with lock:
+            result = run_duplicity_process(cmd, timeout, description)
+        if result.success:
+            add_backup_bytes(result.parser.destination_bytes)
+        return result.success
+
+    except Exception as e:
+        logger.exception(f"{description} failed with exception: {e}")
+        return False
@@ -0,0 +1,196 @@
+import errno
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from shell_utility.locks import RepoLock
+from shell_utility.snapshot import SNAPSHOT_DIR, SNAPSHOT_LOCK_NAME
+
+from . import GCLogger
+from .constants import BACKUP_PATHS, BACKUP_STAGING, BACKUP_STAGING_REF_WAIT_SECONDS
+from .maintenance import MAINTENANCE_LOCK_NAME
+
+gc_logger = GCLogger(__name__)
+logger = gc_logger.get_logger()
+
+# Lock files git holds while it updates refs
+REF_LOCK_FILES = ('HEAD.lock', 'packed-refs.lock')
+REF_WAIT_INTERVAL = 0.01
+
+
+def iter_tree(root, skip=()):
+    """Walk a backup path, directories before their content
+
+    In a repository the refs are read before the objects, a push writes the
+    objects first, so every backed up ref points to backed up objects.
+
+    Args:
+        root: File or directory to walk
+        skip: Directories left out together with their content
+
+    Yields:
+        Path: root itself, then every directory, file and symlink below it
+    """
+    yield root
+    for dirpath, dirnames, filenames in os.walk(root):
+        base = Path(dirpath)
+        dirnames[:] = sorted((name for name in dirnames if base / name not in skip),
+            key=lambda name: (name == 'objects', name))
+        for name in sorted(filenames):
+            yield base / name
+        for name in dirnames:
+            yield base / name
+
+
+def staging_root(backup_path):
+    return Path(backup_path) / SNAPSHOT_DIR
+
+
+def staging_path(repo_path):
+    """
+    Returns:
+        Path: Directory a repository is staged in, below the backup path holding it so hardlinks work
+    """
+    repo_path = Path(repo_path)
+    for backup_path in BACKUP_PATHS:
+        if Path(backup_path) in repo_path.parents:
+            return staging_root(backup_path) / repo_path.relative_to(backup_path)
+    return staging_root(repo_path.parent) / repo_path.name
+
+
+def pending_ref_updates(repo_path):
+    """
+    Returns:
+        list: Ref lock files of receive-packs updating refs right now
+    """
+    repo_path = Path(repo_path)
+    locks = [repo_path / name for name in REF_LOCK_FILES if (repo_path / name).exists()]
+    return locks + list((repo_path / 'refs').rglob('*.lock'))
+
+
+def wait_for_ref_updates(repo_path, timeout=BACKUP_STAGING_REF_WAIT_SECONDS):
+    """
+    Wait until no ref of a repository is being updated
+
+    Returns:
+        bool: False if ref lock files were still there after timeout, e.g. left by a killed push
+    """
+    deadline = time.monotonic() + timeout
+    while pending_ref_updates(repo_path):
+        if time.monotonic() >= deadline:
+            logger.warning(f"Refs of {repo_path} still locked after {timeout}s, staging them as they are")
+            return False
+        time.sleep(REF_WAIT_INTERVAL)
+    return True
+
+
+def link_file(source, destination):
+    """Hardlink a file, copying it where the filesystem cannot link"""
+    try:
+        os.link(source, destination)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(source, destination)
+
+
+def stage_repository(repo_path, destination):
+    """
+    Build a frozen copy of a repository
+
+    Refs, config and the other small files are copied, everything below objects is
+    hardlinked. git never changes an object file in place, it writes a new file and
+    renames it, so a link keeps the content of the moment it was taken. The refs are
+    copied first, once no push is updating them, so every staged ref points to
+    staged objects.
+
+    Args:
+        repo_path: Repository directory
+        destination: Staging directory, must not exist
+    """
+    repo_path = Path(repo_path)
+    objects = repo_path / 'objects'
+    # Taken shared like backups, a repack never removes a pack before it is linked
+    with RepoLock(repo_path, MAINTENANCE_LOCK_NAME, shared=True):
+        with RepoLock(repo_path, SNAPSHOT_LOCK_NAME):
+            wait_for_ref_updates(repo_path)
+            for path in iter_tree(repo_path):
+                target = destination / path.relative_to(repo_path)
+                try:
+                    if path.is_symlink():
+                        os.symlink(os.readlink(path), target)
+                    elif path.is_dir():
+                        target.mkdir(parents=True)
+                        shutil.copystat(path, target)
+                    elif objects in path.parents:
+                        link_file(path, target)
+                    elif not path.name.endswith('.lock'):
+                        shutil.copy2(path, target)
+                except FileNotFoundError:
+                    # Removed meanwhile, e.g. a loose ref packed by a push
+                    continue
+
+
+class GCSnapshotStage():
+    """Point in time copies of repositories for a backup to read
+
+    Each repository is staged below <backup path>/.snapshot/ while its snapshot lock
+    is held, pushes reaching the pre-receive hook meanwhile wait a few milliseconds.
+    The backup then reads the staged copies without holding any lock, pushes and
+    maintenance go on. The staged copies are removed when the stage is left.
+
+    Usage:
+        with GCSnapshotStage(repo_paths) as stage:
+            with stage.read_path(repo_path) as source:
+                ...
+    """
+
+    def __init__(self, repo_paths, enabled=BACKUP_STAGING):
+        self.repo_paths = [Path(path) for path in repo_paths]
+        self.enabled = enabled
+        self.staged = {}
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+        # Left behind by an interrupted backup, backups never run at once
+        self.remove()
+        start = time.monotonic()
+        try:
+            for repo_path in self.repo_paths:
+                if not repo_path.is_dir():
+                    continue
+                self.staged[repo_path] = staging_path(repo_path)
+                stage_repository(repo_path, self.staged[repo_path])
+        except Exception:
+            self.remove()
+            raise
+        logger.info(f"Staged {len(self.staged)} repository(s) in {time.monotonic() - start:.2f}s")
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.enabled:
+            self.remove()
+
+    def remove(self):
+        for destination in self.staged.values():
+            shutil.rmtree(destination, ignore_errors=True)
+        self.staged = {}
+        for backup_path in BACKUP_PATHS:
+            shutil.rmtree(staging_root(backup_path), ignore_errors=True)
+
+    @contextmanager
+    def read_path(self, repo_path):
+        """
+        Yields:
+            Path: The staged copy of a repository, or the live repository while holding
+                its maintenance lock if it was not staged
+        """
+        repo_path = Path(repo_path)
+        if repo_path in self.staged:
+            yield self.staged[repo_path]
+            return
+        with RepoLock(repo_path, MAINTENANCE_LOCK_NAME, shared=True):
+            yield repo_path
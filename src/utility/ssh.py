@@ -1,9 +1,12 @@
 import subprocess
+import time
+
+from shell_utility.keys import SSHKeyIndex, scan_key_files
 
 from . import GCLogger
 
 from . import GCStateManager
-from .constants import KEYS_DIR_PATH , AUTHORIZED_KEYS_PATH, SSH_COMPONENT_NAME
+from .constants import KEYS_DIR_PATH, SSH_KEY_INDEX, SSH_KEYS_POLL_INTERVAL, SSH_COMPONENT_NAME
 
 gc_logger = GCLogger(__name__)
 logger = gc_logger.get_logger()
@@ -29,12 +32,53 @@ class GCSsh():
         self.state_manager.mark_configured()
 
     def install_ssh_keys(self):
+        """Rebuild the fingerprint index sshd's AuthorizedKeysCommand looks keys up in"""
         keys_dir = KEYS_DIR_PATH
-        authorized_keys = AUTHORIZED_KEYS_PATH
-        logger.info(f"Installing SSH keys from {str(keys_dir)} to {str(authorized_keys)}")
-        with open(authorized_keys, 'w') as ak:
-            for key_file in keys_dir.glob('*.pub'):
-                username = key_file.stem  # filename without .pub extension
-                logger.info(f"Installing SSH key for user {username}")
-                key_content = key_file.read_text().strip()
-                ak.write(f'environment="GIT_USER={username}",no-port-forwarding,no-X11-forwarding,no-agent-forwarding {key_content}\n')
\ No newline at end of file
+        logger.info(f"Installing SSH keys from {str(keys_dir)} to {SSH_KEY_INDEX}")
+        start = time.monotonic()
+        key_index = SSHKeyIndex()
+        try:
+            installed, failed = key_index.rebuild(keys_dir.glob('*.pub'))
+        finally:
+            key_index.close()
+        for key_file, error in failed:
+            logger.error(f"Skipped SSH keys of {key_file}: {error}")
+        logger.info(f"Installed {installed} SSH key(s) in {time.monotonic() - start:.2f}s")
+
+    def reload_ssh_keys(self, key_index):
+        """
+        Apply the .pub files added, changed or removed since they were last applied
+
+        Only files whose stat signature differs from the one recorded in the index are
+        read, all changes of a reload are applied in a single transaction.
+
+        Returns:
+            bool: True if anything changed
+        """
+        start = time.monotonic()
+        current = scan_key_files(KEYS_DIR_PATH)
+        applied = key_index.applied_signatures()
+        changed = [KEYS_DIR_PATH / name for name, signature in current.items() if applied.get(name) != signature]
+        removed = [name for name in applied if name not in current]
+        if not changed and not removed:
+            return False
+
+        installed, failed = key_index.apply_changes(changed, removed)
+        for key_file, error in failed:
+            logger.error(f"Skipped SSH keys of {key_file}: {error}")
+        for name in removed:
+            logger.info(f"Revoked SSH keys of user {name[:-len('.pub')]}")
+        logger.info(f"Reloaded SSH keys in {time.monotonic() - start:.3f}s: "
+                    f"{len(changed)} file(s) changed with {installed} key(s), {len(removed)} file(s) removed")
+        return True
+
+    def watch_ssh_keys(self, interval=SSH_KEYS_POLL_INTERVAL):
+        """Poll KEYS_DIR_PATH and apply key changes without restarting sshd"""
+        logger.info(f"Watching {str(KEYS_DIR_PATH)} for SSH key changes every {interval}s")
+        key_index = SSHKeyIndex()
+        while True:
+            try:
+                self.reload_ssh_keys(key_index)
+            except Exception as e:
+                logger.exception(f"Failed to reload SSH keys: {e}")
+            time.sleep(interval)
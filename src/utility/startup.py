@@ -0,0 +1,108 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from . import GCLogger
+
+gc_logger = GCLogger(__name__)
+logger = gc_logger.get_logger()
+
+
+class GCStartupStage():
+    def __init__(self, name, action, requires=()):
+        """
+        Args:
+            name: Stage name used in dependencies and log messages
+            action: Callable run for the stage, its return value is kept in results
+            requires: Names of the stages that must complete first
+        """
+        self.name = name
+        self.action = action
+        self.requires = set(requires)
+        self.started = None
+        self.duration = None
+
+
+class GCStartup():
+    """Runs the container init steps as a dependency graph
+
+    Stages whose dependencies completed run concurrently on a thread pool, most of
+    them wait on subprocesses such as ssh-keygen, gpg or duplicity. A failed stage
+    is logged and the stages depending on it are skipped, independent stages still
+    run. The start offset and duration of every stage are logged so the time until
+    repositories are served can be compared across releases.
+
+    Usage:
+        startup = GCStartup()
+        startup.add('gpg', GCGpg)
+        startup.add('backup', lambda: GCBackup(startup.results['gpg']), requires=['gpg'])
+        startup.run()
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.stages = {}
+        self.results = {}
+        self.failed = set()
+
+    def add(self, name, action, requires=()):
+        unknown = set(requires) - set(self.stages)
+        if unknown:
+            raise ValueError(f"Stage {name} requires unknown stage(s): {', '.join(sorted(unknown))}")
+        self.stages[name] = GCStartupStage(name, action, requires)
+
+    def run_stage(self, stage):
+        stage.started = time.monotonic()
+        logger.info(f"Startup stage {stage.name} started at +{stage.started - self.started:.2f}s")
+        try:
+            return stage.action()
+        finally:
+            stage.duration = time.monotonic() - stage.started
+
+    def run(self):
+        """
+        Run all stages
+
+        Returns:
+            bool: True if every stage completed
+        """
+        self.started = time.monotonic()
+        pending = dict(self.stages)
+        done = set()
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if stage.requires & self.failed:
+                        logger.error(f"Startup stage {name} skipped, it requires failed stage(s) "
+                                     f"{', '.join(sorted(stage.requires & self.failed))}")
+                        self.failed.add(name)
+                        del pending[name]
+                    elif stage.requires <= done:
+                        running[executor.submit(self.run_stage, stage)] = stage
+                        del pending[name]
+                if not running:
+                    # Only stages skipped above were left
+                    continue
+
+                completed, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    stage = running.pop(future)
+                    try:
+                        self.results[stage.name] = future.result()
+                        done.add(stage.name)
+                        logger.info(f"Startup stage {stage.name} completed in {stage.duration:.2f}s")
+                    except Exception as e:
+                        self.failed.add(stage.name)
+                        logger.exception(f"Startup stage {stage.name} failed after {stage.duration:.2f}s: {e}")
+
+        self.log_timings()
+        return not self.failed
+
+    def log_timings(self):
+        timings = ', '.join(
+            f"{stage.name} +{stage.started - self.started:.2f}s/{stage.duration:.2f}s"
+            for stage in sorted(self.stages.values(), key=lambda stage: stage.started or 0)
+            if stage.started is not None
+        )
+        logger.info(f"Startup completed in {time.monotonic() - self.started:.2f}s "
+                    f"({len(self.failed)} failed), stage start/duration: {timings}")